@@ -60,4 +60,8 @@ from .user import (
     verify_password_reset,
 )
 
-from .access import check_user_access, check_user_limit
+from .access import (
+    check_user_access,
+    check_user_access_batch,
+    check_user_limit,
+)
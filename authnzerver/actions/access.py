@@ -27,12 +27,190 @@ from sqlalchemy import select
 
 from .. import permissions
 from .. import authdb
+from ..cache import (
+    MemoryCache,
+    cache_get_generation,
+    cache_bump_generation,
+)
+
+
+###################################
+## USER STATUS CACHE FOR WORKERS ##
+###################################
+
+# these set the size and TTL of the per-worker user_id -> (role, is_active)
+# cache. when a user's status changes, the shared generation below is bumped,
+# which clears this cache in every worker and the server process. each of them
+# reads the generation at most once every
+# USER_STATUS_CACHE_GENERATION_CHECK_SECONDS, so a status changed in another
+# process can be seen for that long.
+USER_STATUS_CACHE_MAXSIZE = 20000
+USER_STATUS_CACHE_TTL_SECONDS = 30.0
+USER_STATUS_CACHE_GENERATION_KEY = 'authnzerver-user-status-generation'
+USER_STATUS_CACHE_GENERATION_CHECK_SECONDS = 0.25
+
+
+def _get_cache_dirname(currproc):
+    '''
+    This returns the cache directory shared by the server and its workers.
+
+    '''
+
+    return getattr(currproc, 'cache_dirname', '/tmp/authnzerver-cache')
+
+
+def _get_user_status_cache(currproc):
+    '''This returns the user status cache tied to the current auth DB engine.
+
+    The cache is cleared first if a user's status has been changed by any
+    process since the shared generation was last read.
+
+    '''
+
+    if (getattr(currproc, 'user_status_cache_engine', None) is not
+        currproc.authdb_engine):
+        currproc.user_status_cache = MemoryCache(
+            maxsize=USER_STATUS_CACHE_MAXSIZE,
+            ttl_seconds=USER_STATUS_CACHE_TTL_SECONDS
+        )
+        currproc.user_status_cache_engine = currproc.authdb_engine
+
+    if currproc.user_status_cache.generation_sync_due(
+            USER_STATUS_CACHE_GENERATION_CHECK_SECONDS
+    ):
+        currproc.user_status_cache.sync_generation(
+            cache_get_generation(USER_STATUS_CACHE_GENERATION_KEY,
+                                 cache_dirname=_get_cache_dirname(currproc))
+        )
+
+    return currproc.user_status_cache
+
+
+def get_user_statuses(currproc, user_ids):
+    '''This returns the role and active status for a list of user IDs.
+
+    The statuses are looked up from the worker's user status cache first. Any
+    user IDs not found there are looked up from the auth DB in a single query
+    and added to the cache.
+
+    Parameters
+    ----------
+
+    currproc : multiprocessing.Process
+        The current process. This must have an active auth DB connection.
+
+    user_ids : iterable of int
+        The user IDs to look up.
+
+    Returns
+    -------
+
+    dict
+        A dict of the form {user_id: (user_role, is_active)}. User IDs that
+        don't exist in the auth DB won't be present in this dict.
+
+    '''
+
+    status_cache = _get_user_status_cache(currproc)
+
+    statuses = {}
+    to_lookup = []
+
+    for user_id in set(user_ids):
+        status = status_cache.get(user_id)
+        if status is None:
+            to_lookup.append(user_id)
+        else:
+            statuses[user_id] = status
+
+    if len(to_lookup) > 0:
+
+        users = currproc.authdb_meta.tables['users']
+
+        s = select([
+            users.c.user_id,
+            users.c.user_role,
+            users.c.is_active,
+        ]).select_from(users).where(
+            users.c.user_id.in_(sorted(to_lookup))
+        )
+        result = currproc.authdb_conn.execute(s)
+        rows = result.fetchall()
+        result.close()
+
+        for row in rows:
+            status = (row['user_role'], bool(row['is_active']))
+            status_cache.set(row['user_id'], status)
+            statuses[row['user_id']] = status
+
+    return statuses
+
+
+def invalidate_user_status(user_id=None):
+    '''This removes a user's cached status from every worker.
+
+    This should be called by any action that changes a user's role or active
+    status, after the change has been written to the auth DB. The status is
+    removed from the current worker right away. The shared generation is
+    bumped so every other process clears its cache the next time it reads the
+    generation. If user_id is None, all cached statuses are removed.
+
+    '''
+
+    currproc = mp.current_process()
+    new_generation = cache_bump_generation(
+        USER_STATUS_CACHE_GENERATION_KEY,
+        cache_dirname=_get_cache_dirname(currproc)
+    )
+
+    status_cache = getattr(currproc, 'user_status_cache', None)
+
+    if status_cache is None:
+        return
+
+    if user_id is None:
+        status_cache.clear()
+    else:
+        status_cache.pop(int(user_id))
+
+    status_cache.advance_generation(new_generation)
+
+
+def user_status_cache_info():
+    '''
+    This returns the hit and miss counts for the current worker's cache.
+
+    '''
+
+    currproc = mp.current_process()
+    status_cache = getattr(currproc, 'user_status_cache', None)
+
+    if status_cache is None:
+        return None
+
+    return status_cache.info()
 
 
 ################
 ## FUNCTIONS  ##
 ################
 
+def _parse_sharedwith(target_sharedwith):
+    '''
+    This turns a CSV string of user IDs into a list of ints.
+
+    '''
+
+    if (target_sharedwith and
+        target_sharedwith != '' and
+        target_sharedwith.lower() != 'none'):
+
+        return [int(x) for x in target_sharedwith.split(',')]
+
+    else:
+        return []
+
+
 def check_user_access(payload,
                       raiseonfail=False,
                       override_permissions_json=None,
@@ -63,10 +241,10 @@ def check_user_access(payload,
         authnzerver start up routines. If you want to use some other permissions
         model JSON (e.g. for testing), provide that here.
 
-        Note that we load the permissions JSON from disk every time we need to
-        take a decision. This might be a bit slower, but allows for much faster
-        policy changes by just changing the permissions JSON file and not having
-        to restart the authnzerver.
+        Note that the compiled permissions model is cached in each worker
+        process and is only reloaded from disk when the permissions JSON file
+        changes. This allows for policy changes by just changing the permissions
+        JSON file and not having to restart the authnzerver.
 
     override_authdb_path : str or None
         If given as a str, is the alternative path to the auth DB.
@@ -132,8 +310,6 @@ def check_user_access(payload,
                 )
             )
 
-        users = currproc.authdb_meta.tables['users']
-
         originating_userid = int(payload['user_id'])
         originating_user_role = payload['user_role']
         target_userid = int(payload['target_owner'])
@@ -141,101 +317,240 @@ def check_user_access(payload,
 
         userids_to_check = [originating_userid,
                             target_userid]
+        userids_to_check.extend(_parse_sharedwith(target_sharedwith))
 
-        if (target_sharedwith and
-            target_sharedwith != '' and
-            target_sharedwith.lower() != 'none'):
+        user_statuses = get_user_statuses(currproc, userids_to_check)
 
-            sharedwith_userids = target_sharedwith.split(',')
-            sharedwith_userids = [int(x) for x in sharedwith_userids]
-            userids_to_check.extend(sharedwith_userids)
+        # check if the originating_userid is legit
+        if (user_statuses.get(originating_userid) !=
+            (originating_user_role, True)):
+            return {
+                'success': False,
+                'messages':['Access request check successful. '
+                            'Access granted: False.']
+            }
 
-        userids_to_check = list(set(userids_to_check))
+        # now check if the rest of the user IDs make sense. make sure all of the
+        # userids to check were found in the DB and are active.
+        if all(user_statuses.get(x, (None, False))[1]
+               for x in userids_to_check):
 
-        # check if the originating_userid is legit
-        s = select([
-            users.c.user_id
-        ]).select_from(users).where(
-            users.c.user_id == originating_userid
-        ).where(
-            users.c.user_role == originating_user_role
-        ).where(
-            users.c.is_active.is_(True)
-        )
-        result = currproc.authdb_conn.execute(s)
-        row = result.scalar()
+            return {
+                'success': access_granted,
+                'messages':['Access request check successful. '
+                            'Access granted: %s.' % access_granted]
+            }
+
+        else:
 
-        if not row or row != originating_userid:
             return {
                 'success': False,
                 'messages':['Access request check successful. '
                             'Access granted: False.']
             }
 
-        # now check if the rest of the user IDs make sense
-        s = select([
-            users.c.user_id,
-        ]).select_from(users).where(
-            users.c.user_id.in_(userids_to_check)
-        ).where(
-            users.c.is_active.is_(True)
-        )
+    except Exception:
 
-        result = currproc.authdb_conn.execute(s)
-        rows = result.fetchall()
-        result.close()
+        if raiseonfail:
+            raise
 
-        try:
+        LOGGER.error('Could not validate access to the '
+                     'requested item because of an exception.')
 
-            # make sure all of the userids to check were found in the DB
-            if rows and len(rows) > 0:
+        return {
+            'success':False,
+            'messages':["Could not validate access to the requested item."],
+        }
 
-                users_found = list(list(zip(*rows))[0])
-                if sorted(userids_to_check) == sorted(users_found):
 
-                    return {
-                        'success': access_granted,
-                        'messages':['Access request check successful. '
-                                    'Access granted: %s.' % access_granted]
-                    }
+def check_user_access_batch(payload,
+                            raiseonfail=False,
+                            override_permissions_json=None,
+                            override_authdb_path=None,
+                            max_targets=1000):
+    '''Checks for user access to a list of items based on a permissions
+    policy.
 
-                else:
+    This is meant for list views where a user needs access decisions for many
+    items at once. All user IDs referenced by the request are validated using a
+    single query against the users table, and the permissions model is loaded
+    only once for the whole batch.
 
-                    return {
-                        'success': False,
-                        'messages':['Access request check successful. '
-                                    'Access granted: False.']
-                    }
+    Parameters
+    ----------
 
-            else:
+    payload : dict
+        This is the input payload dict. Required items:
 
-                return {
-                    'success': False,
-                    'messages':['Access request check successful. '
-                                'Access granted: False.']
-                }
+        - user_id: int
+        - user_role: str
+        - action: str
+        - targets: list of dicts
+
+        Each dict in `targets` must have the following items:
+
+        - target_name: str
+        - target_owner: int
+        - target_visibility: str
+        - target_sharedwith: str
 
-        except Exception:
+        A target dict may also contain an `action` item to override the action
+        to check for that target.
 
-            if raiseonfail:
-                raise
+    raiseonfail : bool
+        If True, will raise an Exception if something goes wrong.
+
+    override_permissions_json : str or None
+        If given as a str, is the alternative path to the permissions JSON to
+        load and use for this request.
+
+    override_authdb_path : str or None
+        If given as a str, is the alternative path to the auth DB.
+
+    max_targets : int
+        The maximum number of targets allowed in a single request.
+
+    Returns
+    -------
+
+    dict
+        The dict returned is of the form::
+
+            {'success': True or False,
+             'access_granted': list of bools, one per target,
+             'messages': list of str messages if any}
+
+        'success' indicates if the batch was checked successfully. The access
+        decisions are in 'access_granted', in the same order as the targets
+        in the request.
+
+    '''
+
+    for key in ('user_id','user_role','action','targets'):
+
+        if key not in payload:
+            LOGGER.error('Invalid batch access grant request.')
 
             return {
                 'success':False,
-                'messages':["Access request check failed."],
+                'access_granted':None,
+                'messages':["Invalid batch access grant request."],
+            }
+
+    targets = payload['targets']
+
+    if (not isinstance(targets, (list, tuple)) or
+        len(targets) == 0 or
+        len(targets) > max_targets):
+
+        LOGGER.error('Invalid number of targets in batch access grant request.')
+
+        return {
+            'success':False,
+            'access_granted':None,
+            'messages':["Invalid batch access grant request. "
+                        "Between 1 and %s targets are required." % max_targets],
+        }
+
+    try:
+
+        currproc = mp.current_process()
+
+        # override permissions JSON if necessary
+        if override_permissions_json:
+            currproc.permissions_json = override_permissions_json
+
+        permissions_model = permissions.get_permissions_model(
+            currproc.permissions_json
+        )
+
+        engine = getattr(currproc, 'authdb_engine', None)
+
+        if override_authdb_path:
+            currproc.auth_db_path = override_authdb_path
+
+        if not engine:
+            (currproc.authdb_engine,
+             currproc.authdb_conn,
+             currproc.authdb_meta) = (
+                authdb.get_auth_db(
+                    currproc.auth_db_path,
+                    echo=raiseonfail
+                )
+            )
+
+        originating_userid = int(payload['user_id'])
+        originating_user_role = payload['user_role']
+
+        # collect all of the user IDs referenced by the targets
+        target_userids = []
+        userids_to_check = {originating_userid}
+
+        for target in targets:
+            this_target_userids = (
+                [int(target['target_owner'])] +
+                _parse_sharedwith(target['target_sharedwith'])
+            )
+            target_userids.append(this_target_userids)
+            userids_to_check.update(this_target_userids)
+
+        # get the role and active status of all of the users at once
+        user_statuses = get_user_statuses(currproc, userids_to_check)
+        active_users = {
+            k:v[0] for k, v in user_statuses.items() if v[1]
+        }
+
+        # check if the originating user is legit
+        if active_users.get(originating_userid) != originating_user_role:
+
+            return {
+                'success':True,
+                'access_granted':[False]*len(targets),
+                'messages':['Batch access request check successful. '
+                            'Access granted: 0 of %s.' % len(targets)]
             }
 
+        access_granted = []
+
+        for target, this_target_userids in zip(targets, target_userids):
+
+            if not all(x in active_users for x in this_target_userids):
+                access_granted.append(False)
+                continue
+
+            access_granted.append(
+                permissions.check_item_access(
+                    permissions_model,
+                    userid=originating_userid,
+                    role=originating_user_role,
+                    action=target.get('action', payload['action']),
+                    target_name=target['target_name'],
+                    target_owner=int(target['target_owner']),
+                    target_visibility=target['target_visibility'],
+                    target_sharedwith=target['target_sharedwith']
+                )
+            )
+
+        return {
+            'success':True,
+            'access_granted':access_granted,
+            'messages':['Batch access request check successful. '
+                        'Access granted: %s of %s.' %
+                        (sum(access_granted), len(targets))]
+        }
+
     except Exception:
 
         if raiseonfail:
             raise
 
         LOGGER.error('Could not validate access to the '
-                     'requested item because of an exception.')
+                     'requested items because of an exception.')
 
         return {
             'success':False,
-            'messages':["Could not validate access to the requested item."],
+            'access_granted':None,
+            'messages':["Could not validate access to the requested items."],
         }
 
 
@@ -266,10 +581,10 @@ def check_user_limit(payload,
         authnzerver start up routines. If you want to use some other permissions
         model JSON (e.g. for testing), provide that here.
 
-        Note that we load the permissions JSON from disk every time we need to
-        take a decision. This might be a bit slower, but allows for much faster
-        policy changes by just changing the permissions JSON file and not having
-        to restart the authnzerver.
+        Note that the compiled permissions model is cached in each worker
+        process and is only reloaded from disk when the permissions JSON file
+        changes. This allows for policy changes by just changing the permissions
+        JSON file and not having to restart the authnzerver.
 
     override_authdb_path : str or None
         If given as a str, is the alternative path to the auth DB.
@@ -328,50 +643,24 @@ def check_user_limit(payload,
                 )
             )
 
-        users = currproc.authdb_meta.tables['users']
-
         originating_userid = int(payload['user_id'])
         originating_user_role = str(payload['user_role'])
 
-        s = select([
-            users.c.user_id
-        ]).select_from(users).where(
-            users.c.user_id == originating_userid
-        ).where(
-            users.c.user_role == originating_user_role
-        ).where(
-            users.c.is_active.is_(True)
-        )
-
-        result = currproc.authdb_conn.execute(s)
-        rows = result.fetchall()
-        result.close()
-
-        try:
-
-            if rows and len(rows) > 0:
-                return {
-                    'success': limit_checked,
-                    'messages':['Limit check successful. '
-                                'Limit check passed: %s.' % limit_checked]
-                }
-            else:
-
-                return {
-                    'success': False,
-                    'messages':['Limit check successful. '
-                                'Limit check passed: False.']
-                }
+        user_statuses = get_user_statuses(currproc, [originating_userid])
 
-        except Exception:
-
-            if raiseonfail:
-                raise
+        if (user_statuses.get(originating_userid) ==
+            (originating_user_role, True)):
+            return {
+                'success': limit_checked,
+                'messages':['Limit check successful. '
+                            'Limit check passed: %s.' % limit_checked]
+            }
+        else:
 
             return {
-                'success':False,
-                'user_info':None,
-                'messages':["Limit check failed."],
+                'success': False,
+                'messages':['Limit check successful. '
+                            'Limit check passed: False.']
             }
 
     except Exception:
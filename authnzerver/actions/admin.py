@@ -27,7 +27,8 @@ import multiprocessing as mp
 from sqlalchemy import select, asc
 
 from .. import authdb
-from .session import auth_session_exists
+from .session import auth_session_exists, invalidate_session_cache
+from .access import invalidate_user_status
 
 
 ##################
@@ -402,6 +403,11 @@ def edit_user(payload,
             users.c.user_id == target_userid
         ).values(update_dict)
         result = currproc.authdb_conn.execute(upd)
+        result.close()
+
+        # drop this user's cached role, active status, and sessions
+        invalidate_user_status(target_userid)
+        invalidate_session_cache(user_id=target_userid)
 
         # check the update and return new values
         sel = select([
@@ -560,6 +566,11 @@ def internal_toggle_user_lock(payload,
             users.c.user_id == target_userid
         ).values(update_dict)
         result = currproc.authdb_conn.execute(upd)
+        result.close()
+
+        # drop this user's cached role, active status, and sessions
+        invalidate_user_status(target_userid)
+        invalidate_session_cache(user_id=target_userid)
 
         # check the update and return new values
         sel = select([
@@ -54,7 +54,8 @@ import time
 from sqlalchemy import select
 
 from .. import authdb
-from .session import auth_session_exists
+from .session import auth_session_exists, invalidate_session_cache
+from .access import invalidate_user_status
 
 
 ####################
@@ -441,6 +442,8 @@ def send_signup_verification_email(payload,
         result = currproc.authdb_conn.execute(upd)
         result.close()
 
+        invalidate_session_cache(user_id=payload['created_info']['user_id'])
+
         return {
             'success':True,
             'user_id':user_info['user_id'],
@@ -530,6 +533,11 @@ def verify_user_email_address(payload,
     rows = result.fetchone()
     result.close()
 
+    # drop this user's cached role, active status, and sessions
+    if rows:
+        invalidate_user_status(rows['user_id'])
+        invalidate_session_cache(user_id=rows['user_id'])
+
     if rows:
 
         return {
@@ -48,14 +48,115 @@ except Exception:
 import ipaddress
 import secrets
 import multiprocessing as mp
+import time
+from copy import deepcopy
 
 from sqlalchemy import select
 
 from .. import authdb
+from ..cache import (
+    MemoryCache,
+    cache_get_generation,
+    cache_bump_generation,
+)
+from ..passhash import pass_hasher, hashing_engine
+from .access import _get_cache_dirname
 
-from argon2 import PasswordHasher
 
-pass_hasher = PasswordHasher()
+####################################
+## SESSION INFO CACHE FOR WORKERS ##
+####################################
+
+# these set the size and TTL of the per-worker session_token -> session_info
+# cache. cached sessions also expire no later than the session itself. when a
+# session is changed or deleted, the shared generation below is bumped, which
+# clears this cache in every worker and the server process. each of them reads
+# the generation at most once every SESSION_CACHE_GENERATION_CHECK_SECONDS, so
+# a session deleted in another process can be seen for that long.
+SESSION_CACHE_MAXSIZE = 10000
+SESSION_CACHE_TTL_SECONDS = 15.0
+SESSION_CACHE_GENERATION_KEY = 'authnzerver-session-generation'
+SESSION_CACHE_GENERATION_CHECK_SECONDS = 0.25
+
+
+def _get_session_cache(currproc):
+    '''This returns the session info cache tied to the current auth DB engine.
+
+    The cache is cleared first if a session has been changed or deleted by any
+    process since the shared generation was last read.
+
+    '''
+
+    if (getattr(currproc, 'session_cache_engine', None) is not
+        currproc.authdb_engine):
+        currproc.session_cache = MemoryCache(
+            maxsize=SESSION_CACHE_MAXSIZE,
+            ttl_seconds=SESSION_CACHE_TTL_SECONDS
+        )
+        currproc.session_cache_engine = currproc.authdb_engine
+
+    if currproc.session_cache.generation_sync_due(
+            SESSION_CACHE_GENERATION_CHECK_SECONDS
+    ):
+        currproc.session_cache.sync_generation(
+            cache_get_generation(SESSION_CACHE_GENERATION_KEY,
+                                 cache_dirname=_get_cache_dirname(currproc))
+        )
+
+    return currproc.session_cache
+
+
+def invalidate_session_cache(session_token=None, user_id=None):
+    '''This removes cached session info from every worker.
+
+    This should be called after the change has been written to the auth DB. If
+    session_token is provided, only that session is removed from the current
+    worker. If user_id is provided, all sessions belonging to that user are
+    removed from it. If neither is provided, its whole cache is cleared. In
+    every case, the shared generation is bumped so every other process clears
+    its cache the next time it reads the generation.
+
+    '''
+
+    currproc = mp.current_process()
+    new_generation = cache_bump_generation(
+        SESSION_CACHE_GENERATION_KEY,
+        cache_dirname=_get_cache_dirname(currproc)
+    )
+
+    session_cache = getattr(currproc, 'session_cache', None)
+
+    if session_cache is None:
+        return
+
+    if session_token is not None:
+        session_cache.pop(session_token)
+
+    if user_id is not None:
+        user_id = int(user_id)
+        session_cache.pop_matching(
+            lambda token, info: info['user_id'] == user_id
+        )
+
+    if session_token is None and user_id is None:
+        session_cache.clear()
+
+    session_cache.advance_generation(new_generation)
+
+
+def session_cache_info():
+    '''
+    This returns the hit and miss counts for the current worker's cache.
+
+    '''
+
+    currproc = mp.current_process()
+    session_cache = getattr(currproc, 'session_cache', None)
+
+    if session_cache is None:
+        return None
+
+    return session_cache.info()
 
 
 ################################
@@ -239,6 +340,11 @@ def auth_session_set_extrainfo(payload,
             sessions.c.session_token == session_token
         ).values({'extra_info_json':extra_info})
         result = currproc.authdb_conn.execute(upd)
+        updated = result.rowcount
+        result.close()
+
+        if updated > 0:
+            invalidate_session_cache(session_token=session_token)
 
         s = select([
             sessions.c.session_token,
@@ -332,6 +438,17 @@ def auth_session_exists(payload,
                 )
             )
 
+        # return the session info from the cache if we can
+        session_cache = _get_session_cache(currproc)
+        cached_session = session_cache.get(session_token)
+
+        if cached_session is not None:
+            return {
+                'success':True,
+                'session_info':deepcopy(cached_session),
+                'messages':["Session look up successful."],
+            }
+
         sessions = currproc.authdb_meta.tables['sessions']
         users = currproc.authdb_meta.tables['users']
         s = select([
@@ -363,6 +480,16 @@ def auth_session_exists(payload,
 
             serialized_result = dict(rows)
 
+            # cache the session info until the session itself expires
+            session_expires_in = (
+                serialized_result['expires'] - datetime.utcnow()
+            ).total_seconds()
+            session_cache.set(
+                session_token,
+                deepcopy(serialized_result),
+                expires_at=time.monotonic() + session_expires_in
+            )
+
             return {
                 'success':True,
                 'session_info':serialized_result,
@@ -441,8 +568,14 @@ def auth_session_delete(payload,
             sessions.c.session_token == session_token
         )
         result = currproc.authdb_conn.execute(delete)
+        deleted = result.rowcount
         result.close()
 
+        # unknown tokens (including the fake deletes that make rejected logins
+        # take as long as real ones) don't clear every worker's cache
+        if deleted > 0:
+            invalidate_session_cache(session_token=session_token)
+
         return {
             'success':True,
             'messages':["Session deleted successfully."],
@@ -534,8 +667,12 @@ def auth_delete_sessions_userid(payload,
             )
 
         result = currproc.authdb_conn.execute(delete)
+        deleted = result.rowcount
         result.close()
 
+        if deleted > 0:
+            invalidate_session_cache(user_id=user_id)
+
         return {
             'success':True,
             'messages':["Sessions deleted successfully."],
@@ -631,10 +768,267 @@ def auth_kill_old_sessions(
         }
 
 
+######################################
+## PASSWORD CHECK TIMING EQUALIZING ##
+######################################
+
+# this user's password hash is checked against when there's no real user to
+# check, so rejected requests take as long as real password checks
+DUMMY_USER_ID = 3
+
+# this sets how rejected password checks and logins are made to take as long
+# as real ones. 'verify:N' runs N argon2 verifies in total against the dummy
+# user's password. 'duration:S' waits until S seconds have passed since the
+# request started. 'duration' does the same, with S set to the time taken by
+# two verifies, measured when the worker starts.
+DEFAULT_PASSWORD_TIMING = 'verify:2'
+
+
+def parse_password_timing(password_timing):
+    '''This parses a password timing spec.
+
+    Parameters
+    ----------
+
+    password_timing : str
+        One of 'verify:N', 'duration', or 'duration:S'. See
+        ``DEFAULT_PASSWORD_TIMING``.
+
+    Returns
+    -------
+
+    tuple
+        A (mode, value) tuple. mode is 'verify' or 'duration'. value is the
+        number of verifies for 'verify', and the number of seconds or None (if
+        it's to be calibrated) for 'duration'.
+
+    '''
+
+    mode, _, value = password_timing.strip().partition(':')
+    mode, value = mode.strip(), value.strip()
+
+    try:
+
+        if mode == 'verify':
+            nverifies = int(value)
+            if nverifies < 1:
+                raise ValueError()
+            return mode, nverifies
+
+        elif mode == 'duration':
+            if not value:
+                return mode, None
+            duration = float(value)
+            if duration <= 0.0:
+                raise ValueError()
+            return mode, duration
+
+    except ValueError:
+        pass
+
+    raise ValueError(
+        "Invalid password timing: '%s'. It must be one of: verify:N, "
+        "duration, or duration:S." % password_timing
+    )
+
+
+def _get_dummy_password(currproc):
+    '''This returns the dummy user's password hash.
+
+    The hash is read from the auth DB once and kept for as long as the current
+    auth DB engine is. If the dummy user is missing or its hash was made with
+    old hasher parameters, a hash of a random password is used instead.
+
+    '''
+
+    if (getattr(currproc, 'dummy_password_engine', None) is not
+        currproc.authdb_engine):
+
+        users = currproc.authdb_meta.tables['users']
+        dummy_sel = select([
+            users.c.password
+        ]).select_from(users).where(users.c.user_id == DUMMY_USER_ID)
+        dummy_results = currproc.authdb_conn.execute(dummy_sel)
+        dummy_row = dummy_results.fetchone()
+        dummy_results.close()
+
+        # if the dummy hash was made with different hasher parameters than
+        # the ones now in use, it would take a different time to check than
+        # real users' hashes, so make a new one
+        if (dummy_row is not None and dummy_row['password'] and
+            not pass_hasher.check_needs_rehash(dummy_row['password'])):
+            currproc.dummy_password = dummy_row['password']
+        else:
+            currproc.dummy_password = pass_hasher.hash(
+                secrets.token_urlsafe(32)
+            )
+
+        currproc.dummy_password_engine = currproc.authdb_engine
+
+    return currproc.dummy_password
+
+
+def _dummy_verify(currproc):
+    '''
+    This runs one argon2 verify against the dummy user's password.
+
+    '''
+
+    try:
+        pass_hasher.verify(_get_dummy_password(currproc), 'nope')
+    except Exception:
+        pass
+
+
+def calibrate_password_timing(currproc, nsamples=5):
+    '''This measures how long a real password check takes in this worker.
+
+    Returns the median time taken by two argon2 verifies in seconds.
+
+    '''
+
+    timings = []
+
+    for _ in range(nsamples):
+        start = time.monotonic()
+        _dummy_verify(currproc)
+        _dummy_verify(currproc)
+        timings.append(time.monotonic() - start)
+
+    timings.sort()
+    return timings[len(timings)//2]
+
+
+def _get_password_timing(currproc):
+    '''This returns the (mode, value) password timing for this worker.
+
+    The worker's password timing spec is taken from its password_timing
+    attribute. The spec is parsed, and calibrated if needed, once.
+
+    '''
+
+    password_timing = getattr(currproc,
+                              'password_timing',
+                              DEFAULT_PASSWORD_TIMING)
+    parsed = getattr(currproc, 'password_timing_parsed', None)
+
+    if parsed is None or parsed[0] != password_timing:
+
+        mode, value = parse_password_timing(password_timing)
+        if mode == 'duration' and value is None:
+            value = calibrate_password_timing(currproc)
+            LOGGER.info('Calibrated password check duration in %s: %.3f s' %
+                        (currproc.name, value))
+
+        parsed = (password_timing, mode, value)
+        currproc.password_timing_parsed = parsed
+
+    return parsed[1], parsed[2]
+
+
+def prepare_password_checks(override_authdb_path=None):
+    '''This loads the dummy password hash and calibrates password timing.
+
+    This is meant to run when a worker starts, so the first rejected requests
+    it handles don't pay for it.
+
+    '''
+
+    currproc = mp.current_process()
+    engine = getattr(currproc, 'authdb_engine', None)
+
+    if override_authdb_path:
+        currproc.auth_db_path = override_authdb_path
+
+    if not engine:
+        currproc.authdb_engine, currproc.authdb_conn, currproc.authdb_meta = (
+            authdb.get_auth_db(
+                currproc.auth_db_path,
+                echo=False
+            )
+        )
+
+    _get_dummy_password(currproc)
+    return _get_password_timing(currproc)
+
+
+def equalize_password_timing(currproc, start_time, verifies_done=0):
+    '''This makes a password check take as long as every other one.
+
+    Parameters
+    ----------
+
+    currproc : multiprocessing.Process
+        The current worker process.
+
+    start_time : float
+        The time.monotonic() time the request started at.
+
+    verifies_done : int
+        The number of real argon2 verifies the request has already run.
+
+    '''
+
+    mode, value = _get_password_timing(currproc)
+
+    if mode == 'verify':
+        for _ in range(value - verifies_done):
+            _dummy_verify(currproc)
+
+    else:
+        remaining = value - (time.monotonic() - start_time)
+        if remaining > 0.0:
+            # let other requests on this worker run while we wait
+            with hashing_engine.released():
+                time.sleep(remaining)
+
+
 ###################################
 ## USER LOGIN HANDLING FUNCTIONS ##
 ###################################
 
+def _rehash_password_if_needed(currproc, user_id, password_hash, password):
+    '''This rehashes a user's password if the hasher parameters have changed.
+
+    Returns True if the password was rehashed.
+
+    '''
+
+    try:
+        if not pass_hasher.check_needs_rehash(password_hash):
+            return False
+    except Exception:
+        LOGGER.exception('could not check the password hash for user: %s' %
+                         user_id)
+        return False
+
+    users = currproc.authdb_meta.tables['users']
+
+    try:
+
+        upd = users.update(
+        ).where(
+            users.c.user_id == user_id
+        ).where(
+            users.c.password == password_hash
+        ).values({
+            'password':pass_hasher.hash(password),
+            'last_updated':datetime.utcnow(),
+        })
+        result = currproc.authdb_conn.execute(upd)
+        result.close()
+
+        LOGGER.info('rehashed the password for user: %s' % user_id)
+        return True
+
+    # a failed rehash shouldn't fail the login. we'll try again next time.
+    except Exception:
+
+        LOGGER.exception('could not rehash the password for user: %s' %
+                         user_id)
+        return False
+
+
 def auth_password_check(payload,
                         override_authdb_path=None,
                         raiseonfail=False):
@@ -674,6 +1068,9 @@ def auth_password_check(payload,
             request_ok = False
             break
 
+    # rejected requests are made to take as long as real checks from here
+    start_time = time.monotonic()
+
     # this checks if the database connection is live
     currproc = mp.current_process()
     engine = getattr(currproc, 'authdb_engine', None)
@@ -695,7 +1092,7 @@ def auth_password_check(payload,
     # check if the request is OK
     #
 
-    # if it isn't, then hash the dummy user's password twice
+    # if it isn't, then make it take as long as a real password check
     if not request_ok:
 
         # dummy session request
@@ -705,32 +1102,8 @@ def auth_password_check(payload,
             override_authdb_path=override_authdb_path
         )
 
-        # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.authdb_conn.execute(dummy_sel)
-
-        dummy_password = dummy_results.fetchone()['password']
-        dummy_results.close()
-
-        try:
-            pass_hasher.verify(dummy_password, 'nope')
-        except Exception:
-            pass
-
-        # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.authdb_conn.execute(dummy_sel)
-        dummy_password = dummy_results.fetchone()['password']
-        dummy_results.close()
-
-        try:
-            pass_hasher.verify(dummy_password, 'nope')
-        except Exception:
-            pass
+        # make the rejection take as long as a real password check
+        equalize_password_timing(currproc, start_time)
 
         return {
             'success':False,
@@ -747,34 +1120,11 @@ def auth_password_check(payload,
             override_authdb_path=override_authdb_path
         )
 
-        # if it doesn't, hash the dummy password twice
+        # if it doesn't, reject the request
         if not session_info['success']:
 
-            # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.authdb_conn.execute(dummy_sel)
-            dummy_password = dummy_results.fetchone()['password']
-            dummy_results.close()
-
-            try:
-                pass_hasher.verify(dummy_password, 'nope')
-            except Exception:
-                pass
-
-            # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.authdb_conn.execute(dummy_sel)
-            dummy_password = dummy_results.fetchone()['password']
-            dummy_results.close()
-
-            try:
-                pass_hasher.verify(dummy_password, 'nope')
-            except Exception:
-                pass
+            # make the rejection take as long as a real password check
+            equalize_password_timing(currproc, start_time)
 
             return {
                 'success':False,
@@ -786,19 +1136,6 @@ def auth_password_check(payload,
         # password for the provided email
         else:
 
-            # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.authdb_conn.execute(dummy_sel)
-            dummy_password = dummy_results.fetchone()['password']
-            dummy_results.close()
-
-            try:
-                pass_hasher.verify(dummy_password, 'nope')
-            except Exception:
-                pass
-
             # look up the provided user
             user_sel = select([
                 users.c.user_id,
@@ -829,13 +1166,12 @@ def auth_password_check(payload,
                     )
                     pass_ok = False
 
-            else:
+                # the real check counts as one of the verifies
+                equalize_password_timing(currproc, start_time, verifies_done=1)
 
-                try:
-                    pass_hasher.verify(dummy_password, 'nope')
-                except Exception:
-                    pass
+            else:
 
+                equalize_password_timing(currproc, start_time)
                 pass_ok = False
 
             if not pass_ok:
@@ -907,6 +1243,9 @@ def auth_user_login(payload,
             request_ok = False
             break
 
+    # rejected requests are made to take as long as real checks from here
+    start_time = time.monotonic()
+
     # this checks if the database connection is live
     currproc = mp.current_process()
     engine = getattr(currproc, 'authdb_engine', None)
@@ -928,7 +1267,7 @@ def auth_user_login(payload,
     # check if the request is OK
     #
 
-    # if it isn't, then hash the dummy user's password twice
+    # if it isn't, then make it take as long as a real password check
     if not request_ok:
 
         # dummy session request
@@ -938,32 +1277,8 @@ def auth_user_login(payload,
             override_authdb_path=override_authdb_path
         )
 
-        # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.authdb_conn.execute(dummy_sel)
-
-        dummy_password = dummy_results.fetchone()['password']
-        dummy_results.close()
-
-        try:
-            pass_hasher.verify(dummy_password, 'nope')
-        except Exception:
-            pass
-
-        # always get the dummy user's password from the DB
-        dummy_sel = select([
-            users.c.password
-        ]).select_from(users).where(users.c.user_id == 3)
-        dummy_results = currproc.authdb_conn.execute(dummy_sel)
-        dummy_password = dummy_results.fetchone()['password']
-        dummy_results.close()
-
-        try:
-            pass_hasher.verify(dummy_password, 'nope')
-        except Exception:
-            pass
+        # make the rejection take as long as a real password check
+        equalize_password_timing(currproc, start_time)
 
         # run a fake session delete
         auth_session_delete({'session_token':'nope'},
@@ -985,34 +1300,11 @@ def auth_user_login(payload,
             override_authdb_path=override_authdb_path
         )
 
-        # if it doesn't, hash the dummy password twice
+        # if it doesn't, reject the request
         if not session_info['success']:
 
-            # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.authdb_conn.execute(dummy_sel)
-            dummy_password = dummy_results.fetchone()['password']
-            dummy_results.close()
-
-            try:
-                pass_hasher.verify(dummy_password,'nope')
-            except Exception:
-                pass
-
-            # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.authdb_conn.execute(dummy_sel)
-            dummy_password = dummy_results.fetchone()['password']
-            dummy_results.close()
-
-            try:
-                pass_hasher.verify(dummy_password, 'nope')
-            except Exception:
-                pass
+            # make the rejection take as long as a real password check
+            equalize_password_timing(currproc, start_time)
 
             # run a fake session delete
             auth_session_delete(
@@ -1031,19 +1323,6 @@ def auth_user_login(payload,
         # password for the provided email
         else:
 
-            # always get the dummy user's password from the DB
-            dummy_sel = select([
-                users.c.password
-            ]).select_from(users).where(users.c.user_id == 3)
-            dummy_results = currproc.authdb_conn.execute(dummy_sel)
-            dummy_password = dummy_results.fetchone()['password']
-            dummy_results.close()
-
-            try:
-                pass_hasher.verify(dummy_password, 'nope')
-            except Exception:
-                pass
-
             # look up the provided user
             user_sel = select([
                 users.c.user_id,
@@ -1078,13 +1357,12 @@ def auth_user_login(payload,
                     )
                     pass_ok = False
 
-            else:
+                # the real check counts as one of the verifies
+                equalize_password_timing(currproc, start_time, verifies_done=1)
 
-                try:
-                    pass_hasher.verify(dummy_password, 'nope')
-                except Exception:
-                    pass
+            else:
 
+                equalize_password_timing(currproc, start_time)
                 pass_ok = False
 
             # run a session delete on the provided token. the frontend will
@@ -1116,6 +1394,16 @@ def auth_user_login(payload,
                 if (user_info['is_active'] and
                     user_info['user_role'] != 'locked'):
 
+                    # upgrade the user's password hash if it was made with
+                    # old hasher parameters. this is the only time we have
+                    # their actual password.
+                    _rehash_password_if_needed(
+                        currproc,
+                        user_info['user_id'],
+                        user_info['password'],
+                        payload['password'][:1024]
+                    )
+
                     return {
                         'success':True,
                         'user_id': user_info['user_id'],
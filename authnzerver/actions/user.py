@@ -46,25 +46,17 @@ except Exception:
     utc = UTC()
 
 import multiprocessing as mp
-import socket
 import uuid
 
-from tornado.escape import squeeze
 from sqlalchemy import select
-from fuzzywuzzy.fuzz import UQRatio
 
 from .. import authdb
-from .session import auth_session_exists
-
-from argon2 import PasswordHasher
+from .session import auth_session_exists, invalidate_session_cache
+from .access import invalidate_user_status
 
 from .. import validators
-
-######################
-## PASSWORD CONTEXT ##
-######################
-
-pass_hasher = PasswordHasher()
+from ..passpolicy import get_password_policy
+from ..passhash import pass_hasher
 
 
 #######################
@@ -75,8 +67,9 @@ def validate_input_password(
         full_name,
         email,
         password,
-        min_length=12,
-        max_match_threshold=20
+        min_length=None,
+        max_match_threshold=20,
+        min_common_similarity=None
 ):
     '''This validates user input passwords.
 
@@ -84,97 +77,39 @@ def validate_input_password(
        1024 characters since we don't want to store entire novels)
     2. must not match within max_match_threshold of their email or full_name
     3. must not match within max_match_threshold of the site's FQDN
-    4. must not have a single case-folded character take up more than 20% of the
-       length of the password
+    4. must not have a single case-folded character take up more than the
+       policy's max_char_fraction (20% by default) of the length of the
+       password
     5. must not be completely numeric
-    6. must not be in the top 10k passwords list
+    6. must not be in the top 10k passwords list, or have an n-gram similarity
+       to one of them of min_common_similarity or more
+    7. must not be in the breached passwords file if one is loaded (see
+       :py:mod:`authnzerver.breached`)
+
+    The checks are run by this process's password policy (see
+    :py:mod:`authnzerver.passpolicy`). min_length, max_match_threshold, and
+    min_common_similarity use the policy's settings if they're None.
+    max_match_threshold keeps its old default of 20 for callers that don't
+    pass it. The actions that check new passwords pass None, so they use the
+    policy's max_similarity (30 by default, as before).
 
     '''
 
-    messages = []
-
-    # we'll ignore any repeated white space and fail immediately if the password
-    # is all white space
-    if len(squeeze(password.strip())) < min_length:
-
-        LOGGER.warning('password for new account: %s is too short' % email)
-        messages.append('Your password is too short. '
-                        'It must have at least %s characters.' % min_length)
-        passlen_ok = False
-    else:
-        passlen_ok = True
-
-    # check if the password is straight-up dumb
-    if password.casefold() in validators.TOP_10K_PASSWORDS:
-        LOGGER.warning('password for new account: %s is '
-                       'in top 10k passwords list' % email)
-        messages.append('Your password is on the list of the '
-                        'most common passwords and is vulnerable to guessing.')
-        tenk_ok = False
-    else:
-        tenk_ok = True
-
-    # FIXME: also add fuzzy matching to top 10k passwords list to avoid stuff
-    # like 'passwordpasswordpassword'
-
-    # check the fuzzy match against the FQDN and email address
-    fqdn = socket.getfqdn()
-    fqdn_match = UQRatio(password.casefold(), fqdn.casefold())
-    email_match = UQRatio(password.casefold(), email.casefold())
-    name_match = UQRatio(password.casefold(), full_name.casefold())
-
-    fqdn_ok = fqdn_match < max_match_threshold
-    email_ok = email_match < max_match_threshold
-    name_ok = name_match < max_match_threshold
-
-    if not fqdn_ok or not email_ok or not name_ok:
-        LOGGER.warning('password for new account: %s matches FQDN '
-                       '(similarity: %s) or their email address '
-                       '(similarity: %s)' % (email, fqdn_match, email_match))
-        messages.append('Your password is too similar to either '
-                        'the domain name of this server or your '
-                        'own name or email address.')
-
-    # next, check if the password is complex enough
-    histogram = {}
-    for char in password:
-        if char.lower() not in histogram:
-            histogram[char.lower()] = 1
-        else:
-            histogram[char.lower()] = histogram[char.lower()] + 1
-
-    hist_ok = True
-
-    for h in histogram:
-        if (histogram[h]/len(password)) > 0.2:
-            hist_ok = False
-            LOGGER.warning('one character is more than '
-                           '0.2 x length of the password')
-            messages.append(
-                'Your password is not complex enough. '
-                'One or more characters appear appear too frequently.'
-            )
-            break
-
-    # check if the password is all numeric
-    if password.isdigit():
-        numeric_ok = False
-        messages.append('Your password cannot be all numbers.')
-    else:
-        numeric_ok = True
-
-    return (
-        (passlen_ok and email_ok and name_ok and
-         fqdn_ok and hist_ok and numeric_ok and tenk_ok),
-        messages
+    return get_password_policy().validate(
+        full_name,
+        email,
+        password,
+        min_length=min_length,
+        max_match_threshold=max_match_threshold,
+        min_common_similarity=min_common_similarity
     )
 
 
 def change_user_password(payload,
                          raiseonfail=False,
                          override_authdb_path=None,
-                         min_pass_length=12,
-                         max_similarity=30):
+                         min_pass_length=None,
+                         max_similarity=None):
     '''This changes the user's password.
 
     payload requires the following keys:
@@ -336,8 +271,8 @@ def change_user_password(payload,
 ###################
 
 def create_new_user(payload,
-                    min_pass_length=12,
-                    max_similarity=30,
+                    min_pass_length=None,
+                    max_similarity=None,
                     raiseonfail=False,
                     override_authdb_path=None):
     '''This makes a new user.
@@ -685,6 +620,10 @@ def delete_user(payload,
     result = currproc.authdb_conn.execute(delete)
     result.close()
 
+    # drop this user's cached role, active status, and sessions
+    invalidate_user_status(payload['user_id'])
+    invalidate_session_cache(user_id=payload['user_id'])
+
     # don't forget to delete the sessions as well
     delete = sessions.delete().where(
         sessions.c.user_id == payload['user_id']
@@ -724,8 +663,8 @@ def delete_user(payload,
 def verify_password_reset(payload,
                           raiseonfail=False,
                           override_authdb_path=None,
-                          min_pass_length=12,
-                          max_similarity=30):
+                          min_pass_length=None,
+                          max_similarity=None):
     '''
     This verifies a password reset request.
 
@@ -30,7 +30,7 @@ from sqlalchemy import (
     Boolean, DateTime, ForeignKey, MetaData, JSON
 )
 
-from argon2 import PasswordHasher
+from .passhash import pass_hasher
 
 from .permissions import load_permissions_json
 
@@ -269,7 +269,15 @@ def get_auth_db(authdb_path,
             cursor.execute("PRAGMA foreign_keys=ON")
             cursor.close()
 
-    engine = create_engine(authdb_path, echo=echo)
+    # workers that run several requests at once share this connection between
+    # their threads. they never use it from two threads at the same time (see
+    # authnzerver.passhash.HashingEngine), so SQLite doesn't need to check
+    if authdb_path.startswith('sqlite'):
+        connect_args = {'check_same_thread':False}
+    else:
+        connect_args = {}
+
+    engine = create_engine(authdb_path, echo=echo, connect_args=connect_args)
     database_metadata.bind = engine
     conn = engine.connect()
 
@@ -351,9 +359,7 @@ def initial_authdb_inserts(auth_db_path,
     else:
         superuser_pass_auto = False
 
-    hasher = PasswordHasher()
-
-    hashed_password = hasher.hash(superuser_pass)
+    hashed_password = pass_hasher.hash(superuser_pass)
 
     result = conn.execute(
         users.insert().values([
@@ -370,7 +376,7 @@ def initial_authdb_inserts(auth_db_path,
              'full_name': "Superuser account"},
             # the anonuser,
             {'user_id':2,
-             'password': hasher.hash(secrets.token_urlsafe(32)),
+             'password': pass_hasher.hash(secrets.token_urlsafe(32)),
              'email': 'anonuser@localhost',
              'system_id':str(uuid.uuid4()),
              'email_verified': True,
@@ -381,7 +387,7 @@ def initial_authdb_inserts(auth_db_path,
              'full_name': "The systemwide anonymous user"},
             # the dummyuser to fail passwords for nonexistent users against
             {'user_id':3,
-             'password': hasher.hash(secrets.token_urlsafe(32)),
+             'password': pass_hasher.hash(secrets.token_urlsafe(32)),
              'email': 'dummyuser@localhost',
              'system_id':str(uuid.uuid4()),
              'email_verified': True,
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# breached.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This contains an offline check for passwords that have shown up in data
+breaches, and a tool to build the file it uses from the SHA-1 text dumps
+distributed by breach corpus projects like Have I Been Pwned.
+
+The text dump has one SHA-1 hash per line, optionally followed by a colon and
+the number of times it was seen, sorted by hash::
+
+    000000005AD76BD555C1D6D771DE417A4B87E4B4:10
+    00000000A8DAE4228F821FB418F59826079BF368:4
+    ...
+
+This is turned into a binary file that's memory-mapped by the workers, so
+checking a password doesn't need any network access and the hashes don't take
+up any memory in each worker beyond the pages the OS keeps in its shared file
+cache. The binary file has:
+
+- a header: the magic bytes b'AZBREACH', the format version, the number of
+  leading hash bytes used to index the hashes, and the number of hashes.
+
+- an index with one entry for each possible value of the leading hash bytes
+  (65536 for the default of 2 bytes), plus one at the end. Each entry is the
+  position of the first hash that starts with that value.
+
+- the rest of each hash after the leading bytes, in sorted order.
+
+A lookup reads two index entries to find the range of hashes that start with
+the same bytes as the password's hash, then runs a binary search over that
+range.
+
+Run the converter like so::
+
+    authnzrv-breached pwned-passwords-sha1-ordered-by-hash.txt breached.bin
+
+then set AUTHNZERVER_BREACHEDPASSWORDS to the path of the output file.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+
+# get a logger
+LOGGER = logging.getLogger(__name__)
+
+
+#############
+## IMPORTS ##
+#############
+
+import argparse
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+
+
+#################################
+## THE BREACHED PASSWORDS FILE ##
+#################################
+
+BREACHED_MAGIC = b'AZBREACH'
+BREACHED_VERSION = 1
+
+# magic, version, prefix bytes, number of hashes
+BREACHED_HEADER = struct.Struct('<8sIIQ')
+BREACHED_INDEX_ENTRY = struct.Struct('<Q')
+
+SHA1_BYTES = 20
+
+
+class BreachedPasswordFile(object):
+    '''This checks passwords against a memory-mapped breached passwords file.
+
+    Use it like a set of passwords::
+
+        breached = BreachedPasswordFile('breached.bin')
+        if 'correct horse battery staple' in breached:
+            ...
+
+    '''
+
+    def __init__(self, path):
+        '''
+        This opens the breached passwords file at path and memory-maps it.
+
+        '''
+
+        self.path = os.path.abspath(path)
+
+        with open(self.path, 'rb') as infd:
+            self._mmap = mmap.mmap(infd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+
+            if len(self._mmap) < BREACHED_HEADER.size:
+                raise ValueError('%s is too short to be a breached '
+                                 'passwords file' % self.path)
+
+            magic, version, prefix_bytes, nhashes = (
+                BREACHED_HEADER.unpack_from(self._mmap, 0)
+            )
+
+            if magic != BREACHED_MAGIC or version != BREACHED_VERSION:
+                raise ValueError('%s is not a breached passwords file, '
+                                 'or is from an unsupported version' %
+                                 self.path)
+
+            self.prefix_bytes = prefix_bytes
+            self.suffix_bytes = SHA1_BYTES - prefix_bytes
+            self.nhashes = nhashes
+
+            self._index_offset = BREACHED_HEADER.size
+            self._hashes_offset = (
+                self._index_offset +
+                ((1 << (8*prefix_bytes)) + 1)*BREACHED_INDEX_ENTRY.size
+            )
+
+            expected_size = self._hashes_offset + nhashes*self.suffix_bytes
+            if len(self._mmap) != expected_size:
+                raise ValueError('%s is truncated or corrupted: expected %s '
+                                 'bytes, found %s' %
+                                 (self.path, expected_size, len(self._mmap)))
+
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def __len__(self):
+        '''
+        This returns the number of hashes in the file.
+
+        '''
+
+        return self.nhashes
+
+    def __contains__(self, password):
+        '''
+        This returns True if the password is in the breached passwords file.
+
+        '''
+
+        return self.contains_hash(
+            hashlib.sha1(password.encode('utf-8')).digest()
+        )
+
+    def contains_hash(self, digest):
+        '''
+        This returns True if a 20-byte SHA-1 digest is in the file.
+
+        '''
+
+        prefix = int.from_bytes(digest[:self.prefix_bytes], 'big')
+        suffix = digest[self.prefix_bytes:]
+
+        index_pos = self._index_offset + prefix*BREACHED_INDEX_ENTRY.size
+        low = BREACHED_INDEX_ENTRY.unpack_from(self._mmap, index_pos)[0]
+        high = BREACHED_INDEX_ENTRY.unpack_from(
+            self._mmap, index_pos + BREACHED_INDEX_ENTRY.size
+        )[0]
+
+        # binary search over the hashes with the same prefix
+        while low < high:
+
+            mid = (low + high)//2
+            offset = self._hashes_offset + mid*self.suffix_bytes
+            mid_suffix = self._mmap[offset:offset + self.suffix_bytes]
+
+            if mid_suffix < suffix:
+                low = mid + 1
+            elif mid_suffix > suffix:
+                high = mid
+            else:
+                return True
+
+        return False
+
+    def close(self):
+        '''
+        This unmaps the file.
+
+        '''
+
+        self._mmap.close()
+
+
+def build_breached_password_file(input_path,
+                                 output_path,
+                                 min_count=1,
+                                 prefix_bytes=2):
+    '''This builds a breached passwords file from a text dump of SHA-1 hashes.
+
+    Parameters
+    ----------
+
+    input_path : str
+        The text dump to read. This has one hex SHA-1 hash per line, optionally
+        followed by a colon and the number of times the password was seen in
+        breaches. The lines must be sorted by hash.
+
+    output_path : str
+        The breached passwords file to write.
+
+    min_count : int
+        Only hashes seen at least this many times are written. Lines without
+        a count are always written.
+
+    prefix_bytes : int
+        The number of leading hash bytes to index the hashes by. The index
+        takes up 8 x 256^prefix_bytes bytes.
+
+    Returns
+    -------
+
+    int
+        The number of hashes written.
+
+    '''
+
+    if not 1 <= prefix_bytes <= 3:
+        raise ValueError('prefix_bytes must be 1, 2, or 3')
+
+    temp_path = '%s.tmp' % output_path
+
+    try:
+        nhashes = _write_breached_password_file(input_path,
+                                                temp_path,
+                                                min_count,
+                                                prefix_bytes)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    os.replace(temp_path, output_path)
+
+    LOGGER.info('Wrote %s hashes (%s bytes each) to %s' %
+                (nhashes, SHA1_BYTES - prefix_bytes, output_path))
+    return nhashes
+
+
+def _write_breached_password_file(input_path,
+                                  output_path,
+                                  min_count,
+                                  prefix_bytes):
+    '''
+    This does the work for :py:func:`.build_breached_password_file`.
+
+    '''
+
+    nprefixes = 1 << (8*prefix_bytes)
+
+    # the number of hashes that start with each prefix
+    prefix_counts = [0]*nprefixes
+
+    nhashes = 0
+    last_digest = b''
+    index_size = (nprefixes + 1)*BREACHED_INDEX_ENTRY.size
+
+    with open(input_path, 'r') as infd, open(output_path, 'wb') as outfd:
+
+        # write the header and leave room for the index. we'll come back and
+        # fill these in once we've seen all of the hashes
+        outfd.write(BREACHED_HEADER.pack(BREACHED_MAGIC,
+                                         BREACHED_VERSION,
+                                         prefix_bytes,
+                                         0))
+        outfd.write(b'\x00'*index_size)
+
+        for lineno, line in enumerate(infd, start=1):
+
+            line = line.strip()
+            if not line:
+                continue
+
+            hexdigest, _, count = line.partition(':')
+
+            try:
+                digest = bytes.fromhex(hexdigest)
+                if len(digest) != SHA1_BYTES:
+                    raise ValueError
+                if count and int(count) < min_count:
+                    continue
+            except ValueError:
+                raise ValueError('line %s of %s is not a SHA-1 hash: %r' %
+                                 (lineno, input_path, line))
+
+            if digest < last_digest:
+                raise ValueError(
+                    'line %s of %s is out of order. The hashes must be '
+                    'sorted by hash, e.g. use the ordered-by-hash '
+                    'download of the breach corpus.' % (lineno, input_path)
+                )
+            elif digest == last_digest:
+                continue
+
+            outfd.write(digest[prefix_bytes:])
+            prefix_counts[int.from_bytes(digest[:prefix_bytes], 'big')] += 1
+            nhashes += 1
+            last_digest = digest
+
+            if nhashes % 10000000 == 0:
+                LOGGER.info('%s hashes written...' % nhashes)
+
+        outfd.seek(0)
+        outfd.write(BREACHED_HEADER.pack(BREACHED_MAGIC,
+                                         BREACHED_VERSION,
+                                         prefix_bytes,
+                                         nhashes))
+
+        # turn the counts into the position of the first hash with each prefix
+        position = 0
+        for prefix_count in prefix_counts:
+            outfd.write(BREACHED_INDEX_ENTRY.pack(position))
+            position += prefix_count
+        outfd.write(BREACHED_INDEX_ENTRY.pack(position))
+
+    return nhashes
+
+
+##############################
+## THE SHARED BREACHED FILE ##
+##############################
+
+# this is the breached passwords file used by the password validator
+breached_passwords = None
+
+
+def load_breached_passwords(path):
+    '''This sets the breached passwords file used to validate new passwords.
+
+    If path is empty or None, new passwords aren't checked against any breached
+    passwords file. Returns the :py:class:`.BreachedPasswordFile` or None.
+
+    '''
+
+    global breached_passwords
+
+    if breached_passwords is not None:
+        breached_passwords.close()
+        breached_passwords = None
+
+    if path:
+        breached_passwords = BreachedPasswordFile(path)
+
+    return breached_passwords
+
+
+def is_breached_password(password):
+    '''This returns True if the password is in the breached passwords file.
+
+    This always returns False if no file has been loaded with
+    :py:func:`.load_breached_passwords`.
+
+    '''
+
+    if breached_passwords is None:
+        return False
+
+    return password in breached_passwords
+
+
+##########
+## MAIN ##
+##########
+
+def main():
+    '''
+    This converts a breach corpus text dump to a breached passwords file.
+
+    '''
+
+    parser = argparse.ArgumentParser(
+        description=('Build a breached passwords file for authnzerver from '
+                     'a text dump of SHA-1 hashes sorted by hash.')
+    )
+    parser.add_argument('input', help='the text dump of SHA-1 hashes')
+    parser.add_argument('output', help='the breached passwords file to write')
+    parser.add_argument('--min-count',
+                        type=int,
+                        default=1,
+                        help=('only include hashes seen at least this many '
+                              'times (default: %(default)s)'))
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s - %(levelname)s] %(message)s')
+
+    nhashes = build_breached_password_file(args.input,
+                                           args.output,
+                                           min_count=args.min_count)
+    print('Wrote %s hashes to %s. Set AUTHNZERVER_BREACHEDPASSWORDS=%s to '
+          'use them.' % (nhashes, args.output, os.path.abspath(args.output)))
+
+
+if __name__ == '__main__':
+    main()
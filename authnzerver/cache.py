@@ -21,12 +21,337 @@ LOGGER = logging.getLogger(__name__)
 ## IMPORTS ##
 #############
 
+import os
 import os.path
 import time
+import math
+import atexit
+import threading
 from datetime import datetime
+from collections import OrderedDict
 
 from diskcache import FanoutCache
 
+from . import permissions
+
+
+#########################
+## IN-MEMORY LRU CACHE ##
+#########################
+
+class MemoryCache(object):
+    '''This is a bounded in-memory LRU cache with per-item expiry times.
+
+    This is meant to be used as a process-local cache in front of the auth DB
+    for values that are read often and change rarely. It is not thread-safe.
+
+    Caches in several processes can be kept in step with a shared generation
+    number (see :py:func:`cache_get_generation`). Each process calls
+    :py:meth:`.sync_generation` before it reads, which throws away everything
+    cached under an older generation. :py:meth:`.generation_sync_due` can be
+    used to read the shared generation at most once every few hundred ms.
+
+    '''
+
+    def __init__(self,
+                 maxsize=10000,
+                 ttl_seconds=60.0,
+                 timer=time.monotonic):
+        '''
+        This sets up the cache.
+
+        Parameters
+        ----------
+
+        maxsize : int
+            The maximum number of items to hold. If this is exceeded, the least
+            recently used items will be evicted.
+
+        ttl_seconds : float
+            The default number of seconds after which an item expires.
+
+        timer : callable
+            The function used to get the current time in seconds.
+
+        '''
+
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.timer = timer
+
+        self._items = OrderedDict()
+        self.generation = None
+        self.generation_synced = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        item = self._items.get(key, None)
+        return item is not None and item[0] > self.timer()
+
+    def get(self, key, default=None):
+        '''
+        This returns the value for key if it's present and hasn't expired.
+
+        '''
+
+        item = self._items.get(key, None)
+
+        if item is None:
+            self.misses += 1
+            return default
+
+        if item[0] <= self.timer():
+            del self._items[key]
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl_seconds=None, expires_at=None):
+        '''This adds or replaces the value for key.
+
+        The item expires after ttl_seconds (or the default TTL for the cache if
+        this is None). If expires_at is provided as a time from the cache's
+        timer, the item will expire at the earlier of this time and the TTL.
+
+        '''
+
+        if self.maxsize <= 0:
+            return
+
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+
+        item_expires = self.timer() + ttl_seconds
+        if expires_at is not None and expires_at < item_expires:
+            item_expires = expires_at
+
+        self._items[key] = (item_expires, value)
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        '''
+        This removes key from the cache and returns its value.
+
+        '''
+
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def pop_matching(self, predicate):
+        '''This removes all items for which predicate(key, value) is True.
+
+        Returns the number of items removed.
+
+        '''
+
+        to_remove = [k for k, (_, v) in self._items.items() if predicate(k, v)]
+        for k in to_remove:
+            del self._items[k]
+        return len(to_remove)
+
+    def clear(self):
+        '''
+        This removes all items from the cache.
+
+        '''
+
+        self._items.clear()
+
+    def sync_generation(self, generation):
+        '''This clears the cache if the shared generation has moved on.
+
+        If generation is None because the shared generation couldn't be read,
+        the cache is cleared every time, so nothing in it is used.
+
+        '''
+
+        if generation is None or generation != self.generation:
+            self._items.clear()
+            self.generation = generation
+
+        self.generation_synced = self.timer()
+
+    def generation_sync_due(self, interval_seconds):
+        '''This returns True if the shared generation should be read again.
+
+        This is True if the cache hasn't synced in the last interval_seconds,
+        or if it doesn't know the current generation.
+
+        '''
+
+        return (self.generation is None or
+                self.generation_synced is None or
+                self.timer() - self.generation_synced >= interval_seconds)
+
+    def advance_generation(self, new_generation):
+        '''This records a shared generation bump made by this process.
+
+        The items still in the cache are kept if no other process bumped the
+        generation since this cache last synced. Otherwise, the cache is
+        cleared and will pick up the new generation on the next sync.
+
+        '''
+
+        if (new_generation is None or self.generation is None or
+            new_generation != self.generation + 1):
+            self._items.clear()
+            self.generation = None
+        else:
+            self.generation = new_generation
+
+    def info(self):
+        '''
+        This returns the hit, miss, and eviction counts for the cache.
+
+        '''
+
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'evictions':self.evictions,
+            'size':len(self._items),
+            'maxsize':self.maxsize,
+            'ttl_seconds':self.ttl_seconds,
+        }
+
+
+############################
+## DISKCACHE HANDLE REUSE ##
+############################
+
+# this holds one open FanoutCache per (cache directory, timeout) for this
+# process. the handles are dropped if we find ourselves in a forked child, since
+# their SQLite connections belong to the parent.
+_CACHE_HANDLES = {}
+_CACHE_HANDLES_PID = os.getpid()
+_CACHE_HANDLES_LOCK = threading.Lock()
+
+
+def get_cache_handle(cache_dirname='/tmp/authnzerver-cache',
+                     timeout_seconds=0.3):
+    '''This returns a long-lived FanoutCache handle for this process.
+
+    Parameters
+    ----------
+
+    cache_dirname : str
+        The directory containing the cache.
+
+    timeout_seconds : float
+        The SQLite timeout to use for cache operations.
+
+    Returns
+    -------
+
+    diskcache.FanoutCache
+        The open cache handle. Don't close this yourself; use
+        :py:func:`cache_close_all` instead.
+
+    '''
+
+    global _CACHE_HANDLES_PID
+
+    cache_key = (os.path.abspath(cache_dirname), timeout_seconds)
+
+    with _CACHE_HANDLES_LOCK:
+
+        if _CACHE_HANDLES_PID != os.getpid():
+            _CACHE_HANDLES.clear()
+            _CACHE_HANDLES_PID = os.getpid()
+
+        cache = _CACHE_HANDLES.get(cache_key, None)
+
+        if cache is None:
+            cache = FanoutCache(cache_key[0], timeout=timeout_seconds)
+            _CACHE_HANDLES[cache_key] = cache
+
+    return cache
+
+
+def cache_close_all():
+    '''
+    This closes all of the cache handles opened by this process.
+
+    '''
+
+    with _CACHE_HANDLES_LOCK:
+
+        if _CACHE_HANDLES_PID == os.getpid():
+            for cache in _CACHE_HANDLES.values():
+                try:
+                    cache.close()
+                except Exception:
+                    LOGGER.exception('could not close cache handle')
+
+        _CACHE_HANDLES.clear()
+
+
+atexit.register(cache_close_all)
+
+
+#################################################
+## SHARED GENERATIONS FOR PROCESS-LOCAL CACHES ##
+#################################################
+
+def cache_get_generation(key,
+                         timeout_seconds=0.3,
+                         cache_dirname='/tmp/authnzerver-cache'):
+    '''This returns the current generation number for key.
+
+    Returns 0 if the generation has never been bumped, or None if it can't be
+    read from the cache.
+
+    '''
+
+    try:
+
+        cache = get_cache_handle(cache_dirname, timeout_seconds)
+        generation = cache.get(key)
+
+        # FanoutCache returns None for both a missing key and a read that timed
+        # out, so we set up the key and try again to tell the two apart
+        if generation is None:
+            cache.add(key, 0)
+            generation = cache.get(key)
+
+        return generation
+
+    except Exception:
+        LOGGER.exception('could not read the generation for %s' % key)
+        return None
+
+
+def cache_bump_generation(key,
+                          timeout_seconds=0.3,
+                          cache_dirname='/tmp/authnzerver-cache'):
+    '''This increments the generation number for key.
+
+    Every process-local cache synced to key is cleared on its next read.
+    Returns the new generation number, or None if it couldn't be bumped.
+
+    '''
+
+    try:
+        cache = get_cache_handle(cache_dirname, timeout_seconds)
+        return cache.incr(key, default=0)
+    except Exception:
+        LOGGER.exception('could not bump the generation for %s' % key)
+        return None
+
 
 ##############################
 ## CACHE HANDLING FUNCTIONS ##
@@ -41,10 +366,8 @@ def cache_add(key, value,
 
     '''
 
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
     added = cache.add(key, value, expire=expires_seconds)
-    cache.close()
 
     return added
 
@@ -56,10 +379,8 @@ def cache_get(key,
     This sets a key to the value specified in the cache.
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
     val = cache.get(key)
-    cache.close()
 
     return val
 
@@ -71,10 +392,8 @@ def cache_pop(key,
     This sets a key to the value specified in the cache.
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
     val = cache.pop(key)
-    cache.close()
 
     return val
 
@@ -86,10 +405,8 @@ def cache_delete(key,
     This sets a key to the value specified in the cache.
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
     deleted = cache.delete(key)
-    cache.close()
 
     return deleted
 
@@ -104,8 +421,7 @@ def cache_increment(key,
     Then increments 'key-counter'.
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
 
     # add the key if not already present
     key_added = cache.add(key, time.time())
@@ -116,7 +432,6 @@ def cache_increment(key,
     else:
         key_count = cache.incr('%s-counter' % key)
 
-    cache.close()
     return key_count
 
 
@@ -127,8 +442,7 @@ def cache_decrement(key,
     This decrements the counter for key.
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
     decremented_val = cache.decr('%s-counter' % key)
 
     # if the counter hits zero, delete the key entirely from the cache
@@ -137,7 +451,6 @@ def cache_decrement(key,
         cache.delete('%s-counter' % key)
         decremented_val = 0
 
-    cache.close()
     return decremented_val
 
 
@@ -151,8 +464,7 @@ def cache_getrate(key,
     key-counter_val/((time_now - time_insertion)/60.0)
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
 
     # get the counter value
     counter_val = cache.get('%s-counter' % key, default=0)
@@ -166,11 +478,11 @@ def cache_getrate(key,
     else:
         rate = 0.0
 
-    cache.close()
     return (
         rate,
         counter_val,
-        datetime.fromtimestamp(time_of_insertion).isoformat()
+        (datetime.fromtimestamp(time_of_insertion).isoformat()
+         if time_of_insertion is not None else None)
     )
 
 
@@ -180,9 +492,743 @@ def cache_flush(timeout_seconds=0.3,
     This removes all keys from the cache.
 
     '''
-    cachedir = os.path.abspath(cache_dirname)
-    cache = FanoutCache(cachedir, timeout=timeout_seconds)
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
     items_removed = cache.clear()
-    cache.close()
 
     return items_removed
+
+
+###################
+## RATE LIMITING ##
+###################
+
+def gcra_check(theoretical_arrival,
+               now,
+               rate_per_minute,
+               burst=None,
+               cost=1):
+    '''This applies the generic cell rate algorithm (GCRA) to a request.
+
+    GCRA keeps a single value per key: the theoretical arrival time (TAT) of
+    the next request if the client was making requests at exactly the allowed
+    rate. A request is allowed if it doesn't push the TAT further than the
+    burst allowance ahead of now. Idle time lets the TAT fall behind now, so the
+    allowance is replenished at the allowed rate and never more than the burst.
+
+    Parameters
+    ----------
+
+    theoretical_arrival : float or None
+        The stored TAT for the key as a UNIX time. None if there isn't one.
+
+    now : float
+        The current UNIX time.
+
+    rate_per_minute : float
+        The allowed number of requests per minute.
+
+    burst : int or None
+        The number of requests that can be made at once. If None, this is the
+        same as rate_per_minute. If either of these is zero, no requests are
+        allowed and retry_after is always 60 seconds.
+
+    cost : int
+        The number of requests this request counts as.
+
+    Returns
+    -------
+
+    dict
+        A dict of the form::
+
+            {'allowed': True if the request is allowed,
+             'remaining': the number of requests that can be made right now,
+             'retry_after': seconds to wait until this request is allowed,
+             'reset_after': seconds until the full burst is available again,
+             'theoretical_arrival': the new TAT to store for the key}
+
+    '''
+
+    if burst is None:
+        burst = rate_per_minute
+
+    # a zero rate or burst means no requests are allowed at all
+    if rate_per_minute <= 0 or burst < 1:
+        return {
+            'allowed':False,
+            'remaining':0,
+            'retry_after':60.0,
+            'reset_after':60.0,
+            'theoretical_arrival':theoretical_arrival,
+        }
+
+    emission_interval = 60.0/rate_per_minute
+
+    delay_tolerance = emission_interval*burst
+
+    if theoretical_arrival is None or theoretical_arrival < now:
+        theoretical_arrival = now
+
+    new_theoretical_arrival = theoretical_arrival + emission_interval*cost
+    allow_at = new_theoretical_arrival - delay_tolerance
+
+    if now < allow_at:
+
+        return {
+            'allowed':False,
+            'remaining':0,
+            'retry_after':allow_at - now,
+            'reset_after':theoretical_arrival - now,
+            'theoretical_arrival':theoretical_arrival,
+        }
+
+    return {
+        'allowed':True,
+        'remaining':int((now - allow_at)/emission_interval + 1.0e-9),
+        'retry_after':0.0,
+        'reset_after':new_theoretical_arrival - now,
+        'theoretical_arrival':new_theoretical_arrival,
+    }
+
+
+def cache_ratelimit(key,
+                    rate_per_minute,
+                    burst=None,
+                    cost=1,
+                    timeout_seconds=0.3,
+                    cache_dirname='/tmp/authnzerver-cache'):
+    '''This checks and updates the rate limit for a key in the cache.
+
+    This uses :py:func:`.gcra_check`, so there's only a single item per key in
+    the cache. The item is read and updated in one transaction, so this is safe
+    to use from several processes sharing the same cache directory.
+
+    Returns the same dict as :py:func:`.gcra_check`.
+
+    '''
+
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
+    ratelimits = cache.cache('ratelimits', timeout=timeout_seconds)
+
+    with ratelimits.transact(retry=True):
+
+        now = time.time()
+        ratelimit = gcra_check(ratelimits.get(key, default=None),
+                               now,
+                               rate_per_minute,
+                               burst=burst,
+                               cost=cost)
+
+        if ratelimit['allowed']:
+            ratelimits.set(key,
+                           ratelimit['theoretical_arrival'],
+                           expire=ratelimit['reset_after'])
+
+    return ratelimit
+
+
+def cache_ratelimit_merge(key_costs,
+                          timeout_seconds=0.3,
+                          cache_dirname='/tmp/authnzerver-cache'):
+    '''This adds requests made elsewhere to the rate limits in the cache.
+
+    This is used to merge the requests counted by in-process rate limiters into
+    the rate limits shared by all processes using the same cache directory. All
+    of the keys are updated in a single transaction. The requests are always
+    added, even if this puts a key over its limit, since they have already been
+    allowed by the in-process limiter.
+
+    Parameters
+    ----------
+
+    key_costs : dict
+        A dict of the form {key: (cost, emission_interval)}, where cost is the
+        number of requests to add for the key, and emission_interval is the
+        number of seconds each request takes up at the key's allowed rate (60.0
+        divided by the per-minute rate).
+
+    timeout_seconds : float
+        The SQLite timeout to use for cache operations.
+
+    cache_dirname : str
+        The directory containing the cache.
+
+    Returns
+    -------
+
+    dict
+        A dict of the form {key: theoretical arrival time} containing the
+        merged theoretical arrival times for all keys in key_costs.
+
+    '''
+
+    cache = get_cache_handle(cache_dirname, timeout_seconds)
+    ratelimits = cache.cache('ratelimits', timeout=timeout_seconds)
+
+    merged = {}
+
+    with ratelimits.transact(retry=True):
+
+        now = time.time()
+
+        for key, (cost, emission_interval) in key_costs.items():
+
+            theoretical_arrival = ratelimits.get(key, default=None)
+            if theoretical_arrival is None or theoretical_arrival < now:
+                theoretical_arrival = now
+
+            theoretical_arrival = theoretical_arrival + cost*emission_interval
+            ratelimits.set(key,
+                           theoretical_arrival,
+                           expire=theoretical_arrival - now)
+            merged[key] = theoretical_arrival
+
+    return merged
+
+
+def cache_ratelimit_role(key,
+                         role,
+                         permissions_json,
+                         limit_name='max_requests_per_minute',
+                         cost=1,
+                         timeout_seconds=0.3,
+                         cache_dirname='/tmp/authnzerver-cache'):
+    '''This checks and updates the rate limit for a key using a role's limit.
+
+    The per-minute rate and burst for the role are read from the permissions
+    model using :py:func:`authnzerver.permissions.get_role_ratelimit`. If the
+    role has no such limit, the request is always allowed and remaining is None.
+
+    Returns the same dict as :py:func:`.gcra_check`.
+
+    '''
+
+    role_ratelimit = permissions.get_role_ratelimit(
+        permissions.get_permissions_model(permissions_json),
+        role,
+        limit_name=limit_name
+    )
+
+    if role_ratelimit is None:
+        return {
+            'allowed':True,
+            'remaining':None,
+            'retry_after':0.0,
+            'reset_after':0.0,
+            'theoretical_arrival':None,
+        }
+
+    rate_per_minute, burst = role_ratelimit
+
+    return cache_ratelimit(
+        key,
+        rate_per_minute,
+        burst=burst,
+        cost=cost,
+        timeout_seconds=timeout_seconds,
+        cache_dirname=cache_dirname
+    )
+
+
+class MemoryRateLimiter(object):
+    '''This is an in-memory GCRA rate limiter.
+
+    This keeps one theoretical arrival time per key in a :py:class:`.MemoryCache`.
+    Each key expires once its full burst has been replenished, since it would
+    then be the same as a key that was never seen. The number of keys is bounded
+    by maxsize; the least recently used keys are evicted first.
+
+    '''
+
+    def __init__(self,
+                 maxsize=100000,
+                 timer=time.monotonic):
+        '''
+        This sets up the rate limiter.
+
+        Parameters
+        ----------
+
+        maxsize : int
+            The maximum number of keys to track.
+
+        timer : callable
+            The function used to get the current time in seconds.
+
+        '''
+
+        self.timer = timer
+        self.theoretical_arrivals = MemoryCache(maxsize=maxsize,
+                                                ttl_seconds=60.0,
+                                                timer=timer)
+        self.allowed = 0
+        self.limited = 0
+
+    def check(self, key, rate_per_minute, burst=None, cost=1):
+        '''This checks and updates the rate limit for key.
+
+        Returns the same dict as :py:func:`.gcra_check`.
+
+        '''
+
+        ratelimit = gcra_check(self.theoretical_arrivals.get(key),
+                               self.timer(),
+                               rate_per_minute,
+                               burst=burst,
+                               cost=cost)
+
+        if ratelimit['allowed']:
+            self.theoretical_arrivals.set(
+                key,
+                ratelimit['theoretical_arrival'],
+                ttl_seconds=ratelimit['reset_after']
+            )
+            self.allowed += 1
+        else:
+            self.limited += 1
+
+        return ratelimit
+
+    def check_role(self,
+                   key,
+                   role,
+                   permissions_model,
+                   limit_name='max_requests_per_minute',
+                   cost=1):
+        '''This checks and updates the rate limit for key using a role's limit.
+
+        If the role has no such limit, the request is always allowed and
+        remaining is None.
+
+        Returns the same dict as :py:func:`.gcra_check`.
+
+        '''
+
+        role_ratelimit = permissions.get_role_ratelimit(permissions_model,
+                                                        role,
+                                                        limit_name=limit_name)
+
+        if role_ratelimit is None:
+            self.allowed += 1
+            return {
+                'allowed':True,
+                'remaining':None,
+                'retry_after':0.0,
+                'reset_after':0.0,
+                'theoretical_arrival':None,
+            }
+
+        rate_per_minute, burst = role_ratelimit
+        return self.check(key, rate_per_minute, burst=burst, cost=cost)
+
+    def info(self):
+        '''
+        This returns the allowed and limited counts and the number of keys.
+
+        '''
+
+        return {
+            'allowed':self.allowed,
+            'limited':self.limited,
+            'keys':len(self.theoretical_arrivals),
+            'maxsize':self.theoretical_arrivals.maxsize,
+        }
+
+
+#######################
+## REPLAY PROTECTION ##
+#######################
+
+class ReplayCache(object):
+    '''This remembers recent request IDs so replayed requests can be rejected.
+
+    A request is only accepted if its timestamp (the one embedded in its Fernet
+    token) is within window_seconds of now and its request ID hasn't been seen
+    in that window. The request IDs are kept in a time wheel: a ring of slots
+    that each hold the IDs for resolution_seconds worth of timestamps. Slots
+    are cleared as they fall out of the window, so inserts and expiry are both
+    O(1) and memory is bounded by the request rate times the window.
+
+    If there are more than maxsize IDs, the oldest slots are cleared early and
+    the window shrinks to match: requests older than the cleared slots are
+    rejected as stale, so a replay can never slip through.
+
+    If cache_dirname is provided, the IDs are kept in the diskcache there
+    instead, so several authnzerver processes on the same machine can share
+    them.
+
+    '''
+
+    def __init__(self,
+                 window_seconds=300.0,
+                 resolution_seconds=1.0,
+                 max_clock_skew=60.0,
+                 maxsize=1000000,
+                 timer=time.time,
+                 cache_dirname=None,
+                 timeout_seconds=0.3):
+        '''
+        This sets up the replay cache.
+
+        Parameters
+        ----------
+
+        window_seconds : float
+            How long after its timestamp a request is accepted.
+
+        resolution_seconds : float
+            The width of each slot in the time wheel.
+
+        max_clock_skew : float
+            How far in the future a request's timestamp can be. This allows for
+            the clocks of the frontend and the authnzerver being a bit off.
+
+        maxsize : int
+            The maximum number of request IDs to keep in memory.
+
+        timer : callable
+            The function used to get the current UNIX time in seconds.
+
+        cache_dirname : str or None
+            If this is provided, the request IDs are kept in the diskcache in
+            this directory so other processes can see them.
+
+        timeout_seconds : float
+            The SQLite timeout to use for the diskcache.
+
+        '''
+
+        self.window_seconds = window_seconds
+        self.resolution_seconds = resolution_seconds
+        self.max_clock_skew = max_clock_skew
+        self.maxsize = maxsize
+        self.timer = timer
+        self.cache_dirname = cache_dirname
+        self.timeout_seconds = timeout_seconds
+
+        # the wheel covers every slot a fresh request can fall in, from the
+        # oldest one still in the window to the newest allowed by the skew
+        self.nslots = int(
+            (window_seconds + max_clock_skew)//resolution_seconds
+        ) + 2
+        self._slots = [set() for _ in range(self.nslots)]
+        self._slot_numbers = [None]*self.nslots
+        self._seen = set()
+
+        # slots numbered below this have been cleared
+        self._floor = int((timer() - window_seconds)//resolution_seconds)
+
+        self.accepted = 0
+        self.replayed = 0
+        self.stale = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _clear_slot(self, slot_number):
+        '''
+        This drops the request IDs in a slot from the wheel.
+
+        '''
+
+        ind = slot_number % self.nslots
+
+        if self._slot_numbers[ind] == slot_number:
+            self._seen.difference_update(self._slots[ind])
+            self._slots[ind].clear()
+            self._slot_numbers[ind] = None
+
+    def _advance(self, now):
+        '''
+        This clears all slots that have fallen out of the window.
+
+        '''
+
+        floor = int((now - self.window_seconds)//self.resolution_seconds)
+
+        if floor - self._floor >= self.nslots:
+            for slot in self._slots:
+                slot.clear()
+            self._slot_numbers = [None]*self.nslots
+            self._seen.clear()
+
+        else:
+            for slot_number in range(self._floor, floor):
+                self._clear_slot(slot_number)
+
+        self._floor = max(self._floor, floor)
+
+    def check(self, reqid, timestamp):
+        '''This checks a request and remembers its ID if it's accepted.
+
+        Parameters
+        ----------
+
+        reqid : int or str
+            The request ID.
+
+        timestamp : float
+            The UNIX time the request was made at, usually from its Fernet
+            token.
+
+        Returns
+        -------
+
+        str
+            'fresh' if the request should be accepted, 'replayed' if its ID was
+            already seen in the window, or 'stale' if its timestamp is outside
+            the window.
+
+        '''
+
+        now = self.timer()
+
+        if self.cache_dirname is None:
+            self._advance(now)
+
+        if (timestamp <= now - self.window_seconds or
+            timestamp > now + self.max_clock_skew):
+            self.stale += 1
+            return 'stale'
+
+        if self.cache_dirname is not None:
+            return self._check_shared(reqid, timestamp, now)
+
+        slot_number = int(timestamp//self.resolution_seconds)
+
+        if slot_number < self._floor:
+            self.stale += 1
+            return 'stale'
+
+        if reqid in self._seen:
+            self.replayed += 1
+            return 'replayed'
+
+        # if we're full, clear the oldest slots until there's room. everything
+        # older than these is now stale.
+        while len(self._seen) >= self.maxsize and self._floor <= slot_number:
+            ind = self._floor % self.nslots
+            if self._slot_numbers[ind] == self._floor:
+                self.evicted += len(self._slots[ind])
+            self._clear_slot(self._floor)
+            self._floor += 1
+
+        if slot_number < self._floor:
+            self.stale += 1
+            return 'stale'
+
+        ind = slot_number % self.nslots
+        if self._slot_numbers[ind] != slot_number:
+            if self._slot_numbers[ind] is not None:
+                self._clear_slot(self._slot_numbers[ind])
+            self._slot_numbers[ind] = slot_number
+
+        self._slots[ind].add(reqid)
+        self._seen.add(reqid)
+        self.accepted += 1
+        return 'fresh'
+
+    def _check_shared(self, reqid, timestamp, now):
+        '''This checks a request against the request IDs in the diskcache.
+
+        diskcache's add() only sets a key if it isn't already there, so this
+        is atomic across processes.
+
+        '''
+
+        cache = get_cache_handle(cache_dirname=self.cache_dirname,
+                                 timeout_seconds=self.timeout_seconds)
+
+        added = cache.add(
+            'replay-reqid-%s' % reqid,
+            timestamp,
+            expire=timestamp + self.window_seconds - now,
+            retry=True
+        )
+
+        if added:
+            self.accepted += 1
+            return 'fresh'
+
+        self.replayed += 1
+        return 'replayed'
+
+    def info(self):
+        '''
+        This returns the accepted, replayed, stale, and evicted counts.
+
+        '''
+
+        return {
+            'accepted':self.accepted,
+            'replayed':self.replayed,
+            'stale':self.stale,
+            'evicted':self.evicted,
+            'size':len(self._seen),
+            'maxsize':self.maxsize,
+            'window_seconds':self.window_seconds,
+            'shared':self.cache_dirname is not None,
+        }
+
+
+###########################
+## FAILED LOGIN TRACKING ##
+###########################
+
+class FailedLoginTracker(object):
+    '''This keeps track of failed logins and how long to turn away new ones.
+
+    Each key (e.g. an email address or an IP address) has a failure score that
+    goes up by one for each failed login and decays exponentially with
+    half_life_seconds. After a failure, the key is locked for
+    base_wait**(score - 1) seconds, up to max_wait seconds. base_wait must be
+    more than 1.
+
+    The scores are kept in a :py:class:`.MemoryCache`, so memory use is bounded
+    by maxsize no matter how many keys are tried. Keys expire once their score
+    has decayed away, and the least recently used keys are evicted first.
+
+    '''
+
+    def __init__(self,
+                 maxsize=100000,
+                 half_life_seconds=600.0,
+                 base_wait=1.5,
+                 max_wait=40.0,
+                 timer=time.monotonic):
+        '''
+        This sets up the tracker.
+
+        Parameters
+        ----------
+
+        maxsize : int
+            The maximum number of keys to track.
+
+        half_life_seconds : float
+            The time it takes for a key's failure score to decay by half.
+
+        base_wait : float
+            The base of the exponential lockout time.
+
+        max_wait : float
+            The longest a key can be locked out for after a failure.
+
+        timer : callable
+            The function used to get the current time in seconds.
+
+        '''
+
+        self.half_life_seconds = half_life_seconds
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+        self.timer = timer
+
+        # scores past this give the longest lockout, so they're capped here.
+        # this also keeps a key from building up a score that takes days to
+        # decay away.
+        self.max_score = 1.0 + math.log(max_wait)/math.log(base_wait)
+
+        self.scores = MemoryCache(maxsize=maxsize,
+                                  ttl_seconds=half_life_seconds,
+                                  timer=timer)
+        self.failures = 0
+        self.throttled = 0
+
+    def _decayed_score(self, key, now):
+        '''
+        This returns the decayed score and lockout end time for key.
+
+        '''
+
+        item = self.scores.get(key)
+
+        if item is None:
+            return 0.0, now
+
+        score, updated, locked_until = item
+        score = score*0.5**((now - updated)/self.half_life_seconds)
+        return score, locked_until
+
+    def check(self, keys):
+        '''This returns how long the keys are locked out for.
+
+        Parameters
+        ----------
+
+        keys : list of str
+            The keys to check.
+
+        Returns
+        -------
+
+        float
+            The number of seconds until a login attempt for all of the keys is
+            allowed again. This is 0.0 if it's allowed now.
+
+        '''
+
+        now = self.timer()
+        retry_after = 0.0
+
+        for key in keys:
+            _, locked_until = self._decayed_score(key, now)
+            retry_after = max(retry_after, locked_until - now)
+
+        if retry_after > 0.0:
+            self.throttled += 1
+
+        return retry_after
+
+    def record_failure(self, keys):
+        '''This records a failed login for each key.
+
+        Returns the number of seconds the keys are now locked out for.
+
+        '''
+
+        now = self.timer()
+        retry_after = 0.0
+        self.failures += 1
+
+        for key in keys:
+
+            score, _ = self._decayed_score(key, now)
+            score = min(score + 1.0, self.max_score)
+
+            wait = min(self.base_wait**(score - 1.0), self.max_wait)
+            retry_after = max(retry_after, wait)
+
+            # forget the key once its score has decayed to below 0.5, at which
+            # point its lockout is less than a second
+            ttl = max(self.half_life_seconds*math.log2(score/0.5), wait)
+            self.scores.set(key, (score, now, now + wait), ttl_seconds=ttl)
+
+        return retry_after
+
+    def record_success(self, keys):
+        '''
+        This clears the failed logins for each key after a successful login.
+
+        '''
+
+        for key in keys:
+            self.scores.pop(key)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def info(self):
+        '''
+        This returns the failure and throttled counts and the number of keys.
+
+        '''
+
+        return {
+            'failures':self.failures,
+            'throttled':self.throttled,
+            'keys':len(self.scores),
+            'maxsize':self.scores.maxsize,
+            'evictions':self.scores.evictions,
+        }
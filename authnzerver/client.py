@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# client.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This contains an asyncio client for talking to the authnzerver.
+
+The client encrypts requests and decrypts responses in-process, reuses a single
+HTTP client for all requests, and can have many requests in flight at once::
+
+    client = AuthnzerverClient('http://127.0.0.1:13431', fernet_secret)
+
+    success, response, messages = await client.request(
+        'session-exists',
+        {'session_token': session_token}
+    )
+
+    results = await client.request_many([
+        ('session-exists', {'session_token': session_token}),
+        ('check-user-limit', limit_payload),
+    ])
+
+    # this runs both requests using a single authnzerver worker
+    results = await client.request_batch([
+        ('session-exists', {'session_token': session_token}),
+        ('check-user-limit', limit_payload),
+    ])
+
+    client.close()
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+
+# get a logger
+LOGGER = logging.getLogger(__name__)
+
+
+#############
+## IMPORTS ##
+#############
+
+import os
+import json
+import asyncio
+import random
+import secrets
+import threading
+import time
+from base64 import b64encode, b64decode
+from datetime import datetime
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
+
+
+#################
+## REQUEST IDS ##
+#################
+
+_REQUEST_ID_LOCK = threading.Lock()
+_REQUEST_ID_PID = None
+_REQUEST_ID_NEXT = None
+
+
+def new_request_id():
+    '''This returns a new request ID for an authnzerver request.
+
+    Request IDs are 64-bit integers that increase monotonically in each process.
+    Each process starts counting from a random 62-bit number, so request IDs
+    from different processes, including forked ones, won't collide in practice.
+
+    '''
+
+    global _REQUEST_ID_PID, _REQUEST_ID_NEXT
+
+    with _REQUEST_ID_LOCK:
+
+        if _REQUEST_ID_PID != os.getpid():
+            _REQUEST_ID_PID = os.getpid()
+            _REQUEST_ID_NEXT = secrets.randbits(62)
+
+        reqid = _REQUEST_ID_NEXT
+        _REQUEST_ID_NEXT += 1
+
+    return reqid
+
+
+#########################
+## REQ/RESP ENCRYPTION ##
+#########################
+
+class ClientEncoder(json.JSONEncoder):
+
+    def default(self, obj):
+
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        elif isinstance(obj, bytes):
+            return obj.decode()
+        else:
+            return json.JSONEncoder.default(self, obj)
+
+
+def encrypt_request(request_dict, ferneter):
+    '''
+    This encrypts an outgoing request using a Fernet instance.
+
+    '''
+
+    json_bytes = json.dumps(request_dict, cls=ClientEncoder).encode()
+    return b64encode(ferneter.encrypt(json_bytes))
+
+
+def decrypt_response(response_base64, ferneter):
+    '''
+    This decrypts an incoming response using a Fernet instance.
+
+    '''
+
+    try:
+
+        response_bytes = b64decode(response_base64)
+        return json.loads(ferneter.decrypt(response_bytes))
+
+    except InvalidToken:
+
+        LOGGER.error('invalid response could not be decrypted')
+        return None
+
+    except Exception:
+
+        LOGGER.exception('could not understand incoming response')
+        return None
+
+
+############
+## CLIENT ##
+############
+
+# these request types can be safely retried if the authnzerver doesn't respond
+IDEMPOTENT_REQUESTS = frozenset({
+    'session-exists',
+    'user-list',
+    'apikey-verify',
+    'check-user-access',
+    'check-user-access-batch',
+    'check-user-limit',
+})
+
+
+class AuthnzerverClient(object):
+    '''This is an asyncio client for the authnzerver.
+
+    '''
+
+    def __init__(self,
+                 authnzerver_url,
+                 fernet_secret,
+                 max_in_flight=100,
+                 connect_timeout=5.0,
+                 request_timeout=10.0,
+                 max_retries=2,
+                 retry_backoff=0.1,
+                 httpclient=None):
+        '''This sets up the client.
+
+        Parameters
+        ----------
+
+        authnzerver_url : str
+            The URL of the authnzerver.
+
+        fernet_secret : str
+            The shared secret used to encrypt requests and decrypt responses.
+
+        max_in_flight : int
+            The maximum number of requests that can be waiting for a response
+            at the same time.
+
+        connect_timeout : float
+            The connection timeout in seconds.
+
+        request_timeout : float
+            The timeout for each request in seconds.
+
+        max_retries : int
+            The number of times to retry a request if the authnzerver can't be
+            reached, times out, or is overloaded. Only request types in
+            ``IDEMPOTENT_REQUESTS`` are retried unless the retry argument to
+            :py:meth:`.request` is True.
+
+        retry_backoff : float
+            The base wait time in seconds before a retry. This is doubled for
+            each retry and a random jitter of up to the same amount is added.
+
+        httpclient : tornado.httpclient.AsyncHTTPClient or None
+            An existing HTTP client to use. If this is None, the client will
+            make its own, and close it in :py:meth:`.close`.
+
+        '''
+
+        self.authnzerver_url = authnzerver_url
+        self.ferneter = Fernet(fernet_secret)
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        if httpclient is None:
+            try:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                self.httpclient = CurlAsyncHTTPClient(
+                    force_instance=True,
+                    max_clients=max_in_flight
+                )
+            except ImportError:
+                self.httpclient = AsyncHTTPClient(force_instance=True,
+                                                  max_clients=max_in_flight)
+            self.owns_httpclient = True
+        else:
+            self.httpclient = httpclient
+            self.owns_httpclient = False
+
+        self._in_flight = None
+
+    async def _send(self, request_type, request_body):
+        '''This sends a single request.
+
+        Returns the HTTP status code, the response body, the response headers,
+        and the request ID. Connection failures and timeouts are returned as
+        status code 599 with no headers.
+
+        '''
+
+        # the authnzerver won't run the request if it can't get to it before
+        # this client stops waiting for the response
+        reqid = new_request_id()
+        encrypted_req = encrypt_request(
+            {'request':request_type,
+             'body':request_body,
+             'reqid':reqid,
+             'deadline':time.time() + self.request_timeout},
+            self.ferneter
+        )
+
+        # raise_error=False only covers non-200 responses. timeouts and
+        # connection failures are still raised
+        try:
+            resp = await self.httpclient.fetch(
+                HTTPRequest(self.authnzerver_url,
+                            method='POST',
+                            body=encrypted_req,
+                            connect_timeout=self.connect_timeout,
+                            request_timeout=self.request_timeout),
+                raise_error=False
+            )
+            return resp.code, resp.body, resp.headers, reqid
+
+        except HTTPClientError as e:
+            LOGGER.error('could not talk to the authnzerver: %s' % e)
+            return e.code, None, None, reqid
+
+        except OSError as e:
+            LOGGER.error('could not connect to the authnzerver: %s' % e)
+            return 599, None, None, reqid
+
+    @staticmethod
+    def _throttled_response(request_type, headers):
+        '''This returns the result for a request turned away with an HTTP 429.
+
+        '''
+
+        try:
+            retry_after = float(headers['Retry-After'])
+        except (TypeError, KeyError, ValueError):
+            retry_after = None
+
+        messages = ["The authnzerver is not accepting %s requests right now. "
+                    "Try again later." % request_type]
+
+        return False, {'success':False,
+                       'retry_after':retry_after,
+                       'messages':messages}, messages
+
+    async def request(self, request_type, request_body, retry=None):
+        '''This sends a request to the authnzerver and returns its response.
+
+        Parameters
+        ----------
+
+        request_type : str
+            The type of request to send.
+
+        request_body : dict
+            The request payload.
+
+        retry : bool or None
+            If True, the request will be retried if the authnzerver can't be
+            reached, times out, or is overloaded. If None, only request types
+            in ``IDEMPOTENT_REQUESTS`` are retried. Each retry uses a new
+            request ID.
+
+        Returns
+        -------
+
+        tuple
+            Returns a tuple of (success, response, messages). If the request
+            failed, returns (False, None, None). If the authnzerver turned the
+            request away with an HTTP 429 (e.g. a login too soon after failed
+            ones), the response is a dict with 'success' = False and the
+            number of seconds to wait before trying again in 'retry_after', so
+            frontends can pass it on.
+
+        '''
+
+        if retry is None:
+            retry = request_type in IDEMPOTENT_REQUESTS
+
+        max_attempts = self.max_retries + 1 if retry else 1
+
+        # the semaphore is made lazily so it's tied to the running event loop
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        for attempt in range(max_attempts):
+
+            if attempt > 0:
+                backoff = self.retry_backoff*2.0**(attempt - 1)
+                await asyncio.sleep(backoff + random.uniform(0.0, backoff))
+
+            async with self._in_flight:
+                code, body, headers, reqid = await self._send(request_type,
+                                                              request_body)
+
+            # 599 is a connection failure or timeout, 503 is an overloaded
+            # authnzerver. these are worth retrying
+            if code in (503, 599):
+                LOGGER.warning(
+                    'authnzerver request %s failed with HTTP %s on attempt %s'
+                    % (request_type, code, attempt + 1)
+                )
+                continue
+
+            if code == 429:
+                return self._throttled_response(request_type, headers)
+
+            if code != 200:
+                return False, None, None
+
+            respdict = decrypt_response(body, self.ferneter)
+
+            if respdict is None or respdict.get('reqid') != reqid:
+                LOGGER.error('authnzerver response for %s did not match '
+                             'the request ID: %s' % (request_type, reqid))
+                return False, None, None
+
+            return (respdict['success'],
+                    respdict['response'],
+                    respdict['response']['messages'])
+
+        return False, None, None
+
+    async def request_many(self, requests, retry=None):
+        '''This sends several requests concurrently.
+
+        Parameters
+        ----------
+
+        requests : list of tuples
+            A list of (request_type, request_body) tuples.
+
+        retry : bool or None
+            This is passed on to :py:meth:`.request` for each request.
+
+        Returns
+        -------
+
+        list of tuples
+            The (success, response, messages) tuple for each request in the
+            same order as the requests.
+
+        '''
+
+        return await asyncio.gather(*[
+            self.request(request_type, request_body, retry=retry)
+            for request_type, request_body in requests
+        ])
+
+    async def request_batch(self, requests, retry=None):
+        '''This sends several requests to the authnzerver in a single envelope.
+
+        The authnzerver runs all of the requests in the batch using a single
+        background worker, so this is faster than :py:meth:`.request_many`
+        when a handler needs several answers at once, e.g. a session check,
+        an access check, and a limit check for a page load.
+
+        Parameters
+        ----------
+
+        requests : list of tuples
+            A list of (request_type, request_body) tuples.
+
+        retry : bool or None
+            If None, the batch is only retried if all of the request types in
+            it are in ``IDEMPOTENT_REQUESTS``.
+
+        Returns
+        -------
+
+        list of tuples
+            The (success, response, messages) tuple for each request in the
+            same order as the requests. If the whole batch failed, each tuple
+            will be (False, None, None).
+
+        '''
+
+        if retry is None:
+            retry = all(x[0] in IDEMPOTENT_REQUESTS for x in requests)
+
+        success, response, messages = await self.request(
+            'batch',
+            {'requests':[{'request':request_type, 'body':request_body}
+                         for request_type, request_body in requests]},
+            retry=retry
+        )
+
+        if response is None or 'responses' not in response:
+            return [(False, None, None)]*len(requests)
+
+        return [(x['success'], x, x['messages'])
+                for x in response['responses']]
+
+    def close(self):
+        '''
+        This closes the HTTP client if this client made it.
+
+        '''
+
+        if self.owns_httpclient:
+            self.httpclient.close()
@@ -116,7 +116,155 @@ CONF = {
         'type':int,
         'default':4,
         'help':('The number of background workers '
-                'to use when processing requests.'),
+                'to use when processing requests. If hashworkers is '
+                'more than 0, these only handle requests that '
+                "don't hash passwords."),
+        'readable_from_file':False,
+    },
+    'hashworkers':{
+        'env':'%s_HASHWORKERS' % ENVPREFIX,
+        'cmdline':'hashworkers',
+        'type':int,
+        'default':1,
+        'help':('The number of background workers to use for requests '
+                'that hash passwords (login, password checks, new users, '
+                'password changes). These run separately from the other '
+                'workers so a burst of logins does not hold up session '
+                'lookups. If 0, all requests share the same workers.'),
+        'readable_from_file':False,
+    },
+    'hashthreads':{
+        'env':'%s_HASHTHREADS' % ENVPREFIX,
+        'cmdline':'hashthreads',
+        'type':int,
+        'default':4,
+        'help':('The number of password hashing requests each hashing '
+                'worker runs at once on its own threads (or each worker if '
+                'hashworkers is 0). argon2 releases the GIL while it hashes, '
+                'so these hash passwords in parallel.'),
+        'readable_from_file':False,
+    },
+    'hashmemory':{
+        'env':'%s_HASHMEMORY' % ENVPREFIX,
+        'cmdline':'hashmemory',
+        'type':int,
+        'default':1024,
+        'help':('The total memory in MiB that concurrent password hashes '
+                'can use. This is shared between the workers that hash '
+                'passwords, and limits how many hashes each of them runs '
+                'at once at the argon2 memory_cost.'),
+        'readable_from_file':False,
+    },
+    'dispatch':{
+        'env':'%s_DISPATCH' % ENVPREFIX,
+        'cmdline':'dispatch',
+        'type':str,
+        'default':'lookup:inline',
+        'help':('Sets which requests run directly on the server instead of '
+                'in the background workers. This is a comma-separated list '
+                'of name:mode items, where name is a request class (hashing, '
+                'lookup, default) or a request type, and mode is inline '
+                'or process. Identical concurrent lookups share one result '
+                'only when they run in the background workers.'),
+        'readable_from_file':False,
+    },
+    'maxqueued':{
+        'env':'%s_MAXQUEUED' % ENVPREFIX,
+        'cmdline':'maxqueued',
+        'type':str,
+        'default':'hashing:32,default:256',
+        'help':('Sets how many requests can wait for a background worker '
+                'before new requests are turned away with an HTTP 503. This '
+                'is a comma-separated list of pool:limit items, where pool '
+                'is hashing or default.'),
+        'readable_from_file':False,
+    },
+    'maxinflight':{
+        'env':'%s_MAXINFLIGHT' % ENVPREFIX,
+        'cmdline':'maxinflight',
+        'type':str,
+        'default':'',
+        'help':('Sets how many requests of each class can be in the '
+                'background worker pools at once, running or waiting, before '
+                'new requests of that class are turned away with an HTTP 503. '
+                'This is a comma-separated list of class:limit items, where '
+                'class is hashing, lookup, or default. Classes not listed '
+                'have no limit.'),
+        'readable_from_file':False,
+    },
+    'passhash':{
+        'env':'%s_PASSHASH' % ENVPREFIX,
+        'cmdline':'passhash',
+        'type':str,
+        'default':'',
+        'help':('Sets the argon2 parameters used to hash passwords. This is '
+                'a comma-separated list of name:value items, where name is '
+                'time_cost, memory_cost (in KiB), or parallelism. Parameters '
+                'not set here use the argon2 defaults. Run authnzrv '
+                '--calibrate to pick these for the current machine. Existing '
+                'password hashes are upgraded when their users next log in.'),
+        'readable_from_file':False,
+    },
+    'breachedpasswords':{
+        'env':'%s_BREACHEDPASSWORDS' % ENVPREFIX,
+        'cmdline':'breachedpasswords',
+        'type':str,
+        'default':'',
+        'help':('The path to a breached passwords file made by '
+                'authnzrv-breached from a breach corpus dump of SHA-1 '
+                'hashes. New passwords found in it are rejected. If this is '
+                'empty, new passwords are only checked against the list of '
+                'the 10,000 most common passwords.'),
+        'readable_from_file':False,
+    },
+    'passpolicy':{
+        'env':'%s_PASSPOLICY' % ENVPREFIX,
+        'cmdline':'passpolicy',
+        'type':str,
+        'default':'',
+        'help':('The rules new passwords are checked against, as a '
+                'comma-separated list of name:value items, e.g. '
+                'min_length:16,max_similarity:25. The settings are '
+                'min_length (default: 12), max_similarity to the user\'s '
+                'name, email address, and the server\'s FQDN (0 to 100, '
+                'default: 30), max_char_fraction taken up by any single '
+                'character (default: 0.2), and min_common_similarity to one '
+                'of the 10,000 most common passwords (0.0 to 1.0, '
+                'default: 0.7).'),
+        'readable_from_file':False,
+    },
+    'passtiming':{
+        'env':'%s_PASSTIMING' % ENVPREFIX,
+        'cmdline':'passtiming',
+        'type':str,
+        'default':'verify:2',
+        'help':('Sets how rejected password checks and logins are made to '
+                'take as long as real ones. verify:N runs N password hash '
+                'checks in total against a dummy password. duration:S waits '
+                'until S seconds have passed. duration does the same with S '
+                'measured by each background worker when it starts.'),
+        'readable_from_file':False,
+    },
+    'replaywindow':{
+        'env':'%s_REPLAYWINDOW' % ENVPREFIX,
+        'cmdline':'replaywindow',
+        'type':int,
+        'default':300,
+        'help':('The number of seconds after it was made that a request is '
+                'accepted. Request IDs are remembered for this long so '
+                'replayed requests can be rejected.'),
+        'readable_from_file':False,
+    },
+    'replaycache':{
+        'env':'%s_REPLAYCACHE' % ENVPREFIX,
+        'cmdline':'replaycache',
+        'type':str,
+        'default':'',
+        'help':('If set, request IDs are kept in a diskcache in this '
+                'directory instead of in memory, so several authnzerver '
+                'processes on the same machine can share replay protection. '
+                'This should not be the same as the cache directory, '
+                'since that is cleared on startup.'),
         'readable_from_file':False,
     },
     'emailserver':{
@@ -201,11 +201,23 @@ def _sendback_result(result_queue, work_id, result=None, exception=None):
         result_queue.put(_ResultItem(work_id, exception=exc))
 
 
+def _run_call_item(result_queue, call_item):
+    """Runs a _CallItem and puts its result or exception in result_queue"""
+    try:
+        r = call_item.fn(*call_item.args, **call_item.kwargs)
+    except BaseException as e:
+        exc = _ExceptionWithTraceback(e, e.__traceback__)
+        _sendback_result(result_queue, call_item.work_id, exception=exc)
+    else:
+        _sendback_result(result_queue, call_item.work_id, result=r)
+
+
 def _process_worker(call_queue,
                     result_queue,
                     initializer,
                     initargs,
-                    finalizer):
+                    finalizer,
+                    max_threads=1):
     """Evaluates calls from call_queue and places the results in result_queue.
 
     This worker is run in a separate process.
@@ -218,6 +230,8 @@ def _process_worker(call_queue,
         initializer: A callable initializer, or None
         initargs: A tuple of args for the initializer
         finalizer: A callable that runs when this worker is about to exit
+        max_threads: The number of calls this worker runs at once. If more
+            than 1, calls run on a pool of this many threads in the worker.
     """
     if initializer is not None:
         try:
@@ -227,13 +241,36 @@ def _process_worker(call_queue,
             # The parent will notice that the process stopped and
             # mark the pool broken
             return
+
+    if max_threads > 1:
+        from authnzerver.external.futures37.thread import ThreadPoolExecutor
+        threads = ThreadPoolExecutor(max_workers=max_threads)
+        # only take a call off the queue when a thread is free for it, so
+        # the other workers can pick up the rest
+        free_threads = threading.BoundedSemaphore(max_threads)
+
+        def run_threaded(call_item):
+            try:
+                _run_call_item(result_queue, call_item)
+            finally:
+                free_threads.release()
+    else:
+        threads = None
+
     while True:
+        if threads is not None:
+            free_threads.acquire()
+
         call_item = call_queue.get(block=True)
 
         # If there's a None as the queue item, this is a sentinel from the
         # management thread that we have no more work items. Prepare to exit.
         if call_item is None:
 
+            # let any running calls finish first
+            if threads is not None:
+                threads.shutdown(wait=True)
+
             # call the finalizer
             if finalizer is not None:
                 finalizer()
@@ -242,13 +279,11 @@ def _process_worker(call_queue,
             result_queue.put(os.getpid())
 
             return
-        try:
-            r = call_item.fn(*call_item.args, **call_item.kwargs)
-        except BaseException as e:
-            exc = _ExceptionWithTraceback(e, e.__traceback__)
-            _sendback_result(result_queue, call_item.work_id, exception=exc)
+
+        if threads is not None:
+            threads.submit(run_threaded, call_item)
         else:
-            _sendback_result(result_queue, call_item.work_id, result=r)
+            _run_call_item(result_queue, call_item)
 
         # Liberate the resource as soon as possible, to avoid holding onto
         # open files or shared memory that is not needed anymore
@@ -506,7 +541,8 @@ class ProcessPoolExecutor(_base.Executor):
                  mp_context=None,
                  initializer=None,
                  initargs=(),
-                 finalizer=None):
+                 finalizer=None,
+                 max_threads=1):
         """Initializes a new ProcessPoolExecutor instance.
 
         Args:
@@ -518,6 +554,8 @@ class ProcessPoolExecutor(_base.Executor):
             initializer: An callable used to initialize worker processes.
             finalizer: A callable used right before the worker signals it's done
             initargs: A tuple of arguments to pass to the initializer.
+            max_threads: The number of calls each worker process runs at
+                once on its own pool of threads.
         """
         _check_system_limits()
 
@@ -539,6 +577,10 @@ class ProcessPoolExecutor(_base.Executor):
         self._initargs = initargs
         self._finalizer = finalizer
 
+        if max_threads <= 0:
+            raise ValueError("max_threads must be greater than 0")
+        self._max_threads = max_threads
+
         # Management thread
         self._queue_management_thread = None
 
@@ -553,10 +595,11 @@ class ProcessPoolExecutor(_base.Executor):
         self._pending_work_items = {}
 
         # Create communication channels for the executor
-        # Make the call queue slightly larger than the number of processes to
-        # prevent the worker processes from idling. But don't make it too big
+        # Make the call queue slightly larger than the number of worker
+        # threads in all processes to prevent the worker processes from
+        # idling. But don't make it too big
         # because futures in the call queue cannot be cancelled.
-        queue_size = self._max_workers + EXTRA_QUEUED_CALLS
+        queue_size = self._max_workers*self._max_threads + EXTRA_QUEUED_CALLS
         self._call_queue = _SafeQueue(
             max_size=queue_size, ctx=self._mp_context,
             pending_work_items=self._pending_work_items)
@@ -610,7 +653,8 @@ class ProcessPoolExecutor(_base.Executor):
                       self._result_queue,
                       self._initializer,
                       self._initargs,
-                      self._finalizer)
+                      self._finalizer,
+                      self._max_threads)
             )
             p.start()
             self._processes[p.pid] = p
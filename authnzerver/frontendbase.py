@@ -18,9 +18,12 @@ ProcessPoolExecutor or ThreadPoolExecutor.
 import logging
 import numpy as np
 from datetime import datetime, timedelta
-import random
 from base64 import b64encode, b64decode
 import re
+import math
+import time
+from functools import partial
+import weakref
 from hmac import compare_digest
 
 from cryptography.fernet import Fernet, InvalidToken
@@ -77,8 +80,9 @@ LOGGER = logging.getLogger(__name__)
 #####################
 
 import tornado.web
+import tornado.ioloop
 from tornado.escape import utf8, native_str
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient
 from tornado import gen
 from tornado import httputil
 
@@ -89,8 +93,9 @@ from tornado import httputil
 
 from authnzerver.external.cookies import cookies
 from authnzerver.actions import authnzerver_send_email
-from authnzerver.authdb import check_role_limits
 from authnzerver import cache
+from authnzerver import permissions
+from authnzerver.client import AuthnzerverClient
 
 
 #######################
@@ -135,6 +140,294 @@ def encrypt_request(request_dict, fernetkey):
     return request_base64
 
 
+###############################
+## SHARED AUTHNZERVER CLIENT ##
+###############################
+
+# these are the default settings for the HTTP client used to talk to the
+# authnzerver. max_clients is the maximum number of concurrent requests; the
+# timeouts are in seconds and apply to each request. max_retries applies only
+# to idempotent requests (see authnzerver.client.IDEMPOTENT_REQUESTS).
+AUTHNZERVER_CLIENT_SETTINGS = {
+    'max_clients':100,
+    'connect_timeout':5.0,
+    'request_timeout':10.0,
+    'max_retries':2,
+}
+
+# this holds one HTTP client per IOLoop for this process
+_AUTHNZERVER_HTTPCLIENTS = weakref.WeakKeyDictionary()
+
+
+def get_authnzerver_httpclient(max_clients=100):
+    '''This returns the HTTP client shared by all handlers on this IOLoop.
+
+    If pycurl is available, this uses Tornado's curl HTTP client, which keeps
+    connections to the authnzerver alive between requests. Install authnzerver
+    with the ``curl`` extra to get it. Otherwise, this falls back to Tornado's
+    default HTTP client, which opens a new connection for each request but
+    still limits the number of concurrent requests, and logs a warning.
+
+    Parameters
+    ----------
+
+    max_clients : int
+        The maximum number of concurrent requests. This only takes effect the
+        first time the client is created for an IOLoop.
+
+    Returns
+    -------
+
+    tornado.httpclient.AsyncHTTPClient
+        The shared HTTP client. Don't close this in request handlers.
+
+    '''
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    httpclient = _AUTHNZERVER_HTTPCLIENTS.get(ioloop, None)
+
+    if httpclient is None:
+
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            httpclient = CurlAsyncHTTPClient(force_instance=True,
+                                             max_clients=max_clients)
+        except ImportError:
+            LOGGER.warning('pycurl is not installed, so connections to the '
+                           'authnzerver will not be kept alive. Install '
+                           'authnzerver[curl] to use pooled connections.')
+            httpclient = AsyncHTTPClient(force_instance=True,
+                                         max_clients=max_clients)
+
+        _AUTHNZERVER_HTTPCLIENTS[ioloop] = httpclient
+
+    return httpclient
+
+
+# this holds the authnzerver clients for each IOLoop for this process, keyed by
+# the authnzerver URL and the Fernet key
+_AUTHNZERVER_CLIENTS = weakref.WeakKeyDictionary()
+
+
+def get_authnzerver_client(authnzerver_url, fernetkey, client_settings=None):
+    '''This returns the authnzerver client shared by all handlers on this
+    IOLoop.
+
+    Sharing the client means its max_in_flight limit applies to all of this
+    process's requests to the authnzerver, not just to those of one handler.
+
+    Parameters
+    ----------
+
+    authnzerver_url : str
+        The address of the authnzerver.
+
+    fernetkey : str
+        The key used to encrypt communication with the authnzerver.
+
+    client_settings : dict or None
+        The client settings, in the same form as
+        ``AUTHNZERVER_CLIENT_SETTINGS``. Settings not provided are taken from
+        there. These only take effect the first time the client is created for
+        an IOLoop.
+
+    Returns
+    -------
+
+    authnzerver.client.AuthnzerverClient
+        The shared client. Don't close this in request handlers.
+
+    '''
+
+    settings = AUTHNZERVER_CLIENT_SETTINGS.copy()
+    if client_settings:
+        settings.update(client_settings)
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    ioloop_clients = _AUTHNZERVER_CLIENTS.setdefault(ioloop, {})
+    authnzerver_client = ioloop_clients.get((authnzerver_url, fernetkey))
+
+    if authnzerver_client is None:
+
+        authnzerver_client = AuthnzerverClient(
+            authnzerver_url,
+            fernetkey,
+            max_in_flight=settings['max_clients'],
+            connect_timeout=settings['connect_timeout'],
+            request_timeout=settings['request_timeout'],
+            max_retries=settings['max_retries'],
+            httpclient=get_authnzerver_httpclient(
+                max_clients=settings['max_clients']
+            )
+        )
+        ioloop_clients[(authnzerver_url, fernetkey)] = authnzerver_client
+
+    return authnzerver_client
+
+
+##############################
+## IN-PROCESS RATE LIMITING ##
+##############################
+
+class FrontendRateLimiter(cache.MemoryRateLimiter):
+    '''This is an in-process rate limiter for frontends.
+
+    Rate limits are checked right on the frontend's IOLoop using the
+    max_requests_per_minute limits for each role in the permissions model. The
+    requests allowed since the last sync are merged into the rate limits kept in
+    the shared diskcache every sync_seconds, and the merged limits are used from
+    then on. This means all frontend processes sharing the cache directory see
+    each other's requests after at most sync_seconds.
+
+    Memory use is bounded by maxsize. Keys are dropped lazily once their burst
+    allowance is fully replenished.
+
+    Pass an instance of this to :py:class:`.BaseHandler` as its ratelimiter
+    argument, and call :py:meth:`.start_sync` once the IOLoop is set up.
+
+    '''
+
+    def __init__(self,
+                 permissions_json,
+                 cache_dirname='/tmp/authnzerver-cache',
+                 sync_seconds=5.0,
+                 maxsize=100000):
+        '''
+        This sets up the rate limiter.
+
+        Parameters
+        ----------
+
+        permissions_json : str
+            The permissions model JSON file containing the role limits.
+
+        cache_dirname : str
+            The directory containing the shared cache.
+
+        sync_seconds : float
+            How often to sync with the shared cache.
+
+        maxsize : int
+            The maximum number of keys to track.
+
+        '''
+
+        # use the wall clock so our times match those of other processes
+        super().__init__(maxsize=maxsize, timer=time.time)
+
+        self.permissions_json = permissions_json
+        self.cache_dirname = cache_dirname
+        self.sync_seconds = sync_seconds
+
+        self.pending = {}
+        self.sync_callback = None
+        self.sync_running = False
+
+    def check_request(self, key, role, cost=1):
+        '''This checks and updates the rate limit for key using role's limit.
+
+        Returns the same dict as :py:func:`authnzerver.cache.gcra_check`.
+
+        '''
+
+        permissions_model = permissions.get_permissions_model(
+            self.permissions_json
+        )
+        ratelimit = self.check_role(key,
+                                    role,
+                                    permissions_model,
+                                    cost=cost)
+
+        # remember the allowed requests so we can add them to the shared limits
+        if ratelimit['allowed'] and ratelimit['remaining'] is not None:
+
+            rate_per_minute, burst = permissions.get_role_ratelimit(
+                permissions_model, role
+            )
+            pending_cost, emission_interval = self.pending.get(
+                key, (0, 60.0/rate_per_minute)
+            )
+            self.pending[key] = (pending_cost + cost, emission_interval)
+
+        return ratelimit
+
+    def merge(self, merged):
+        '''
+        This updates our limits with the merged limits from the shared cache.
+
+        '''
+
+        now = self.timer()
+
+        for key, theoretical_arrival in merged.items():
+
+            local_arrival = self.theoretical_arrivals.get(key)
+
+            if ((local_arrival is None or theoretical_arrival > local_arrival)
+                and theoretical_arrival > now):
+                self.theoretical_arrivals.set(
+                    key,
+                    theoretical_arrival,
+                    ttl_seconds=theoretical_arrival - now
+                )
+
+    async def sync(self):
+        '''This adds our pending requests to the shared cache's rate limits.
+
+        The cache update runs on the IOLoop's default executor so it doesn't
+        block request handling.
+
+        '''
+
+        if self.sync_running or not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        self.sync_running = True
+
+        try:
+
+            loop = tornado.ioloop.IOLoop.current()
+            merged = await loop.run_in_executor(
+                None,
+                partial(cache.cache_ratelimit_merge,
+                        pending,
+                        cache_dirname=self.cache_dirname)
+            )
+            self.merge(merged)
+
+        except Exception:
+
+            LOGGER.exception('could not sync rate limits with the cache')
+
+        finally:
+            self.sync_running = False
+
+    def start_sync(self):
+        '''
+        This starts syncing with the shared cache every sync_seconds.
+
+        '''
+
+        if self.sync_callback is None:
+            self.sync_callback = tornado.ioloop.PeriodicCallback(
+                self.sync,
+                self.sync_seconds*1000.0,
+                jitter=0.1
+            )
+            self.sync_callback.start()
+
+    def stop_sync(self):
+        '''
+        This stops syncing with the shared cache.
+
+        '''
+
+        if self.sync_callback is not None:
+            self.sync_callback.stop()
+            self.sync_callback = None
+
+
 ########################
 ## BASE HANDLER CLASS ##
 ########################
@@ -150,6 +443,8 @@ class BaseHandler(tornado.web.RequestHandler):
             api_settings,
             email_settings,
             cachedir,
+            ratelimiter=None,
+            authnzerver_client_settings=None,
     ):
         '''
         This just sets up some stuff.
@@ -179,7 +474,10 @@ class BaseHandler(tornado.web.RequestHandler):
         api_settings : dict
             This is a dict containing various API settings::
 
-                {'maxrate_60sec': number of requests allowed per 60 seconds,
+                {'maxrate_60sec': if True, apply the rate limits enforced by
+                                  the authnzerver. The rates are set by the
+                                  max_requests_per_minute limit for each role
+                                  in the permissions model,
                  'version': the API version to match against for requests,
                  'expiry_days': the number of days an API key is valid for,
                  'issuer': the API key issuer to match against}
@@ -195,15 +493,46 @@ class BaseHandler(tornado.web.RequestHandler):
         cachedir : str
             The directory to be used for the cache and rate-limit data.
 
+        ratelimiter : FrontendRateLimiter or None
+            If this is provided, rate limits will be checked in this process
+            using this instead of asking the authnzerver for every request.
+
+        authnzerver_client_settings : dict or None
+            This is a dict containing settings for the HTTP client used to talk
+            to the authnzerver. Any settings not provided are taken from
+            ``AUTHNZERVER_CLIENT_SETTINGS``::
+
+                {'max_clients': the maximum number of concurrent requests,
+                 'connect_timeout': the connection timeout in seconds,
+                 'request_timeout': the timeout for each request in seconds,
+                 'max_retries': the number of retries for idempotent requests}
+
+            All handlers on an IOLoop share one client (see
+            :py:func:`.get_authnzerver_client`), so these only take effect for
+            the first handler that talks to a given authnzerver.
+
         '''
 
         self.authnzerver = authnzerver
         self.fernetkey = fernetkey
         self.ferneter = Fernet(fernetkey)
         self.executor = executor
-        self.httpclient = AsyncHTTPClient(force_instance=True)
+        self.authnzerver_client_settings = AUTHNZERVER_CLIENT_SETTINGS.copy()
+        if authnzerver_client_settings:
+            self.authnzerver_client_settings.update(
+                authnzerver_client_settings
+            )
+        self.httpclient = get_authnzerver_httpclient(
+            max_clients=self.authnzerver_client_settings['max_clients']
+        )
+        self.authnzerver_client = get_authnzerver_client(
+            self.authnzerver,
+            self.fernetkey,
+            client_settings=self.authnzerver_client_settings
+        )
 
         self.cachedir = cachedir
+        self.ratelimiter = ratelimiter
         self.email_settings = email_settings
 
         self.session_expiry = session_settings['expiry_days']
@@ -284,48 +613,114 @@ class BaseHandler(tornado.web.RequestHandler):
 
     @gen.coroutine
     def authnzerver_request(self, request_type, request_body):
+        '''This talks to the authnzerver.
+
+        Returns a tuple of (success, response, messages). If the authnzerver
+        couldn't be reached, returns (False, None, None). If it turned the
+        request away with an HTTP 429, response['retry_after'] is the number of
+        seconds to wait before trying again, which can be sent on to the client
+        in a Retry-After header.
+
+        The client's IP address is added to user-login requests that don't
+        already have one, so the authnzerver tracks failed logins for each
+        email address and IP address pair.
+
         '''
-        This talks to the authnzerver.
+
+        if (request_type == 'user-login' and
+            'ip_address' not in request_body and
+            self.request.remote_ip):
+            request_body = dict(request_body,
+                                ip_address=self.request.remote_ip)
+
+        ok, resp, msgs = yield self.authnzerver_client.request(
+            request_type,
+            request_body
+        )
+        return ok, resp, msgs
+
+    @gen.coroutine
+    def authnzerver_batch_request(self, requests):
+        '''This sends several requests to the authnzerver at once.
+
+        The requests are run by a single authnzerver worker. requests is a list
+        of (request_type, request_body) tuples. Returns a list of (success,
+        response, messages) tuples in the same order.
 
         '''
 
-        reqid = random.randint(0,10000)
+        results = yield self.authnzerver_client.request_batch(requests)
+        return results
 
-        req = {'request':request_type,
-               'body':request_body,
-               'reqid':reqid}
+    @gen.coroutine
+    def check_ratelimit(self, key_type, key):
+        '''This checks if the current request is rate limited.
 
-        encrypted_req = yield self.executor.submit(
-            encrypt_request,
-            req,
-            self.fernetkey
-        )
-        auth_req = HTTPRequest(
-            self.authnzerver,
-            method='POST',
-            body=encrypted_req
-        )
-        encrypted_resp = yield self.httpclient.fetch(
-            auth_req, raise_error=False
-        )
+        If this handler has a ratelimiter, the check is done right here.
+        Otherwise, this asks the authnzerver, which keeps track of request rates
+        for all the frontends talking to it. In both cases, the
+        max_requests_per_minute limit for the current user's role is applied.
+
+        If the request is over the limit, this responds with a 429 and a
+        Retry-After header, then finishes the request.
+
+        Parameters
+        ----------
+
+        key_type : {'session', 'apikey', 'ip', 'user'}
+            The type of key to apply the rate limit to.
 
-        if encrypted_resp.code != 200:
+        key : str or int
+            The session token, API key token, IP address, or user ID to apply
+            the rate limit to.
 
-            return False, None, None
+        '''
+
+        if self.ratelimiter is not None:
+
+            resp = self.ratelimiter.check_request(
+                '%s:%s' % (key_type, native_str(key)),
+                self.user_role
+            )
+            ok = resp['allowed']
 
         else:
 
-            respdict = yield self.executor.submit(
-                decrypt_response,
-                encrypted_resp.body,
-                self.fernetkey
+            ok, resp, msgs = yield self.authnzerver_request(
+                'ratelimit-check',
+                {'key_type':key_type,
+                 'key':key,
+                 'user_role':self.user_role}
             )
 
-            success = respdict['success']
-            response = respdict['response']
-            messages = respdict['response']['messages']
+        # if we can't get an answer from the authnzerver, let this one through
+        if resp is None or ok:
+            return
 
-            return success, response, messages
+        # failed checks that weren't over the limit, e.g. invalid requests,
+        # come back without a retry_after, so we don't send a Retry-After
+        retry_after = resp.get('retry_after')
+        if retry_after is not None:
+            retry_after = int(math.ceil(retry_after))
+
+        LOGGER.error(
+            '%s: %s: request rate exceeds the allowed rate '
+            'for their role = %s. retry after = %s seconds'
+            % (key_type, key, self.user_role, retry_after)
+        )
+        self.set_status(429)
+        if retry_after is not None:
+            self.set_header('Retry-After', str(retry_after))
+        self.write({
+            'status':'failed',
+            'result':{
+                'retry_after':retry_after,
+            },
+            'message':(
+                'You have exceeded your API request rate.'
+            )
+        })
+        raise tornado.web.Finish()
 
     @gen.coroutine
     def new_session_token(self, user_id, expires_days=None, extra_info=None):
@@ -818,55 +1213,7 @@ class BaseHandler(tornado.web.RequestHandler):
                     self.user_role = self.current_user['user_role']
 
                     if self.ratelimit:
-
-                        # increment the rate counter for this session token
-                        reqcount = yield self.executor.submit(
-                            cache.cache_increment,
-                            session_token,
-                            cache_dirname=self.cachedir
-
-                        )
-
-                        # rate limit only after 25 requests have been counted
-                        if reqcount > 25:
-
-                            # check the rate for this session token
-                            request_rate, keycount, time_zero = (
-                                yield self.executor.submit(
-                                    cache.cache_getrate,
-                                    session_token,
-                                    cache_dirname=self.cachedir
-                                )
-                            )
-                            rate_ok = check_role_limits(self.user_role,
-                                                        rate_60sec=request_rate)
-                            self.request_rate_60sec = request_rate
-
-                        else:
-                            rate_ok = True
-                            self.request_rate_60sec = reqcount
-
-                        if not rate_ok:
-
-                            LOGGER.error(
-                                'session token: %s: current rate = %s exceeds '
-                                'their allowed rate for their role = %s'
-                                % (session_token,
-                                   request_rate,
-                                   self.user_role)
-                            )
-                            self.set_status(429)
-                            self.set_header('Retry-After','120')
-                            self.write({
-                                'status':'failed',
-                                'result':{
-                                    'rate':self.request_rate_60sec,
-                                },
-                                'message':(
-                                    'You have exceeded your API request rate.'
-                                )
-                            })
-                            raise tornado.web.Finish()
+                        yield self.check_ratelimit('session', session_token)
 
                 else:
 
@@ -913,15 +1260,7 @@ class BaseHandler(tornado.web.RequestHandler):
                     self.user_role = self.current_user['user_role']
 
                     if self.ratelimit:
-
-                        # increment the rate counter for this session token. we
-                        # just increase the count to 1 since this is the first
-                        # time we've seen this user.
-                        yield self.executor.submit(
-                            cache.cache_increment,
-                            session_token,
-                            cache_dirname=self.cachedir
-                        )
+                        yield self.check_ratelimit('session', session_token)
 
                 else:
 
@@ -1008,63 +1347,5 @@ class BaseHandler(tornado.web.RequestHandler):
                 self.user_role = self.current_user['user_role']
 
                 if self.ratelimit:
-
-                    # increment the rate counter for this session token
-                    reqcount = yield self.executor.submit(
-                        cache.cache_increment,
-                        self.apikey_dict['tkn'],
-                        cache_dirname=self.cachedir
-
-                    )
-
-                    # rate limit only after 25 requests have been counted
-                    if reqcount > 25:
-
-                        # check the rate for this session token
-                        request_rate, keycount, time_zero = (
-                            yield self.executor.submit(
-                                cache.cache_getrate,
-                                self.apikey_dict['tkn'],
-                                cache_dirname=self.cachedir
-                            )
-                        )
-                        rate_ok = check_role_limits(self.user_role,
-                                                    rate_60sec=request_rate)
-
-                        self.request_rate_60sec = request_rate
-
-                    else:
-                        rate_ok = True
-                        self.request_rate_60sec = reqcount
-
-                    if not rate_ok:
-
-                        LOGGER.error(
-                            'API key: %s: current rate = %s exceeds '
-                            'their allowed rate for their role = %s. '
-                            'total reqs = %s, time_zero = %s'
-                            % (self.apikey_dict['tkn'],
-                               request_rate,
-                               self.user_role,
-                               keycount, time_zero)
-                        )
-                        self.set_status(429)
-                        self.set_header('Retry-After','120')
-                        self.write({
-                            'status':'failed',
-                            'result':{
-                                'rate':self.request_rate_60sec,
-                            },
-                            'message':(
-                                'You have exceeded your API request rate.'
-                            )
-                        })
-                        raise tornado.web.Finish()
-
-    def on_finish(self):
-        '''
-        This just cleans up the httpclient.
-
-        '''
-
-        self.httpclient.close()
+                    yield self.check_ratelimit('apikey',
+                                               self.apikey_dict['tkn'])
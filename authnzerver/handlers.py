@@ -24,6 +24,9 @@ LOGGER = logging.getLogger(__name__)
 import json
 from datetime import datetime
 import asyncio
+import math
+import time
+from collections import deque
 
 
 class FrontendEncoder(json.JSONEncoder):
@@ -47,6 +50,7 @@ json._default_encoder = FrontendEncoder()
 
 import ipaddress
 import base64
+import struct
 
 import multiprocessing as mp
 
@@ -60,6 +64,8 @@ from sqlalchemy.sql import select
 
 from . import authdb
 from . import actions
+from . import permissions
+from .passhash import run_action
 
 
 #########################
@@ -78,9 +84,12 @@ def check_host(remote_ip):
         return False
 
 
-def decrypt_request(requestbody_base64, fernet_key):
-    '''
-    This decrypts the incoming request.
+def decrypt_request(requestbody_base64, fernet_key, return_timestamp=False):
+    '''This decrypts the incoming request.
+
+    If return_timestamp is True, this returns a (request, timestamp) tuple,
+    where timestamp is the UNIX time the request's Fernet token was made at.
+    The request is None if it couldn't be decrypted.
 
     '''
 
@@ -90,17 +99,26 @@ def decrypt_request(requestbody_base64, fernet_key):
 
         request_bytes = base64.b64decode(requestbody_base64)
         decrypted = frn.decrypt(request_bytes)
-        return json.loads(decrypted)
+        request = json.loads(decrypted)
+
+        if not return_timestamp:
+            return request
+
+        # a Fernet token is a version byte followed by its 64-bit big-endian
+        # timestamp. decrypt() has already checked that it's authentic.
+        token_bytes = base64.urlsafe_b64decode(request_bytes)
+        timestamp = struct.unpack('>Q', token_bytes[1:9])[0]
+        return request, timestamp
 
     except InvalidToken:
 
         LOGGER.error('invalid request could not be decrypted')
-        return None
 
     except Exception:
 
         LOGGER.exception('could not understand incoming request')
-        return None
+
+    return (None, None) if return_timestamp else None
 
 
 def encrypt_response(response_dict, fernet_key):
@@ -150,6 +168,188 @@ def auth_echo(payload):
     return payload
 
 
+def ratelimit_check(payload, ratelimiter, permissions_json):
+    '''This checks the request rate limit for a client.
+
+    This runs directly on the server's IOLoop using an in-memory rate limiter,
+    so all frontends talking to this authnzerver share the same view of each
+    client's request rate.
+
+    Parameters
+    ----------
+
+    payload : dict
+        This should contain the following items:
+
+        - key_type : str, one of 'session', 'apikey', 'ip', or 'user'
+        - key : str or int, the session token, API key token, IP address, or
+          user ID to apply the rate limit to
+        - user_role : str, the role whose max_requests_per_minute limit will be
+          used. Defaults to 'anonymous' if not provided.
+
+        The payload may also contain:
+
+        - cost : int, the number of requests this counts as (default 1)
+
+    ratelimiter : authnzerver.cache.MemoryRateLimiter
+        The rate limiter to use.
+
+    permissions_json : str
+        The permissions model JSON file containing the role limits.
+
+    Returns
+    -------
+
+    dict
+        Returns a dict of the form::
+
+            {'success': True if the request is allowed,
+             'allowed': True if the request is allowed,
+             'remaining': the number of requests that can be made right now,
+             'retry_after': seconds to wait until a request is allowed,
+             'reset_after': seconds until the full burst is available again,
+             'messages': list of str messages}
+
+    '''
+
+    try:
+
+        key_type = payload['key_type']
+        key = payload['key']
+        user_role = payload.get('user_role', 'anonymous')
+        cost = int(payload.get('cost', 1))
+
+        if key_type not in ('session', 'apikey', 'ip', 'user'):
+            raise ValueError("unknown rate limit key_type: %s" % key_type)
+
+    except Exception:
+
+        LOGGER.error('invalid rate limit check request')
+        return {
+            'success':False,
+            'allowed':False,
+            'remaining':None,
+            'retry_after':None,
+            'reset_after':None,
+            'messages':["Invalid rate limit check request: "
+                        "missing or invalid parameters."],
+        }
+
+    ratelimit = ratelimiter.check_role(
+        '%s:%s' % (key_type, key),
+        user_role,
+        permissions.get_permissions_model(permissions_json),
+        cost=cost
+    )
+
+    return {
+        'success':ratelimit['allowed'],
+        'allowed':ratelimit['allowed'],
+        'remaining':ratelimit['remaining'],
+        'retry_after':ratelimit['retry_after'],
+        'reset_after':ratelimit['reset_after'],
+        'messages':['Rate limit check successful. '
+                    'Request allowed: %s.' % ratelimit['allowed']],
+    }
+
+
+# the maximum number of sub-requests allowed in a single batch request
+BATCH_MAX_REQUESTS = 50
+
+# these requests can't be part of a batch request. user-login is excluded so
+# the failed login backoff always applies to each login attempt.
+BATCH_EXCLUDED_REQUESTS = frozenset({'batch', 'echo', 'user-login'})
+
+
+def run_before_deadline(func, payload, deadline):
+    '''This runs func(payload) only if the deadline hasn't passed yet.
+
+    This is what the executor workers actually run, so requests that waited
+    in the queue for longer than the frontend was willing to wait for them
+    aren't run at all.
+
+    Parameters
+    ----------
+
+    func : Python function
+        The request function to run.
+
+    payload : dict
+        The request payload to pass to the function.
+
+    deadline : float or None
+        The UNIX time after which the request's result won't be used. If this
+        is None, func always runs.
+
+    Returns
+    -------
+
+    dict or None
+        The response from func, or None if the deadline passed before func
+        could start.
+
+    '''
+
+    if deadline is not None and time.time() >= deadline:
+        return None
+
+    return func(payload)
+
+
+def auth_batch(requests, deadline=None):
+    '''This runs several requests one after the other in a single worker.
+
+    All of the requests use the same worker process and its database
+    connection, so a batch costs a single trip through the executor.
+
+    Parameters
+    ----------
+
+    requests : list of tuples
+        A list of (request_type, request_body) tuples. Each request_type must be
+        a key in ``request_functions``.
+
+    deadline : float or None
+        The UNIX time after which results won't be used. Requests in the batch
+        that haven't started by then aren't run.
+
+    Returns
+    -------
+
+    list of dicts
+        The response dict for each request in the same order as the requests.
+        If a request fails with an exception, its response will have
+        'success' = False and an error message, and the rest of the requests
+        in the batch will still run.
+
+    '''
+
+    responses = []
+
+    for request_type, request_body in requests:
+
+        if deadline is not None and time.time() >= deadline:
+            responses.append({
+                'success':False,
+                'messages':["Request %s in the batch was not run because "
+                            "its deadline passed." % request_type]
+            })
+            continue
+
+        try:
+            response = request_functions[request_type](request_body)
+        except Exception:
+            LOGGER.exception('batch sub-request %s failed' % request_type)
+            response = {
+                'success':False,
+                'messages':["Request %s in the batch failed." % request_type]
+            }
+
+        responses.append(response)
+
+    return responses
+
+
 #
 # this maps request types -> request functions to execute
 #
@@ -180,10 +380,738 @@ request_functions = {
     'apikey-verify':actions.verify_apikey,
     # access and limit check actions
     'check-user-access': actions.check_user_access,
+    'check-user-access-batch': actions.check_user_access_batch,
     'check-user-limit': actions.check_user_limit,
 }
 
 
+##############################
+## REQUEST DISPATCH CLASSES ##
+##############################
+
+# requests are sorted into classes by how much work they do. hashing requests
+# run argon2 and must go to the background workers. lookup requests are fast
+# reads of a single item that can be answered on the server's IOLoop.
+# everything else is in the default class, including user-list (which can
+# return every user) and check-user-access-batch (which can check hundreds of
+# items), since these would hold up every other request if they ran inline.
+REQUEST_CLASSES = {
+    'user-login':'hashing',
+    'user-passcheck':'hashing',
+    'user-new':'hashing',
+    'user-changepass':'hashing',
+    'user-delete':'hashing',
+    'user-resetpass':'hashing',
+    'session-exists':'lookup',
+    'apikey-verify':'lookup',
+    'check-user-access':'lookup',
+    'check-user-limit':'lookup',
+    'ratelimit-check':'lookup',
+}
+
+# how each request class is run if not configured otherwise. inline lookups
+# use the server process's session and user status caches, which are cleared
+# through the shared cache directory when a worker changes a session or user
+DEFAULT_DISPATCH = 'lookup:inline'
+
+DISPATCH_MODES = ('inline', 'process')
+
+
+def parse_dispatch(dispatch_spec):
+    '''This parses a request dispatch spec.
+
+    Parameters
+    ----------
+
+    dispatch_spec : str or None
+        A comma-separated list of ``name:mode`` items. Each name is either a
+        request class ('hashing', 'lookup', 'default') or a request type, and
+        each mode is either 'inline' to run the request on the server's IOLoop
+        or 'process' to run it in a background worker. Request types override
+        their class's mode. Requests not covered by the spec run in the
+        background workers. For example::
+
+            lookup:inline,user-list:process
+
+    Returns
+    -------
+
+    dict
+        A dict mapping request classes and request types to modes.
+
+    '''
+
+    dispatch = {}
+
+    if not dispatch_spec:
+        return dispatch
+
+    for item in dispatch_spec.split(','):
+
+        item = item.strip()
+        if not item:
+            continue
+
+        name, mode = (x.strip() for x in item.split(':', 1))
+
+        if mode not in DISPATCH_MODES:
+            raise ValueError("Unknown dispatch mode '%s' for '%s'. "
+                             "Use one of: %s" %
+                             (mode, name, ', '.join(DISPATCH_MODES)))
+
+        if (name not in ('hashing', 'lookup', 'default') and
+            name not in request_functions):
+            raise ValueError("Unknown request class or request type '%s' "
+                             "in dispatch spec." % name)
+
+        if mode == 'inline' and (name == 'hashing' or
+                                 REQUEST_CLASSES.get(name) == 'hashing'):
+            LOGGER.warning("Running hashing requests like '%s' inline will "
+                           "block the server while passwords are hashed." %
+                           name)
+
+        dispatch[name] = mode
+
+    return dispatch
+
+
+def get_dispatch_mode(request_type, dispatch):
+    '''
+    This returns the dispatch mode for a request type.
+
+    '''
+
+    if request_type in dispatch:
+        return dispatch[request_type]
+
+    return dispatch.get(REQUEST_CLASSES.get(request_type, 'default'),
+                        'process')
+
+
+def parse_queue_limits(queue_limits_spec):
+    '''This parses a spec for the executor pool queue limits.
+
+    Parameters
+    ----------
+
+    queue_limits_spec : str or None
+        A comma-separated list of ``pool:max_queued`` items, where pool is
+        'hashing' or 'default' and max_queued is the number of requests that
+        can wait for a worker in that pool. Requests over the limit are turned
+        away with an HTTP 503. Pools not in the spec have no limit. For
+        example::
+
+            hashing:32,default:256
+
+    Returns
+    -------
+
+    dict
+        A dict mapping pool names to their queue limits.
+
+    '''
+
+    queue_limits = {}
+
+    if not queue_limits_spec:
+        return queue_limits
+
+    for item in queue_limits_spec.split(','):
+
+        item = item.strip()
+        if not item:
+            continue
+
+        pool, limit = (x.strip() for x in item.split(':', 1))
+
+        if pool not in ('hashing', 'default'):
+            raise ValueError("Unknown executor pool '%s' in queue limits. "
+                             "Use one of: hashing, default" % pool)
+
+        limit = int(limit)
+        if limit < 0:
+            raise ValueError("The queue limit for the '%s' pool "
+                             "can't be negative." % pool)
+
+        queue_limits[pool] = limit
+
+    return queue_limits
+
+
+def parse_inflight_limits(inflight_limits_spec):
+    '''This parses a spec for the in-flight limits of each request class.
+
+    Parameters
+    ----------
+
+    inflight_limits_spec : str or None
+        A comma-separated list of ``request_class:max_in_flight`` items, where
+        request_class is 'hashing', 'lookup', or 'default' and max_in_flight
+        is the number of requests of that class that can be in the executor
+        pools at once, running or waiting. Requests over the limit are turned
+        away with an HTTP 503. Classes not in the spec have no limit. For
+        example::
+
+            hashing:16,lookup:512
+
+    Returns
+    -------
+
+    dict
+        A dict mapping request classes to their in-flight limits.
+
+    '''
+
+    inflight_limits = {}
+
+    if not inflight_limits_spec:
+        return inflight_limits
+
+    for item in inflight_limits_spec.split(','):
+
+        item = item.strip()
+        if not item:
+            continue
+
+        request_class, limit = (x.strip() for x in item.split(':', 1))
+
+        if request_class not in ('hashing', 'lookup', 'default'):
+            raise ValueError("Unknown request class '%s' in in-flight limits. "
+                             "Use one of: hashing, lookup, default" %
+                             request_class)
+
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError("The in-flight limit for the '%s' request class "
+                             "must be at least 1." % request_class)
+
+        inflight_limits[request_class] = limit
+
+    return inflight_limits
+
+
+class ServerOverloaded(Exception):
+    '''This is raised when a request is turned away because its executor
+    pool's queue is full.
+
+    '''
+
+    def __init__(self, pool, retry_after):
+        super().__init__('executor pool %s is overloaded' % pool)
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class LoginThrottled(Exception):
+    '''This is raised when a login is tried too soon after failed logins.
+
+    '''
+
+    def __init__(self, retry_after):
+        super().__init__('login throttled for %.1f seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+class DeadlineExpired(Exception):
+    '''This is raised when a request's deadline passes before it can run.
+
+    '''
+
+
+class RequestMetrics(object):
+    '''This keeps track of request latencies for each request class, the
+    queue depth of each executor pool, and the requests of each class in the
+    executor pools.
+
+    '''
+
+    def __init__(self,
+                 nsamples=1000,
+                 pool_sizes=None,
+                 queue_limits=None,
+                 inflight_limits=None):
+        '''This sets up the metrics.
+
+        Parameters
+        ----------
+
+        nsamples : int
+            The number of most recent latencies to keep for each request class
+            to calculate percentiles.
+
+        pool_sizes : dict or None
+            A dict mapping executor pool names to their number of workers.
+            This is used to work out how many requests are waiting for a
+            worker in each pool.
+
+        queue_limits : dict or None
+            A dict mapping executor pool names to the number of requests that
+            can wait for a worker in that pool. See
+            :py:meth:`.pool_admit`.
+
+        inflight_limits : dict or None
+            A dict mapping request classes to the number of requests of that
+            class that can be in the executor pools at once. See
+            :py:meth:`.pool_admit`.
+
+        '''
+
+        self.nsamples = nsamples
+        self.classes = {}
+        self.pools = {}
+        self.class_pools = {}
+        self.dropped = {'expired_before_dispatch':0,
+                        'expired_in_worker':0,
+                        'cancelled':0}
+
+        if pool_sizes is not None:
+            for pool, workers in pool_sizes.items():
+                self._get_pool(pool)['workers'] = workers
+
+        if queue_limits is not None:
+            for pool, limit in queue_limits.items():
+                self._get_pool(pool)['queue_limit'] = limit
+
+        if inflight_limits is not None:
+            for request_class, limit in inflight_limits.items():
+                self._get_class_pool(request_class)['inflight_limit'] = limit
+
+    def _get_pool(self, pool):
+        '''
+        This returns the stats dict for an executor pool.
+
+        '''
+
+        stats = self.pools.get(pool)
+
+        if stats is None:
+            stats = {'workers':None,
+                     'queue_limit':None,
+                     'in_flight':0,
+                     'max_in_flight':0,
+                     'submitted':0,
+                     'shed':0}
+            self.pools[pool] = stats
+
+        return stats
+
+    def _get_class_pool(self, request_class):
+        '''
+        This returns the executor pool stats dict for a request class.
+
+        '''
+
+        stats = self.class_pools.get(request_class)
+
+        if stats is None:
+            stats = {'inflight_limit':None,
+                     'in_flight':0,
+                     'max_in_flight':0,
+                     'shed':0}
+            self.class_pools[request_class] = stats
+
+        return stats
+
+    def _mean_seconds(self, request_class):
+        '''
+        This returns the mean latency of a request class so far.
+
+        '''
+
+        class_metrics = self.classes.get(request_class)
+        if class_metrics is not None and class_metrics['count'] > 0:
+            return class_metrics['total_seconds']/class_metrics['count']
+
+        return 0.0
+
+    def record_dropped(self, reason):
+        '''This records a request that was dropped without being run.
+
+        reason is one of 'expired_before_dispatch', 'expired_in_worker', or
+        'cancelled'.
+
+        '''
+
+        self.dropped[reason] += 1
+
+    def pool_admit(self, pool, request_class):
+        '''This checks if there's room in an executor pool for a request.
+
+        A request class with an in-flight limit can have at most that many
+        requests in the executor pools at once. A pool with a queue limit
+        admits at most its number of workers plus the queue limit at once.
+        Requests over either limit are counted as shed.
+
+        Parameters
+        ----------
+
+        pool : str
+            The executor pool the request would go to.
+
+        request_class : str
+            The class of the request. Its mean latency is used to estimate when
+            the pool will have room again.
+
+        Returns
+        -------
+
+        float or None
+            None if the request can go ahead. Otherwise, the number of seconds
+            the client should wait before trying again.
+
+        '''
+
+        class_stats = self._get_class_pool(request_class)
+
+        if (class_stats['inflight_limit'] is not None and
+            class_stats['in_flight'] >= class_stats['inflight_limit']):
+
+            class_stats['shed'] += 1
+
+            # one of the class's requests in flight has to finish first
+            return max(1.0, self._mean_seconds(request_class))
+
+        stats = self._get_pool(pool)
+
+        if stats['queue_limit'] is None or stats['workers'] is None:
+            return None
+
+        queued = stats['in_flight'] - stats['workers']
+        if queued < stats['queue_limit']:
+            return None
+
+        stats['shed'] += 1
+
+        # estimate how long it'll take for the current queue to drain
+        return max(1.0,
+                   self._mean_seconds(request_class)*(queued + 1) /
+                   max(stats['workers'], 1))
+
+    def pool_submitted(self, pool, request_class=None):
+        '''
+        This records a request being sent to an executor pool.
+
+        '''
+
+        stats = self._get_pool(pool)
+        stats['in_flight'] += 1
+        stats['submitted'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'],
+                                     stats['in_flight'])
+
+        if request_class is not None:
+            class_stats = self._get_class_pool(request_class)
+            class_stats['in_flight'] += 1
+            class_stats['max_in_flight'] = max(class_stats['max_in_flight'],
+                                               class_stats['in_flight'])
+
+    def pool_completed(self, pool, request_class=None):
+        '''
+        This records a request sent to an executor pool being done.
+
+        '''
+
+        self._get_pool(pool)['in_flight'] -= 1
+
+        if request_class is not None:
+            self._get_class_pool(request_class)['in_flight'] -= 1
+
+    def pool_info(self):
+        '''This returns the queue depth stats for each executor pool.
+
+        Returns
+        -------
+
+        dict
+            A dict keyed by pool name. Each item contains the number of
+            workers, the number of requests in flight and the most there have
+            been at once, the number of requests waiting for a worker right
+            now (queued) and the most there have been at once (max_queued),
+            the queue limit, the total number of requests sent to the pool,
+            and the number of requests turned away because the queue was full
+            (shed).
+
+        '''
+
+        info = {}
+
+        for pool, stats in self.pools.items():
+
+            workers = stats['workers']
+            if workers is None:
+                queued = max_queued = None
+            else:
+                queued = max(stats['in_flight'] - workers, 0)
+                max_queued = max(stats['max_in_flight'] - workers, 0)
+
+            info[pool] = {'workers':workers,
+                          'in_flight':stats['in_flight'],
+                          'max_in_flight':stats['max_in_flight'],
+                          'queued':queued,
+                          'max_queued':max_queued,
+                          'queue_limit':stats['queue_limit'],
+                          'submitted':stats['submitted'],
+                          'shed':stats['shed']}
+
+        return info
+
+    def class_pool_info(self):
+        '''This returns the executor pool stats for each request class.
+
+        Returns
+        -------
+
+        dict
+            A dict keyed by request class. Each item contains the number of
+            the class's requests in the executor pools now (in_flight) and the
+            most there have been at once (max_in_flight), the in-flight limit,
+            and the number of requests turned away because the class was at
+            its limit (shed).
+
+        '''
+
+        return {request_class:dict(stats)
+                for request_class, stats in self.class_pools.items()}
+
+    def record(self, request_class, mode, elapsed_seconds):
+        '''
+        This records the time taken by a request.
+
+        '''
+
+        metrics = self.classes.get(request_class)
+
+        if metrics is None:
+            metrics = {'count':0,
+                       'inline':0,
+                       'process':0,
+                       'total_seconds':0.0,
+                       'max_seconds':0.0,
+                       'samples':deque(maxlen=self.nsamples)}
+            self.classes[request_class] = metrics
+
+        metrics['count'] += 1
+        metrics[mode] += 1
+        metrics['total_seconds'] += elapsed_seconds
+        metrics['max_seconds'] = max(metrics['max_seconds'], elapsed_seconds)
+        metrics['samples'].append(elapsed_seconds)
+
+    def info(self):
+        '''This returns the latency stats for each request class.
+
+        Returns
+        -------
+
+        dict
+            A dict keyed by request class. Each item contains the number of
+            requests, how many ran inline and in the background workers, and
+            the mean, max, and recent p50, p95, and p99 latencies in
+            milliseconds.
+
+        '''
+
+        info = {}
+
+        for request_class, metrics in self.classes.items():
+
+            samples = sorted(metrics['samples'])
+            nsamples = len(samples)
+
+            info[request_class] = {
+                'count':metrics['count'],
+                'inline':metrics['inline'],
+                'process':metrics['process'],
+                'mean_ms':metrics['total_seconds']/metrics['count']*1.0e3,
+                'max_ms':metrics['max_seconds']*1.0e3,
+                'p50_ms':samples[int(0.50*nsamples)]*1.0e3,
+                'p95_ms':samples[min(int(0.95*nsamples), nsamples - 1)]*1.0e3,
+                'p99_ms':samples[min(int(0.99*nsamples), nsamples - 1)]*1.0e3,
+            }
+
+        return info
+
+
+def get_login_keys(request_body):
+    '''This returns the keys used to track failed logins for a login request.
+
+    If the frontend provides the client's IP address in the request's
+    'ip_address' item, failed logins are tracked for the email address and IP
+    address together, and for the IP address across all email addresses. This
+    way, failed logins from one client can't lock the owner of an email
+    address out from somewhere else. Without an IP address, failed logins are
+    tracked by email address alone.
+
+    '''
+
+    keys = []
+
+    ip_address = request_body.get('ip_address')
+    if not isinstance(ip_address, str) or not ip_address:
+        ip_address = None
+
+    email = request_body.get('email')
+    if isinstance(email, str):
+        if ip_address is not None:
+            keys.append('email:%s ip:%s' % (email.strip().casefold(),
+                                            ip_address))
+        else:
+            keys.append('email:%s' % email.strip().casefold())
+
+    if ip_address is not None:
+        keys.append('ip:%s' % ip_address)
+
+    return keys
+
+
+# these read-only requests give the same answer to identical concurrent
+# requests, so only one of them needs to go to a worker. requests that run
+# inline aren't coalesced: each one runs to completion on the IOLoop before the
+# next starts, so identical inline requests never overlap. with the default
+# dispatch, this applies to single-user user-list requests and to the lookups
+# of any server set up to send lookups to the workers.
+COALESCED_REQUESTS = frozenset({
+    'session-exists',
+    'apikey-verify',
+    'check-user-access',
+    'user-list',
+})
+
+
+def get_coalescing_key(request_type, request_body):
+    '''This returns the key used to find identical concurrent requests.
+
+    Parameters
+    ----------
+
+    request_type : str
+        The request type.
+
+    request_body : dict
+        The request payload.
+
+    Returns
+    -------
+
+    tuple or None
+        A (request_type, normalized body) tuple, or None if the request can't
+        be coalesced. Only requests in ``COALESCED_REQUESTS`` can be, and
+        'user-list' only when it asks for a single user ID.
+
+    '''
+
+    if request_type not in COALESCED_REQUESTS:
+        return None
+
+    if (request_type == 'user-list' and
+        (not isinstance(request_body, dict) or
+         request_body.get('user_id') is None)):
+        return None
+
+    try:
+        normalized_body = json.dumps(request_body,
+                                     sort_keys=True,
+                                     cls=FrontendEncoder)
+    except (TypeError, ValueError):
+        return None
+
+    return request_type, normalized_body
+
+
+class RequestCoalescer(object):
+    '''This lets identical concurrent requests share one in-flight result.
+
+    The first request for a key runs. Requests for the same key that arrive
+    while it's running wait for its result instead of running themselves.
+
+    '''
+
+    def __init__(self):
+        '''
+        This sets up the coalescer.
+
+        '''
+
+        self.in_flight = {}
+        self.requests = 0
+        self.coalesced = 0
+
+    async def run(self, key, func, *args, deadline=None, **kwargs):
+        '''This runs func(*args, **kwargs) unless it's already running for key.
+
+        Parameters
+        ----------
+
+        key : tuple
+            The key from :py:func:`.get_coalescing_key`.
+
+        func : coroutine function
+            The function that does the actual work.
+
+        args, kwargs : extra arguments
+            These are passed to func.
+
+        deadline : float or None
+            The UNIX time after which this request stops waiting for the
+            result and raises :py:class:`.DeadlineExpired`. The shared work
+            keeps running for the other requests waiting on it.
+
+        Returns
+        -------
+
+        object
+            The result of func, shared by every request for key that arrived
+            while it was running.
+
+        '''
+
+        self.requests += 1
+
+        shared = self.in_flight.get(key)
+
+        if shared is not None:
+            self.coalesced += 1
+        else:
+            shared = asyncio.ensure_future(func(*args, **kwargs))
+            self.in_flight[key] = shared
+            shared.add_done_callback(
+                lambda fut: (self.in_flight.pop(key)
+                             if self.in_flight.get(key) is fut else None)
+            )
+
+        # shield the shared work so that one waiter getting cancelled or
+        # giving up at its deadline doesn't cancel it for everyone else
+        if deadline is None:
+            return await asyncio.shield(shared)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(shared),
+                                          max(deadline - time.time(), 0.0))
+        except asyncio.TimeoutError:
+            raise DeadlineExpired()
+
+    def info(self):
+        '''This returns the coalescing stats.
+
+        Returns
+        -------
+
+        dict
+            The number of requests that could be coalesced, how many of these
+            shared another request's result, how many actually ran, the
+            fraction that were coalesced, and the number of keys running now.
+
+        '''
+
+        return {
+            'requests':self.requests,
+            'coalesced':self.coalesced,
+            'executed':self.requests - self.coalesced,
+            'ratio':(self.coalesced/self.requests if self.requests > 0
+                     else 0.0),
+            'in_flight':len(self.in_flight),
+        }
+
+
 #############
 ## HANDLER ##
 #############
@@ -271,10 +1199,29 @@ class AuthHandler(tornado.web.RequestHandler):
                    fernet_secret,
                    executor,
                    reqid_cache,
-                   failed_passchecks):
+                   failed_passchecks,
+                   ratelimiter=None,
+                   permissions_json=None,
+                   dispatch=None,
+                   metrics=None,
+                   executors=None,
+                   coalescer=None):
         '''
         This sets up stuff.
 
+        reqid_cache is a :py:class:`authnzerver.cache.ReplayCache` used to
+        reject replayed and stale requests. failed_passchecks is a
+        :py:class:`authnzerver.cache.FailedLoginTracker` used to turn away
+        logins after repeated failures. dispatch is a dict from
+        :py:func:`.parse_dispatch` that sets which requests run inline on the
+        IOLoop. If it's None, all requests run in the executor. metrics is a
+        :py:class:`.RequestMetrics` instance used to record request latencies.
+        executors is a dict mapping request classes to separate executors, e.g.
+        {'hashing': hashing_executor}. Request classes not in this dict use
+        executor. coalescer is a :py:class:`.RequestCoalescer` that lets
+        identical concurrent read-only requests sent to the executor share one
+        result.
+
         '''
 
         self.authdb = authdb
@@ -282,6 +1229,172 @@ class AuthHandler(tornado.web.RequestHandler):
         self.executor = executor
         self.reqid_cache = reqid_cache
         self.failed_passchecks = failed_passchecks
+        self.ratelimiter = ratelimiter
+        self.permissions_json = permissions_json
+        self.dispatch = dispatch if dispatch is not None else {}
+        self.metrics = metrics
+        self.executors = executors if executors is not None else {}
+        self.coalescer = coalescer
+        self.pool_future = None
+
+    async def run_in_pool(self, request_class, func, *args,
+                          cancellable=True):
+        '''This runs func in the executor pool for request_class.
+
+        Raises :py:class:`.ServerOverloaded` without running func if the pool's
+        queue is full or request_class is at its in-flight limit. If
+        cancellable is False, the work isn't cancelled when this handler's
+        client goes away.
+
+        '''
+
+        if request_class in self.executors:
+            pool, executor = request_class, self.executors[request_class]
+        else:
+            pool, executor = 'default', self.executor
+
+        if self.metrics is not None:
+
+            retry_after = self.metrics.pool_admit(pool, request_class)
+            if retry_after is not None:
+                raise ServerOverloaded(pool, retry_after)
+
+            self.metrics.pool_submitted(pool, request_class)
+
+        # keep the future around so it can be cancelled if the client goes
+        # away while the request is waiting for a worker. workers can run
+        # several requests at once, so run_action makes sure they only
+        # overlap while hashing passwords
+        try:
+            loop = tornado.ioloop.IOLoop.current()
+            pool_future = loop.run_in_executor(executor,
+                                               run_action,
+                                               func,
+                                               *args)
+            if cancellable:
+                self.pool_future = pool_future
+            return await pool_future
+        finally:
+            self.pool_future = None
+            if self.metrics is not None:
+                self.metrics.pool_completed(pool, request_class)
+
+    def on_connection_close(self):
+        '''This cancels the request's executor work if the client goes away.
+
+        Work that's still waiting for a worker is dropped. Work that has
+        already started runs to completion but its result is thrown away.
+
+        '''
+
+        pool_future = self.pool_future
+
+        if pool_future is not None and not pool_future.done():
+            LOGGER.info('client went away, cancelling its queued request')
+            pool_future.cancel()
+            if self.metrics is not None:
+                self.metrics.record_dropped('cancelled')
+
+    async def run_batch(self, body, deadline=None):
+        '''This runs a batch request.
+
+        Rate limit checks in the batch are answered directly. The rest of the
+        sub-requests are sent to a single executor worker using
+        :py:func:`.auth_batch`, or run inline if all of them are set up to run
+        inline. Sub-requests with unknown or disallowed request
+        types fail without affecting the others.
+
+        Parameters
+        ----------
+
+        body : dict
+            This should contain a 'requests' item: a list of dicts, each with a
+            'request' item for the request type and a 'body' item for its
+            payload.
+
+        deadline : float or None
+            The UNIX time after which sub-requests that haven't started yet
+            won't be run.
+
+        Returns
+        -------
+
+        dict
+            Returns a dict of the form::
+
+                {'success': True if all sub-requests succeeded,
+                 'responses': list of response dicts in request order,
+                 'messages': list of str messages}
+
+        '''
+
+        subrequests = body['requests']
+        if (not isinstance(subrequests, list) or
+            len(subrequests) > BATCH_MAX_REQUESTS):
+            raise ValueError("A batch request must be a list of at most "
+                             "%s requests." % BATCH_MAX_REQUESTS)
+
+        responses = [None]*len(subrequests)
+        worker_requests, worker_indices = [], []
+        self.batch_dispatch_mode = 'inline'
+
+        for ind, subreq in enumerate(subrequests):
+
+            request_type = subreq.get('request')
+            request_body = subreq.get('body', {})
+
+            if (request_type == 'ratelimit-check' and
+                self.ratelimiter is not None):
+                responses[ind] = ratelimit_check(request_body,
+                                                 self.ratelimiter,
+                                                 self.permissions_json)
+
+            elif (request_type in request_functions and
+                  request_type not in BATCH_EXCLUDED_REQUESTS):
+                worker_requests.append((request_type, request_body))
+                worker_indices.append(ind)
+
+            else:
+                responses[ind] = {
+                    'success':False,
+                    'messages':["Request type %s is not allowed in a "
+                                "batch request." % request_type]
+                }
+
+        # the batch runs inline only if all of its requests can
+        if worker_requests and all(
+                get_dispatch_mode(x[0], self.dispatch) == 'inline'
+                for x in worker_requests
+        ):
+
+            worker_responses = auth_batch(worker_requests, deadline)
+
+        elif worker_requests:
+
+            # batches with a password hashing request go to the hashing pool
+            self.batch_dispatch_mode = 'process'
+            batch_class = (
+                'hashing' if any(REQUEST_CLASSES.get(x[0]) == 'hashing'
+                                 for x in worker_requests)
+                else 'default'
+            )
+            worker_responses = await self.run_in_pool(batch_class,
+                                                      auth_batch,
+                                                      worker_requests,
+                                                      deadline)
+
+        if worker_requests:
+            for ind, response in zip(worker_indices, worker_responses):
+                responses[ind] = response
+
+        nfailed = sum(1 for x in responses if not x['success'])
+
+        return {
+            'success':nfailed == 0,
+            'responses':responses,
+            'messages':["Batch of %s requests completed, %s failed." %
+                        (len(responses), nfailed)]
+        }
 
     async def post(self):
         '''
@@ -294,7 +1407,9 @@ class AuthHandler(tornado.web.RequestHandler):
         if not ipcheck:
             raise tornado.web.HTTPError(status_code=400)
 
-        payload = decrypt_request(self.request.body, self.fernet_secret)
+        payload, request_timestamp = decrypt_request(self.request.body,
+                                                     self.fernet_secret,
+                                                     return_timestamp=True)
         if not payload:
             raise tornado.web.HTTPError(status_code=401)
 
@@ -314,72 +1429,154 @@ class AuthHandler(tornado.web.RequestHandler):
                                  "Ignoring this request.")
 
             #
-            # put the reqid into a cache and get it back
+            # reject replayed and stale requests
             #
-            reqid_cache_len = len(self.reqid_cache)
-            self.reqid_cache.add(reqid)
-            if len(self.reqid_cache) == reqid_cache_len:
+            replay_check = self.reqid_cache.check(reqid, request_timestamp)
+            if replay_check == 'replayed':
                 raise ValueError(
                     "Request ID was repeated. Ignoring this request."
                 )
-
-            #
-            # trim the reqid_cache as needed
-            #
-            if len(self.reqid_cache) > 1000:
-                self.reqid_cache.pop()
+            elif replay_check == 'stale':
+                raise ValueError(
+                    "Request is outside the replay window. "
+                    "Ignoring this request."
+                )
 
             #
             # dispatch the action handler function
             #
 
+            request_start = time.monotonic()
+            request_class = REQUEST_CLASSES.get(payload['request'], 'default')
+            dispatch_mode = 'inline'
+
+            # if the frontend has already given up on this request, don't
+            # bother running it
+            deadline = payload.get('deadline')
+            if deadline is not None and time.time() >= deadline:
+                if self.metrics is not None:
+                    self.metrics.record_dropped('expired_before_dispatch')
+                raise DeadlineExpired()
+
+            # turn away logins for email and IP address pairs and IP
+            # addresses with recent failed logins right away instead of
+            # hashing their passwords
+            if payload['request'] == 'user-login':
+
+                login_keys = get_login_keys(payload['body'])
+                retry_after = self.failed_passchecks.check(login_keys)
+                if retry_after > 0.0:
+                    raise LoginThrottled(retry_after)
+
+            # batch requests run their sub-requests in a single worker call
+            if payload['request'] == 'batch':
+
+                request_class = 'batch'
+                response = await self.run_batch(payload['body'], deadline)
+                dispatch_mode = self.batch_dispatch_mode
+
+            # rate limit checks are answered right here without going through
+            # the executor
+            elif (payload['request'] == 'ratelimit-check' and
+                self.ratelimiter is not None):
+
+                response = ratelimit_check(payload['body'],
+                                           self.ratelimiter,
+                                           self.permissions_json)
+
+            # return the request latency metrics
+            elif (payload['request'] == 'server-metrics' and
+                  self.metrics is not None):
+
+                response = {'success':True,
+                            'metrics':self.metrics.info(),
+                            'pools':self.metrics.pool_info(),
+                            'class_pools':self.metrics.class_pool_info(),
+                            'dropped':dict(self.metrics.dropped),
+                            'replay':self.reqid_cache.info(),
+                            'failed_logins':self.failed_passchecks.info(),
+                            'coalescing':(self.coalescer.info()
+                                          if self.coalescer is not None
+                                          else None),
+                            'messages':["Server metrics retrieved."]}
+
+            # run fast requests directly on the IOLoop if they're set up to
+            elif get_dispatch_mode(payload['request'],
+                                   self.dispatch) == 'inline':
+
+                response = request_functions[payload['request']](
+                    payload['body']
+                )
+
             # run the function associated with the request type
-            loop = tornado.ioloop.IOLoop.current()
-            response = await loop.run_in_executor(
-                self.executor,
-                request_functions[payload['request']],
-                payload['body']
-            )
+            else:
+
+                dispatch_mode = 'process'
+                coalescing_key = (
+                    get_coalescing_key(payload['request'], payload['body'])
+                    if self.coalescer is not None else None
+                )
+
+                # identical concurrent read-only requests share one trip to
+                # the workers. the shared work can't be cancelled by any one
+                # client or dropped at one client's deadline since the others
+                # are still waiting on it, but each of them stops waiting at
+                # its own deadline.
+                if coalescing_key is not None:
+                    try:
+                        response = await self.coalescer.run(
+                            coalescing_key,
+                            self.run_in_pool,
+                            request_class,
+                            request_functions[payload['request']],
+                            payload['body'],
+                            deadline=deadline,
+                            cancellable=False
+                        )
+                    except DeadlineExpired:
+                        if self.metrics is not None:
+                            self.metrics.record_dropped('expired_in_worker')
+                        raise
+                else:
+                    response = await self.run_in_pool(
+                        request_class,
+                        run_before_deadline,
+                        request_functions[payload['request']],
+                        payload['body'],
+                        deadline
+                    )
+
+                # the worker didn't run it because the deadline passed while
+                # it was waiting
+                if response is None:
+                    if self.metrics is not None:
+                        self.metrics.record_dropped('expired_in_worker')
+                    raise DeadlineExpired()
+
+            if self.metrics is not None:
+                self.metrics.record(request_class,
+                                    dispatch_mode,
+                                    time.monotonic() - request_start)
 
             #
-            # see if the request was user-login. in this case,
-            # we'll apply backoff to slow down repeated failed passwords
+            # see if the request was user-login. in this case, we'll lock out
+            # the email and IP address pair and the IP address for an
+            # exponentially increasing time after each failed login. logins
+            # tried before then get an HTTP 429 above.
             #
             if (payload['request'] == 'user-login' and
                 response['success'] is False):
 
-                # increment the failure counter and return it
-                if (payload['body']['email'] in self.failed_passchecks):
-                    self.failed_passchecks[payload['body']['email']] += 1
-                else:
-                    self.failed_passchecks[payload['body']['email']] = 1
-
-                failed_pass_count = self.failed_passchecks[
-                    payload['body']['email']
-                ]
-
-                # asyncio.sleep for an exponentially increasing period of time
-                # until 40.0 seconds ~= 10 tries
-                wait_time = 1.5**(failed_pass_count - 1.0)
-                if wait_time > 40.0:
-                    wait_time = 40.0
+                self.failed_passchecks.record_failure(login_keys)
 
-                await asyncio.sleep(wait_time)
-
-            # reset the failed counter to zero for each successful attempt
+            # reset the email and IP address pair's failures for each
+            # successful attempt. the IP address's failures are kept since it
+            # may be trying many emails.
             elif (payload['request'] == 'user-login' and
                   response['success'] is True):
 
-                self.failed_passchecks.pop(
-                    payload['body']['email'],
-                    None
-                )
-            #
-            # trim the failed_passchecks dict
-            #
-            if len(self.failed_passchecks) > 1000:
-                self.failed_passchecks.pop(
-                    self.failed_passchecks.keys()[0]
+                self.failed_passchecks.record_success(
+                    [x for x in login_keys if x.startswith('email:')]
                 )
 
             #
@@ -400,6 +1597,38 @@ class AuthHandler(tornado.web.RequestHandler):
             self.write(encrypted_base64)
             self.finish()
 
+        # the frontend won't use the response so tell it so without running
+        # the request
+        except DeadlineExpired:
+
+            LOGGER.debug('dropped %s request after its deadline passed' %
+                         payload['request'])
+            self.set_status(504)
+            self.finish()
+
+        # this email or IP address has failed to log in too recently, so tell
+        # the frontend when to try again
+        except LoginThrottled as e:
+
+            LOGGER.debug('throttling login: %s' % e)
+            self.set_status(429)
+            self.set_header('Retry-After', str(int(math.ceil(e.retry_after))))
+            self.finish()
+
+        # the client went away and the request was cancelled
+        except asyncio.CancelledError:
+
+            LOGGER.debug('%s request cancelled' % payload['request'])
+
+        # if the executor pool is backed up, turn the request away right now
+        # instead of letting it wait for a worker
+        except ServerOverloaded as e:
+
+            LOGGER.debug('shedding %s request: %s' % (payload['request'], e))
+            self.set_status(503)
+            self.set_header('Retry-After', str(int(math.ceil(e.retry_after))))
+            self.finish()
+
         except Exception:
 
             LOGGER.exception('failed to understand request')
@@ -69,10 +69,23 @@ import multiprocessing as mp
 
 def _setup_auth_worker(authdb_path,
                        fernet_secret,
-                       permissions_json):
+                       permissions_json,
+                       password_timing,
+                       passhash,
+                       hash_threads=1,
+                       hash_memory_mib=1024,
+                       breached_passwords='',
+                       password_policy='',
+                       cache_dirname='/tmp/authnzerver-cache'):
     '''This stores secrets and the auth DB path in the worker loop's context.
 
     The worker will then open the DB and set up its Fernet instance by itself.
+    The cache directory is where the worker's session and user status caches
+    find out about changes made by the other workers.
+    It also sets the password hasher parameters and how many hashes it can run
+    at once, and maps the breached passwords file. It then loads the dummy
+    password hash, sets up password check timing, and builds the password
+    policy right away, so the first requests it handles don't have to.
 
     '''
     # unregister interrupt signals so they don't get to the worker
@@ -83,6 +96,26 @@ def _setup_auth_worker(authdb_path,
     currproc.auth_db_path = authdb_path
     currproc.fernet_secret = fernet_secret
     currproc.permissions_json = permissions_json
+    currproc.password_timing = password_timing
+    currproc.cache_dirname = cache_dirname
+
+    from .passhash import configure_pass_hasher, configure_hashing_engine
+    from .breached import load_breached_passwords
+    from .passpolicy import configure_password_policy
+    from .actions.session import prepare_password_checks
+
+    configure_pass_hasher(passhash)
+    configure_hashing_engine(hash_threads, hash_memory_mib)
+    load_breached_passwords(breached_passwords)
+    configure_password_policy(password_policy)
+
+    try:
+        prepare_password_checks()
+    except Exception:
+        logging.getLogger(LOGMOD).exception(
+            'could not set up password checks in worker %s, '
+            'will try again on the first request' % currproc.name
+        )
 
 
 def _close_authentication_database():
@@ -135,6 +168,29 @@ define('envfile',
              'for testing/development.'),
        type=str)
 
+# whether to pick password hasher parameters for this machine
+define('calibrate',
+       default=False,
+       help=("If this is True, will time password hashes on this machine, "
+             "print the passhash setting that makes a password check take "
+             "about calibratetarget seconds within calibratememory MiB, "
+             "then exit."),
+       type=bool)
+
+define('calibratetarget',
+       default=0.25,
+       help=("The time in seconds a password check should take, "
+             "used with the calibrate option."),
+       type=float)
+
+define('calibratememory',
+       default=1024,
+       help=("The total memory in MiB that all concurrent password hashes "
+             "can use, used with the calibrate option. This is shared "
+             "between the threads of the hashing workers (or the workers if "
+             "hashworkers is 0)."),
+       type=int)
+
 # whether to make a new authdb if none exists
 define('autosetup',
        default=False,
@@ -178,6 +234,13 @@ def main():
     ##############
 
     from .handlers import AuthHandler, EchoHandler
+    from .handlers import parse_dispatch, parse_queue_limits, RequestMetrics
+    from .handlers import parse_inflight_limits
+    from .handlers import RequestCoalescer
+    from .actions.session import parse_password_timing
+    from .passhash import configure_pass_hasher
+    from .breached import load_breached_passwords
+    from .passpolicy import configure_password_policy
     from . import cache
     from . import actions
 
@@ -204,6 +267,32 @@ def main():
                        "command line options or as environment variables.")
         sys.exit(0)
 
+    # if calibrate is set, we'll pick the password hasher parameters, then
+    # exit immediately
+    if options.calibrate:
+
+        from .passhash import calibrate_passhash, format_passhash_params
+
+        concurrency = (options.hashworkers if options.hashworkers > 0
+                       else options.workers)*options.hashthreads
+        LOGGER.info('Calibrating password hashing for a verify time of '
+                    '%.3f s with %s MiB shared by %s concurrent hashes...' %
+                    (options.calibratetarget,
+                     options.calibratememory,
+                     concurrency))
+
+        params, verify_seconds = calibrate_passhash(
+            target_seconds=options.calibratetarget,
+            memory_budget_mib=options.calibratememory,
+            concurrency=concurrency
+        )
+
+        LOGGER.warning('A password check will take %.3f s and use %s MiB. '
+                       'To use these parameters, set:' %
+                       (verify_seconds, params['memory_cost']//1024))
+        print('AUTHNZERVER_PASSHASH=%s' % format_passhash_params(params))
+        sys.exit(0)
+
     # otherwise, we'll assume that all is well, and we'll proceed to load the
     # config from an envfile, command line args, or the environment.
 
@@ -221,6 +310,8 @@ def main():
         raise
 
     maxworkers = loaded_config.workers
+    hashworkers = loaded_config.hashworkers
+    hashthreads = loaded_config.hashthreads
     basedir = loaded_config.basedir
     LOGGER.info("The server's base directory is: %s" % os.path.abspath(basedir))
 
@@ -240,16 +331,109 @@ def main():
     secret = loaded_config.secret
     permissions = loaded_config.permissions
 
+    #
+    # set up request dispatch. requests that run inline use this process's
+    # own DB connection, so we set it up the same way as the workers
+    #
+    dispatch = parse_dispatch(loaded_config.dispatch)
+    LOGGER.info('Request dispatch: %s' % (dispatch or 'all in workers'))
+
+    password_timing = loaded_config.passtiming
+    parse_password_timing(password_timing)
+    LOGGER.info('Rejected password check timing: %s' % password_timing)
+
+    passhash = loaded_config.passhash
+    passhash_params = configure_pass_hasher(passhash)
+    LOGGER.info('Password hasher parameters: %s' %
+                (passhash_params or 'argon2 defaults'))
+
+    # open the breached passwords file here so a bad path stops the server
+    # before any workers start
+    breached_passwords = loaded_config.breachedpasswords
+    breached = load_breached_passwords(breached_passwords)
+    if breached is not None:
+        LOGGER.info('Checking new passwords against %s breached password '
+                    'hashes in: %s' % (len(breached), breached.path))
+
+    # build the password policy for requests that run on the server. this
+    # also checks the spec before any workers get it
+    password_policy = loaded_config.passpolicy
+    policy = configure_password_policy(password_policy)
+    LOGGER.info('Password policy: min_length:%s, max_similarity:%s, '
+                'max_char_fraction:%s, min_common_similarity:%s, FQDN: %s' %
+                (policy.min_length, policy.max_similarity,
+                 policy.max_char_fraction, policy.min_common_similarity,
+                 policy.fqdn))
+
+    queue_limits = parse_queue_limits(loaded_config.maxqueued)
+    LOGGER.info('Worker pool queue limits: %s' % (queue_limits or 'none'))
+
+    inflight_limits = parse_inflight_limits(loaded_config.maxinflight)
+    LOGGER.info('Request class in-flight limits: %s' %
+                (inflight_limits or 'none'))
+
+    replay_cache = cache.ReplayCache(
+        window_seconds=loaded_config.replaywindow,
+        cache_dirname=loaded_config.replaycache or None
+    )
+    LOGGER.info('Replay protection window: %s seconds, '
+                'request IDs kept in: %s' %
+                (loaded_config.replaywindow,
+                 loaded_config.replaycache or 'memory'))
+
+    # inline lookups use this process's own session and user status caches.
+    # these have to share the workers' cache directory to see the sessions and
+    # users the workers change
+    currproc = mp.current_process()
+    currproc.auth_db_path = authdb
+    currproc.fernet_secret = secret
+    currproc.permissions_json = permissions
+    currproc.password_timing = password_timing
+    currproc.cache_dirname = cachedir
+
+    #
+    # the workers that hash passwords run several requests at once on their
+    # own threads. the memory for concurrent hashes is split between them
+    #
+    hash_procs = hashworkers if hashworkers > 0 else maxworkers
+    hash_memory = loaded_config.hashmemory//hash_procs
+    LOGGER.info('Password hashing: %s threads in each of %s workers, '
+                '%s MiB for concurrent hashes in each worker' %
+                (hashthreads, hash_procs, hash_memory))
+
     #
     # this is the background executor we'll pass over to the handler
     #
+    default_threads = hashthreads if hashworkers == 0 else 1
     executor = ProcessPoolExecutor(
         max_workers=maxworkers,
         initializer=_setup_auth_worker,
-        initargs=(authdb, secret, permissions),
-        finalizer=_close_authentication_database
+        initargs=(authdb, secret, permissions, password_timing,
+                  passhash, default_threads, hash_memory,
+                  breached_passwords, password_policy, cachedir),
+        finalizer=_close_authentication_database,
+        max_threads=default_threads
     )
 
+    #
+    # password hashing requests get their own executor so they can't hold up
+    # the DB lookups
+    #
+    executors = {}
+    pool_sizes = {'default':maxworkers*default_threads}
+
+    if hashworkers > 0:
+        executors['hashing'] = ProcessPoolExecutor(
+            max_workers=hashworkers,
+            initializer=_setup_auth_worker,
+            initargs=(authdb, secret, permissions, password_timing,
+                      passhash, hashthreads, hash_memory,
+                      breached_passwords, password_policy, cachedir),
+            finalizer=_close_authentication_database,
+            max_threads=hashthreads
+        )
+        pool_sizes['hashing'] = hashworkers*hashthreads
+
     ###################
     ## HANDLER SETUP ##
     ###################
@@ -260,8 +444,16 @@ def main():
          {'authdb':authdb,
           'fernet_secret':secret,
           'executor':executor,
-          'reqid_cache':set(),
-          'failed_passchecks':{}}),
+          'reqid_cache':replay_cache,
+          'failed_passchecks':cache.FailedLoginTracker(),
+          'ratelimiter':cache.MemoryRateLimiter(),
+          'permissions_json':permissions,
+          'dispatch':dispatch,
+          'metrics':RequestMetrics(pool_sizes=pool_sizes,
+                                   queue_limits=queue_limits,
+                                   inflight_limits=inflight_limits),
+          'executors':executors,
+          'coalescer':RequestCoalescer()}),
     ]
 
     if DEBUG:
@@ -351,8 +543,10 @@ def main():
 
         LOGGER.info('Starting authnzerver. Listening on http://%s:%s.' %
                     (listen, serverport))
-        LOGGER.info('Background worker processes: %s. IOLoop in use: %s.' %
-                    (maxworkers, IOLOOP_SPEC))
+        LOGGER.info('Background worker processes: %s, '
+                    'password hashing worker processes: %s. '
+                    'IOLoop in use: %s.' %
+                    (maxworkers, hashworkers, IOLOOP_SPEC))
 
         # start the IOLoop
         loop.start()
@@ -361,10 +555,15 @@ def main():
 
         LOGGER.info('Received Ctrl-C: shutting down...')
 
-        # close down the processpool
+        # close down the processpools
         executor.shutdown()
+        for pool_executor in executors.values():
+            pool_executor.shutdown()
         time.sleep(2)
 
+        # close our cache handles
+        cache.cache_close_all()
+
         tornado.ioloop.IOLoop.instance().stop()
 
         currproc = mp.current_process()
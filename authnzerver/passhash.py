@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# passhash.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This contains the argon2 password hasher shared by the auth actions, and
+functions to tune its parameters for the current machine.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+
+# get a logger
+LOGGER = logging.getLogger(__name__)
+
+
+#############
+## IMPORTS ##
+#############
+
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from argon2 import PasswordHasher
+
+
+################################
+## THE SHARED PASSWORD HASHER ##
+################################
+
+# these are the argon2 parameters that can be tuned
+PASSHASH_PARAMS = ('time_cost', 'memory_cost', 'parallelism')
+
+
+def parse_passhash_params(passhash_spec):
+    '''This parses a password hasher parameter spec.
+
+    Parameters
+    ----------
+
+    passhash_spec : str
+        A comma-separated list of name:value items, e.g.
+        'time_cost:3,memory_cost:65536,parallelism:4'. memory_cost is in
+        KiB. Parameters that aren't in the spec use argon2's defaults. An empty
+        string uses the defaults for everything.
+
+    Returns
+    -------
+
+    dict
+        A dict mapping parameter names to their values.
+
+    '''
+
+    params = {}
+
+    for item in passhash_spec.split(','):
+
+        item = item.strip()
+        if not item:
+            continue
+
+        name, _, value = item.partition(':')
+        name, value = name.strip(), value.strip()
+
+        if name not in PASSHASH_PARAMS:
+            raise ValueError(
+                "Unknown password hasher parameter: '%s'. It must be one of: "
+                "%s." % (name, ', '.join(PASSHASH_PARAMS))
+            )
+
+        try:
+            params[name] = int(value)
+        except ValueError:
+            raise ValueError(
+                "Invalid value for password hasher parameter %s: '%s'" %
+                (name, value)
+            )
+
+        if params[name] < 1:
+            raise ValueError(
+                "Password hasher parameter %s must be at least 1." % name
+            )
+
+    return params
+
+
+def format_passhash_params(params):
+    '''
+    This turns a dict of password hasher parameters back into a spec string.
+
+    '''
+
+    return ','.join('%s:%s' % (name, params[name])
+                    for name in PASSHASH_PARAMS if name in params)
+
+
+class HashingEngine(object):
+    '''This runs argon2 hashes in a worker that handles several requests at
+    once on its own threads.
+
+    argon2 releases the GIL while it hashes, but nothing else in the auth
+    actions is safe to run at the same time: they share the worker's single
+    DB connection and its per-process state. So each request runs holding the
+    worker's action lock (see :py:func:`.run_action`), and the lock is only
+    let go while the request is waiting on argon2. The DB work for one request
+    can then run while another request's password is being hashed.
+
+    The number of hashes that can run at once is capped separately so their
+    memory use stays within the worker's budget.
+
+    '''
+
+    def __init__(self, max_concurrent=1):
+        '''
+        This sets up the engine to run up to max_concurrent hashes at once.
+
+        '''
+
+        self._action_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.configure(max_concurrent)
+
+    def configure(self, max_concurrent):
+        '''This sets the number of hashes that can run at once.
+
+        This should be called before the worker starts running requests.
+
+        '''
+
+        self.max_concurrent = max(1, max_concurrent)
+        self._hash_slots = threading.BoundedSemaphore(self.max_concurrent)
+        self.running = 0
+        self.max_running = 0
+        self.hashes = 0
+
+    def run_action(self, func, *args, **kwargs):
+        '''
+        This runs func(*args, **kwargs) holding the worker's action lock.
+
+        '''
+
+        with self._action_lock:
+            self._local.holding = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.holding = False
+
+    @contextmanager
+    def released(self):
+        '''This lets go of the action lock for the duration of a with block.
+
+        It does nothing if the current thread isn't holding the lock, e.g. for
+        requests that run inline on the server.
+
+        '''
+
+        holding = getattr(self._local, 'holding', False)
+
+        if holding:
+            self._local.holding = False
+            self._action_lock.release()
+
+        try:
+            yield
+        finally:
+            if holding:
+                self._action_lock.acquire()
+                self._local.holding = True
+
+    def run_hash(self, func, *args):
+        '''This runs an argon2 function once a hash slot is free.
+
+        The action lock is let go while this waits for a slot and hashes.
+
+        '''
+
+        with self.released(), self._hash_slots:
+
+            with self._stats_lock:
+                self.running += 1
+                self.hashes += 1
+                self.max_running = max(self.max_running, self.running)
+
+            try:
+                return func(*args)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+
+    def info(self):
+        '''
+        This returns the engine's concurrency limit and hash counts.
+
+        '''
+
+        with self._stats_lock:
+            return {'max_concurrent':self.max_concurrent,
+                    'running':self.running,
+                    'max_running':self.max_running,
+                    'hashes':self.hashes}
+
+
+class TunablePasswordHasher(object):
+    '''This is an argon2 PasswordHasher whose parameters can be changed.
+
+    All of the auth actions share one instance of this, so setting its
+    parameters once when a worker starts changes them everywhere.
+
+    '''
+
+    def __init__(self, engine=None, **params):
+        '''This sets up the hasher with the provided argon2 parameters.
+
+        engine is the :py:class:`.HashingEngine` that runs the hashes. A new one
+        that runs one hash at a time is used if this is None.
+
+        '''
+
+        self.engine = engine if engine is not None else HashingEngine()
+        self.configure(**params)
+
+    def configure(self, **params):
+        '''This sets the argon2 parameters to use for new hashes.
+
+        Hashes made with other parameters can still be verified. See
+        :py:meth:`.check_needs_rehash`.
+
+        '''
+
+        self.params = params
+        self._hasher = PasswordHasher(**params)
+
+    def hash(self, password):
+        '''
+        This hashes a password.
+
+        '''
+
+        return self.engine.run_hash(self._hasher.hash, password)
+
+    def verify(self, password_hash, password):
+        '''This verifies a password against a hash.
+
+        Raises an argon2 exception if the password doesn't match.
+
+        '''
+
+        return self.engine.run_hash(self._hasher.verify,
+                                    password_hash,
+                                    password)
+
+    def check_needs_rehash(self, password_hash):
+        '''
+        This returns True if a hash wasn't made with the current parameters.
+
+        '''
+
+        return self._hasher.check_needs_rehash(password_hash)
+
+
+# this runs the password hashes for the worker
+hashing_engine = HashingEngine()
+
+# this is the hasher used by all of the auth actions
+pass_hasher = TunablePasswordHasher(engine=hashing_engine)
+
+
+def configure_pass_hasher(passhash_spec):
+    '''This sets the parameters of the shared password hasher from a spec.
+
+    See :py:func:`.parse_passhash_params` for the spec format. Returns the
+    parsed parameters.
+
+    '''
+
+    params = parse_passhash_params(passhash_spec)
+    pass_hasher.configure(**params)
+    return params
+
+
+def configure_hashing_engine(max_threads, memory_budget_mib):
+    '''This sets how many hashes the shared password hasher runs at once.
+
+    Parameters
+    ----------
+
+    max_threads : int
+        The number of requests the worker runs at once.
+
+    memory_budget_mib : int
+        The memory in MiB that this worker's concurrent hashes can use. The
+        number of hashes that run at once is cut down to fit this at the
+        hasher's current memory cost, but at least one can always run.
+
+    Returns
+    -------
+
+    int
+        The number of hashes that can run at once.
+
+    '''
+
+    memory_cost = pass_hasher._hasher.memory_cost
+    max_concurrent = max(1, min(max_threads,
+                                memory_budget_mib*1024//memory_cost))
+    hashing_engine.configure(max_concurrent)
+    return max_concurrent
+
+
+def run_action(func, *args, **kwargs):
+    '''This runs an auth action in a worker.
+
+    Executor workers run every request through this so requests that run on
+    the same worker at once only hash passwords at the same time. See
+    :py:class:`.HashingEngine`.
+
+    '''
+
+    return hashing_engine.run_action(func, *args, **kwargs)
+
+
+#################################
+## PASSWORD HASHER CALIBRATION ##
+#################################
+
+def time_verify(params, nsamples=3):
+    '''This measures how long an argon2 verify takes with the given parameters.
+
+    Returns the median time in seconds.
+
+    '''
+
+    hasher = PasswordHasher(**params)
+    password = secrets.token_urlsafe(16)
+    password_hash = hasher.hash(password)
+
+    timings = []
+
+    for _ in range(nsamples):
+        start = time.perf_counter()
+        hasher.verify(password_hash, password)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return timings[len(timings)//2]
+
+
+def calibrate_passhash(target_seconds=0.25,
+                       memory_budget_mib=1024,
+                       concurrency=2,
+                       max_time_cost=10,
+                       min_memory_cost=8192,
+                       timer=time_verify):
+    '''This picks argon2 parameters for this machine.
+
+    The total memory used by concurrent password hashes is kept within
+    memory_budget_mib, so each hash can use at most memory_budget_mib /
+    concurrency. Each hash gets an equal share of the CPU cores, up to 4
+    lanes.
+
+    The memory cost starts at the largest power of two within the budget and
+    is halved until a verify with time_cost=1 takes less than target_seconds.
+    The time cost is then raised as long as a verify still takes less than
+    target_seconds.
+
+    Parameters
+    ----------
+
+    target_seconds : float
+        The longest a single verify should take.
+
+    memory_budget_mib : int
+        The total memory in MiB that all concurrent password hashes can use.
+
+    concurrency : int
+        The number of password hashes that can run at once, i.e. the number of
+        hashing workers times the number of hashes each runs at once.
+
+    max_time_cost : int
+        The largest time cost to try.
+
+    min_memory_cost : int
+        The smallest memory cost in KiB to try.
+
+    timer : callable
+        The function used to time a verify. It's called with a dict of argon2
+        parameters and returns the time taken in seconds.
+
+    Returns
+    -------
+
+    tuple
+        A (params, verify_seconds) tuple, where params is a dict of argon2
+        parameters and verify_seconds is how long a verify took with them.
+
+    '''
+
+    concurrency = max(1, concurrency)
+    parallelism = max(1, min(4, (os.cpu_count() or 1)//concurrency))
+
+    memory_limit = max(min_memory_cost,
+                       memory_budget_mib*1024//concurrency)
+    memory_cost = min_memory_cost
+    while memory_cost*2 <= memory_limit:
+        memory_cost *= 2
+
+    params = {'time_cost':1,
+              'memory_cost':memory_cost,
+              'parallelism':parallelism}
+    verify_seconds = timer(params)
+
+    while verify_seconds > target_seconds and memory_cost > min_memory_cost:
+        memory_cost = memory_cost//2
+        params = dict(params, memory_cost=memory_cost)
+        verify_seconds = timer(params)
+        LOGGER.info('memory_cost: %s KiB, verify: %.3f s' %
+                    (memory_cost, verify_seconds))
+
+    while params['time_cost'] < max_time_cost:
+
+        next_params = dict(params, time_cost=params['time_cost'] + 1)
+        next_seconds = timer(next_params)
+        LOGGER.info('time_cost: %s, verify: %.3f s' %
+                    (next_params['time_cost'], next_seconds))
+
+        if next_seconds > target_seconds:
+            break
+
+        params, verify_seconds = next_params, next_seconds
+
+    return params, verify_seconds
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# passpolicy.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This contains the password policy that new passwords are checked against.
+
+The policy is built once per process, usually when a background worker starts
+(see :py:func:`.configure_password_policy`), so the signup, password change,
+and password reset actions don't have to look up this server's FQDN or build
+the common password index while they're handling a request.
+
+'''
+
+#############
+## LOGGING ##
+#############
+
+import logging
+
+# get a logger
+LOGGER = logging.getLogger(__name__)
+
+
+#############
+## IMPORTS ##
+#############
+
+import socket
+
+from tornado.escape import squeeze
+from fuzzywuzzy.fuzz import QRatio
+from fuzzywuzzy.utils import full_process
+
+from . import validators
+from .breached import is_breached_password
+
+
+#######################
+## THE POLICY CONFIG ##
+#######################
+
+# these are the password policy settings that can be set in a spec, along with
+# their types and default values
+PASSPOLICY_PARAMS = {
+    'min_length':(int, 12),
+    'max_similarity':(int, 30),
+    'max_char_fraction':(float, 0.2),
+    'min_common_similarity':(float, 0.7),
+}
+
+
+def parse_password_policy(passpolicy_spec):
+    '''This parses a password policy spec.
+
+    Parameters
+    ----------
+
+    passpolicy_spec : str
+        A comma-separated list of name:value items, e.g.
+        'min_length:16,max_similarity:25'. The settings are:
+
+        - min_length: the minimum number of characters in a password
+        - max_similarity: the fuzzy match score (0 to 100) against the user's
+          name, email address, and the server's FQDN at which a password is
+          rejected
+        - max_char_fraction: the largest fraction of the password that a
+          single case-folded character can take up
+        - min_common_similarity: the n-gram similarity (0.0 to 1.0) to one of
+          the top 10k passwords at which a password is rejected
+
+        Settings that aren't in the spec use their defaults from
+        ``PASSPOLICY_PARAMS``. An empty string uses the defaults for
+        everything.
+
+    Returns
+    -------
+
+    dict
+        A dict mapping setting names to their values.
+
+    '''
+
+    params = {}
+
+    for item in passpolicy_spec.split(','):
+
+        item = item.strip()
+        if not item:
+            continue
+
+        name, _, value = item.partition(':')
+        name, value = name.strip(), value.strip()
+
+        if name not in PASSPOLICY_PARAMS:
+            raise ValueError(
+                "Unknown password policy setting: '%s'. It must be one of: "
+                "%s." % (name, ', '.join(sorted(PASSPOLICY_PARAMS)))
+            )
+
+        try:
+            params[name] = PASSPOLICY_PARAMS[name][0](value)
+        except ValueError:
+            raise ValueError(
+                "Invalid value for password policy setting %s: '%s'" %
+                (name, value)
+            )
+
+        if params[name] <= 0:
+            raise ValueError(
+                "Password policy setting %s must be more than 0." % name
+            )
+
+    for name in ('max_char_fraction', 'min_common_similarity'):
+        if params.get(name, 0.0) > 1.0:
+            raise ValueError(
+                "Password policy setting %s must be at most 1.0." % name
+            )
+
+    if params.get('max_similarity', 0) > 100:
+        raise ValueError(
+            "Password policy setting max_similarity must be at most 100."
+        )
+
+    return params
+
+
+#######################
+## THE POLICY ITSELF ##
+#######################
+
+class PasswordPolicy(object):
+    '''This checks new passwords against the server's password rules.
+
+    Everything that doesn't depend on the password being checked is worked out
+    once when the policy is made: the server's FQDN (which can need a DNS
+    lookup) and its processed form for fuzzy matching, and the n-gram index of
+    the top 10k passwords. A policy doesn't change after it's made, so it can
+    be shared by all the threads in a worker.
+
+    '''
+
+    def __init__(self,
+                 min_length=12,
+                 max_similarity=30,
+                 max_char_fraction=0.2,
+                 min_common_similarity=0.7,
+                 fqdn=None):
+        '''
+        This sets up the policy. If fqdn is None, it's looked up here.
+
+        '''
+
+        self.min_length = min_length
+        self.max_similarity = max_similarity
+        self.max_char_fraction = max_char_fraction
+        self.min_common_similarity = min_common_similarity
+
+        if fqdn is None:
+            fqdn = socket.getfqdn()
+        self.fqdn = fqdn
+        self._fqdn_processed = self._process(fqdn)
+
+        self._common_index = validators.get_common_password_index()
+
+    @staticmethod
+    def _process(value):
+        '''This prepares a string for fuzzy matching.
+
+        This is the same processing that fuzzywuzzy's UQRatio does to each of
+        its inputs, so a string only has to be processed once however many
+        strings it's compared to.
+
+        '''
+
+        return full_process(value.casefold(), force_ascii=False)
+
+    @staticmethod
+    def _similarity(processed1, processed2):
+        '''
+        This returns UQRatio for two strings prepared by :py:meth:`._process`.
+
+        '''
+
+        return QRatio(processed1, processed2,
+                      force_ascii=False, full_process=False)
+
+    def is_complex_enough(self, password):
+        '''This checks that no single character is too much of the password.
+
+        Characters are case-folded and counted in one pass over the password,
+        which stops as soon as one of them goes over max_char_fraction of the
+        password's length.
+
+        '''
+
+        length = len(password)
+        counts = {}
+
+        for char in password.lower():
+            count = counts.get(char, 0) + 1
+            if count/length > self.max_char_fraction:
+                return False
+            counts[char] = count
+
+        return True
+
+    def validate(self,
+                 full_name,
+                 email,
+                 password,
+                 min_length=None,
+                 max_match_threshold=None,
+                 min_common_similarity=None):
+        '''This validates a new password.
+
+        min_length, max_match_threshold, and min_common_similarity override
+        the policy's min_length, max_similarity, and min_common_similarity if
+        they're not None. See
+        :py:func:`authnzerver.actions.user.validate_input_password` for the
+        rules. Returns a (password_ok, messages) tuple.
+
+        '''
+
+        if min_length is None:
+            min_length = self.min_length
+        if max_match_threshold is None:
+            max_match_threshold = self.max_similarity
+        if min_common_similarity is None:
+            min_common_similarity = self.min_common_similarity
+
+        messages = []
+        casefolded = password.casefold()
+
+        # we'll ignore any repeated white space and fail immediately if the
+        # password is all white space
+        if len(squeeze(password.strip())) < min_length:
+
+            LOGGER.warning('password for new account: %s is too short' %
+                           email)
+            messages.append('Your password is too short. '
+                            'It must have at least %s characters.' %
+                            min_length)
+            passlen_ok = False
+        else:
+            passlen_ok = True
+
+        # check if the password is straight-up dumb
+        if casefolded in validators.TOP_10K_PASSWORDS:
+            LOGGER.warning('password for new account: %s is '
+                           'in top 10k passwords list' % email)
+            messages.append('Your password is on the list of the '
+                            'most common passwords and is vulnerable to '
+                            'guessing.')
+            tenk_ok = False
+        else:
+            tenk_ok = True
+
+        # check if the password is a lightly dressed-up common password, e.g.
+        # 'passwordpasswordpassword'
+        if tenk_ok:
+            similarity, _ = self._common_index.most_similar(casefolded)
+            if similarity >= min_common_similarity:
+                LOGGER.warning('password for new account: %s is too '
+                               'similar to a password in the top 10k '
+                               'passwords list' % email)
+                messages.append('Your password is too similar to one of the '
+                                'most common passwords and is vulnerable to '
+                                'guessing.')
+                tenk_ok = False
+
+        # check if the password has turned up in a data breach
+        if is_breached_password(password):
+            LOGGER.warning('password for new account: %s is '
+                           'in the breached passwords file' % email)
+            messages.append('Your password has appeared in a data breach '
+                            'and is vulnerable to guessing.')
+            breached_ok = False
+        else:
+            breached_ok = True
+
+        # check the fuzzy match against the FQDN and email address
+        processed = self._process(password)
+        fqdn_match = self._similarity(processed, self._fqdn_processed)
+        email_match = self._similarity(processed, self._process(email))
+        name_match = self._similarity(processed, self._process(full_name))
+
+        fqdn_ok = fqdn_match < max_match_threshold
+        email_ok = email_match < max_match_threshold
+        name_ok = name_match < max_match_threshold
+
+        if not fqdn_ok or not email_ok or not name_ok:
+            LOGGER.warning('password for new account: %s matches FQDN '
+                           '(similarity: %s) or their email address '
+                           '(similarity: %s)' %
+                           (email, fqdn_match, email_match))
+            messages.append('Your password is too similar to either '
+                            'the domain name of this server or your '
+                            'own name or email address.')
+
+        # next, check if the password is complex enough
+        hist_ok = self.is_complex_enough(password)
+        if not hist_ok:
+            LOGGER.warning('one character is more than '
+                           '%s x length of the password' %
+                           self.max_char_fraction)
+            messages.append(
+                'Your password is not complex enough. '
+                'One or more characters appear appear too frequently.'
+            )
+
+        # check if the password is all numeric
+        if password.isdigit():
+            numeric_ok = False
+            messages.append('Your password cannot be all numbers.')
+        else:
+            numeric_ok = True
+
+        return (
+            (passlen_ok and email_ok and name_ok and fqdn_ok and
+             hist_ok and numeric_ok and tenk_ok and breached_ok),
+            messages
+        )
+
+
+#######################
+## THE SHARED POLICY ##
+#######################
+
+# this is the password policy used by the password validator
+password_policy = None
+
+
+def configure_password_policy(passpolicy_spec, fqdn=None):
+    '''This sets the password policy used to validate new passwords.
+
+    See :py:func:`.parse_password_policy` for the spec format. Returns the
+    :py:class:`.PasswordPolicy`.
+
+    '''
+
+    global password_policy
+
+    params = {name:PASSPOLICY_PARAMS[name][1] for name in PASSPOLICY_PARAMS}
+    params.update(parse_password_policy(passpolicy_spec))
+    password_policy = PasswordPolicy(fqdn=fqdn, **params)
+
+    return password_policy
+
+
+def get_password_policy():
+    '''This returns the password policy for this process.
+
+    A policy with the default settings is made on first use if
+    :py:func:`.configure_password_policy` hasn't been called.
+
+    '''
+
+    if password_policy is None:
+        return configure_password_policy('')
+
+    return password_policy
@@ -21,18 +21,34 @@ LOGGER = logging.getLogger(__name__)
 ## IMPORTS ##
 #############
 
+import os.path
 import json
+import hashlib
 
 
 #################################
 ##  PERMISSION MODEL FUNCTIONS ##
 #################################
 
-def load_permissions_json(model_json):
-    '''Loads a permissions JSON and returns the model.'''
+def compile_permissions_model(model):
+    '''This converts the lists in a loaded permissions model dict to sets.
 
-    with open(model_json,'r') as infd:
-        model = json.load(infd)
+    Parameters
+    ----------
+
+    model : dict
+        The permissions model dict as loaded from a permissions JSON.
+
+    Returns
+    -------
+
+    dict
+        The permissions model dict with its item, role, action, and visibility
+        lists converted to sets for faster lookups and a decision table added
+        under the 'decision_table' key (see
+        :py:func:`.compile_decision_table`). The dict is modified in-place.
+
+    '''
 
     # load the item policy
     item_policy = model['item_policy']
@@ -68,9 +84,231 @@ def load_permissions_json(model_json):
     model['actions'] = set(model['actions'])
     model['visibilities'] = set(model['visibilities'])
 
+    model['decision_table'] = compile_decision_table(model)
+
+    return model
+
+
+def compile_decision_table(permissions_model):
+    '''This precomputes the allowed actions for all combinations of role,
+    item, visibility, and ownership in a permissions model.
+
+    Each action is assigned a bit, and the allowed actions for each combination
+    of (role, item, visibility, ownership) are stored as an integer bitmask in a
+    flat tuple. An access decision then only needs a few dict lookups to get the
+    indices and a bit test against the bitmask.
+
+    The bitmasks are generated using :py:func:`.get_item_actions` so they
+    always match the set-based policy decisions. The 'for_owned' bitmasks are
+    zero for items that the role can't own.
+
+    Parameters
+    ----------
+
+    permissions_model : dict
+        A permissions model with its lists converted to sets by
+        :py:func:`.compile_permissions_model`.
+
+    Returns
+    -------
+
+    dict
+        A dict of the form::
+
+            {'roles': dict mapping role names -> indices,
+             'items': dict mapping item names -> indices,
+             'visibilities': dict mapping visibility names -> indices,
+             'actions': dict mapping action names -> bits,
+             'table': tuple of int bitmasks}
+
+        The bitmask for a combination of (role, item, visibility, ownership) is
+        at index ``((role*n_items + item)*n_visibilities + visibility)*2 +
+        ownership`` in the table, with ownership = 0 for items owned by the user
+        and 1 for items owned by others.
+
+    '''
+
+    role_policy = permissions_model['role_policy']
+
+    roles = {x:i for i, x in enumerate(sorted(permissions_model['roles']))}
+    items = {x:i for i, x in enumerate(sorted(permissions_model['items']))}
+    visibilities = {
+        x:i for i, x in enumerate(sorted(permissions_model['visibilities']))
+    }
+    actions = {
+        x:(1 << i) for i, x in enumerate(sorted(permissions_model['actions']))
+    }
+
+    table = []
+
+    for role in sorted(roles, key=roles.get):
+
+        can_own_items = role_policy.get(role, {}).get('can_own_items', ())
+
+        for item in sorted(items, key=items.get):
+            for visibility in sorted(visibilities, key=visibilities.get):
+                for ownership in ('for_owned', 'for_other'):
+
+                    if ownership == 'for_owned' and item not in can_own_items:
+                        table.append(0)
+                        continue
+
+                    item_actions = get_item_actions(permissions_model,
+                                                    role,
+                                                    item,
+                                                    visibility,
+                                                    ownership)
+                    bitmask = 0
+                    for action in item_actions:
+                        bitmask |= actions.get(action, 0)
+
+                    table.append(bitmask)
+
+    return {
+        'roles':roles,
+        'items':items,
+        'visibilities':visibilities,
+        'actions':actions,
+        'table':tuple(table),
+    }
+
+
+def load_permissions_json(model_json):
+    '''Loads a permissions JSON and returns the model.'''
+
+    with open(model_json,'r') as infd:
+        model = json.load(infd)
+
+    return compile_permissions_model(model)
+
+
+#
+# this holds the compiled permissions models for the current process. these are
+# keyed by the absolute path to the permissions JSON and hold the file's mtime,
+# size, and SHA256 digest when it was last loaded.
+#
+_PERMISSIONS_MODEL_CACHE = {}
+
+# these are the hit and reload counts for the compiled permissions models
+_PERMISSIONS_MODEL_CACHE_STATS = {'hits':0, 'reloads':0, 'reload_errors':0}
+
+
+def get_permissions_model(model_json):
+    '''Returns a compiled permissions model, reloading it only if the
+    permissions JSON has changed on disk.
+
+    This does an os.stat() on the permissions JSON for every call. If the mtime
+    and size of the file match those of the cached model, the cached model is
+    returned. If not, the file is read and its SHA256 digest is compared
+    against that of the cached model. The model is only re-parsed if the
+    contents of the file have actually changed. This means that edits to the
+    permissions JSON take effect on the next call without restarting the
+    authnzerver.
+
+    The cached model is replaced in a single dict assignment after the new model
+    has been compiled fully, so callers will never see a partially loaded
+    model. If the updated permissions JSON can't be parsed (e.g. if it's caught
+    in the middle of being written), the previous model will continue to be
+    used and the reload will be retried on the next call.
+
+    Parameters
+    ----------
+
+    model_json : str
+        The path to the permissions JSON to load.
+
+    Returns
+    -------
+
+    dict
+        A permissions model as returned by :py:func:`.load_permissions_json`.
+        This is shared between callers in the same process and must not be
+        modified.
+
+    '''
+
+    model_path = os.path.abspath(model_json)
+    model_stat = os.stat(model_path)
+
+    cached = _PERMISSIONS_MODEL_CACHE.get(model_path, None)
+
+    if (cached is not None and
+        cached['mtime'] == model_stat.st_mtime_ns and
+        cached['size'] == model_stat.st_size):
+        _PERMISSIONS_MODEL_CACHE_STATS['hits'] += 1
+        return cached['model']
+
+    with open(model_path,'rb') as infd:
+        model_bytes = infd.read()
+
+    model_digest = hashlib.sha256(model_bytes).hexdigest()
+
+    # if the file was touched but its contents didn't change, keep using the
+    # existing model
+    if cached is not None and cached['digest'] == model_digest:
+        _PERMISSIONS_MODEL_CACHE[model_path] = {
+            'mtime':model_stat.st_mtime_ns,
+            'size':model_stat.st_size,
+            'digest':model_digest,
+            'model':cached['model'],
+        }
+        _PERMISSIONS_MODEL_CACHE_STATS['hits'] += 1
+        return cached['model']
+
+    try:
+        model = compile_permissions_model(json.loads(model_bytes))
+    except Exception:
+        if cached is None:
+            raise
+        LOGGER.exception('Could not reload the permissions JSON: %s, '
+                         'will continue to use the previous model.' %
+                         model_path)
+        _PERMISSIONS_MODEL_CACHE_STATS['reload_errors'] += 1
+        return cached['model']
+
+    _PERMISSIONS_MODEL_CACHE[model_path] = {
+        'mtime':model_stat.st_mtime_ns,
+        'size':model_stat.st_size,
+        'digest':model_digest,
+        'model':model,
+    }
+    _PERMISSIONS_MODEL_CACHE_STATS['reloads'] += 1
+
+    if cached is not None:
+        LOGGER.info('Reloaded changed permissions JSON: %s' % model_path)
+
     return model
 
 
+def permissions_model_cache_info():
+    '''Returns the hit and reload counts for the cached permissions models.
+
+    Returns
+    -------
+
+    dict
+        A dict of the form::
+
+            {'hits': number of calls served from the cached models,
+             'reloads': number of times a permissions JSON was (re)loaded,
+             'reload_errors': number of failed reloads of a changed JSON,
+             'models': list of paths to the cached permissions JSONs}
+
+    '''
+
+    info = dict(_PERMISSIONS_MODEL_CACHE_STATS)
+    info['models'] = sorted(_PERMISSIONS_MODEL_CACHE.keys())
+    return info
+
+
+def clear_permissions_model_cache():
+    '''Removes all cached permissions models and resets the counters.'''
+
+    _PERMISSIONS_MODEL_CACHE.clear()
+    for key in _PERMISSIONS_MODEL_CACHE_STATS:
+        _PERMISSIONS_MODEL_CACHE_STATS[key] = 0
+
+
 ##########################
 ## CHECKING PERMISSIONS ##
 ##########################
@@ -297,6 +535,30 @@ def check_item_access(permissions_model,
     if debug:
         print('target shared or owned test passed = %s' % shared_or_owned_ok)
 
+    decision_table = permissions_model.get('decision_table', None)
+
+    # use the precomputed decision table to check the action. if we're
+    # debugging, we'll go through the set-based policy checks below instead so
+    # we can see the decisions being taken.
+    if decision_table is not None and not debug:
+
+        try:
+            table_index = (
+                ((decision_table['roles'][role]*len(decision_table['items']) +
+                  decision_table['items'][target_name]) *
+                 len(decision_table['visibilities']) +
+                 decision_table['visibilities'][target_visibility])*2 +
+                (0 if userid == target_owner else 1)
+            )
+            action_bit = decision_table['actions'][action]
+        except KeyError:
+            return False
+
+        return (
+            shared_or_owned_ok and
+            (decision_table['table'][table_index] & action_bit) != 0
+        )
+
     target_may_be_owned_by_role = (
         target_name in role_policy[role]['can_own_items']
     )
@@ -347,7 +609,9 @@ def load_policy_and_check_access(
     '''
     Does a check for user access to a target item.
 
-    This version loads a permissions JSON from disk every time it is called.
+    This version loads the permissions model using
+    :py:func:`.get_permissions_model`, so the permissions JSON is only re-parsed
+    if it has changed on disk since the last call.
 
     Parameters
     ----------
@@ -388,7 +652,7 @@ def load_policy_and_check_access(
 
     '''
 
-    permissions_model = load_permissions_json(permissions_json)
+    permissions_model = get_permissions_model(permissions_json)
     return check_item_access(
         permissions_model,
         userid=userid,
@@ -486,7 +750,9 @@ def load_policy_and_check_limits(
     '''
     Applies the role limits to a value to check.
 
-    This version loads a policy JSON every time it is called.
+    This version loads the permissions model using
+    :py:func:`.get_permissions_model`, so the permissions JSON is only re-parsed
+    if it has changed on disk since the last call.
 
     Parameters
     ----------
@@ -511,10 +777,56 @@ def load_policy_and_check_limits(
 
     '''
 
-    permissions_model = load_permissions_json(permissions_json)
+    permissions_model = get_permissions_model(permissions_json)
     return check_role_limits(
         permissions_model,
         role,
         limit_name,
         value_to_check
     )
+
+
+def get_role_ratelimit(permissions_model,
+                       role,
+                       limit_name='max_requests_per_minute'):
+    '''This returns the request rate limit for a role.
+
+    The rate limit is read from the role's limits in the permissions model. The
+    limit item may have an optional "burst" key to set the number of requests
+    that can be made at once. This defaults to the per-minute limit, so a role
+    can use its whole allowance in a burst, and then has to wait for it to be
+    replenished at the per-minute rate.
+
+    Parameters
+    ----------
+
+    permissions_model : dict
+        A permissions model returned by :py:func:`.load_permissions_json`.
+
+    role : str
+        The name of the role to get the rate limit for.
+
+    limit_name : str
+        The name of the limit to use as the per-minute request rate.
+
+    Returns
+    -------
+
+    tuple or None
+        Returns a tuple of (rate_per_minute, burst). Returns None if the role
+        has no such limit.
+
+    '''
+
+    role_policy = permissions_model['role_policy'].get(role)
+    if not role_policy:
+        return None
+
+    role_limit = role_policy['limits'].get(limit_name)
+    if not role_limit:
+        return None
+
+    rate_per_minute = float(role_limit['limit'])
+    burst = int(role_limit.get('burst', rate_per_minute))
+
+    return rate_per_minute, burst
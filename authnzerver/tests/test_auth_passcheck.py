@@ -6,11 +6,16 @@ This contains tests for the auth functions in authnzerver.actions.
 '''
 
 from .. import authdb, actions
+from ..actions import session
 import os.path
 import os
+import time
 from datetime import datetime, timedelta
 import multiprocessing as mp
 
+import pytest
+from argon2 import PasswordHasher
+
 
 def get_test_authdb():
     '''This just makes a new test auth DB for each test function.
@@ -153,3 +158,96 @@ def test_passcheck():
         os.remove('test-passcheck.authdb.sqlite-wal')
     except Exception as e:
         pass
+
+
+def test_passcheck_timing(monkeypatch):
+    '''
+    This tests if rejected password checks take as long as real ones.
+
+    '''
+
+    try:
+        os.remove('test-passcheck.authdb.sqlite')
+    except Exception as e:
+        pass
+
+    get_test_authdb()
+
+    with pytest.raises(ValueError):
+        session.parse_password_timing('verify:0')
+    with pytest.raises(ValueError):
+        session.parse_password_timing('sleep:1')
+    assert session.parse_password_timing('duration') == ('duration', None)
+
+    # count the argon2 verifies
+    verifies = []
+
+    class CountingHasher(object):
+
+        def verify(self, password_hash, password):
+            verifies.append(password_hash)
+            return PasswordHasher().verify(password_hash, password)
+
+        def hash(self, password):
+            return PasswordHasher().hash(password)
+
+        def check_needs_rehash(self, password_hash):
+            return PasswordHasher().check_needs_rehash(password_hash)
+
+    monkeypatch.setattr(session, 'pass_hasher', CountingHasher())
+
+    currproc = mp.current_process()
+    currproc.password_timing = 'verify:3'
+
+    try:
+
+        assert session.prepare_password_checks(
+            override_authdb_path='sqlite:///test-passcheck.authdb.sqlite'
+        ) == ('verify', 3)
+        assert currproc.dummy_password.startswith('$argon2')
+
+        # a malformed request runs all of its verifies against the dummy hash
+        pass_check = actions.auth_password_check(
+            {'session_token':'nope'},
+            override_authdb_path='sqlite:///test-passcheck.authdb.sqlite',
+        )
+        assert pass_check['success'] is False
+        assert verifies == [currproc.dummy_password]*3
+
+        # a rejected login waits out the requested duration instead
+        currproc.password_timing = 'duration:0.2'
+        start = time.monotonic()
+        login = actions.auth_user_login(
+            {'session_token':'nope',
+             'email':'nobody@test.org',
+             'password':'nope'},
+            override_authdb_path='sqlite:///test-passcheck.authdb.sqlite',
+        )
+        assert login['success'] is False
+        assert time.monotonic() - start >= 0.2
+        assert len(verifies) == 3
+
+    finally:
+
+        for attr in ('password_timing',
+                     'password_timing_parsed',
+                     'dummy_password',
+                     'dummy_password_engine'):
+            if hasattr(currproc, attr):
+                delattr(currproc, attr)
+
+        if getattr(currproc, 'authdb_meta', None):
+            del currproc.authdb_meta
+
+        if getattr(currproc, 'authdb_conn', None):
+            currproc.authdb_conn.close()
+            del currproc.authdb_conn
+
+        if getattr(currproc, 'authdb_engine', None):
+            currproc.authdb_engine.dispose()
+            del currproc.authdb_engine
+
+        try:
+            os.remove('test-passcheck.authdb.sqlite')
+        except Exception as e:
+            pass
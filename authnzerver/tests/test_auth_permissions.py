@@ -250,6 +250,161 @@ def test_role_permissions():
         pass
 
 
+def test_role_permissions_batch():
+    '''
+    This tests if we can check the permissions for a list of items.
+
+    '''
+
+    try:
+        os.remove('test-permcheck.authdb.sqlite')
+    except Exception:
+        pass
+    try:
+        os.remove('test-permcheck.authdb.sqlite-shm')
+    except Exception:
+        pass
+    try:
+        os.remove('test-permcheck.authdb.sqlite-wal')
+    except Exception:
+        pass
+
+    get_test_authdb()
+
+    # create the user
+    user_payload = {'full_name': 'Test User',
+                    'email':'testuser-permcheck@test.org',
+                    'password':'aROwQin9L8nNtPTEMLXd'}
+    user_created = actions.create_new_user(
+        user_payload,
+        override_authdb_path='sqlite:///test-permcheck.authdb.sqlite'
+    )
+    assert user_created['success'] is True
+
+    # verify our email
+    emailverify = (
+        actions.verify_user_email_address(
+            {'email':user_payload['email'],
+             'user_id': user_created['user_id']},
+            override_authdb_path='sqlite:///test-permcheck.authdb.sqlite'
+        )
+    )
+    user_id = emailverify['user_id']
+
+    # get the permissions JSON
+    thisdir = os.path.dirname(__file__)
+    permissions_json = os.path.abspath(
+        os.path.join(thisdir, '..', 'default-permissions-model.json')
+    )
+
+    targets = [
+        # 1. a non-owned public object -> True
+        {'target_name':'object',
+         'target_owner':1,
+         'target_visibility':'public',
+         'target_sharedwith':''},
+        # 2. a non-owned private object -> False
+        {'target_name':'object',
+         'target_owner':1,
+         'target_visibility':'private',
+         'target_sharedwith':''},
+        # 3. a self-owned private dataset -> True
+        {'target_name':'dataset',
+         'target_owner':user_id,
+         'target_visibility':'private',
+         'target_sharedwith':''},
+        # 4. a non-owned dataset shared with the user -> True
+        {'target_name':'dataset',
+         'target_owner':1,
+         'target_visibility':'shared',
+         'target_sharedwith':'%s' % user_id},
+        # 5. a dataset owned by a nonexistent user -> False
+        {'target_name':'dataset',
+         'target_owner':100,
+         'target_visibility':'public',
+         'target_sharedwith':''},
+        # 6. delete a non-owned public object -> False
+        {'target_name':'object',
+         'target_owner':1,
+         'target_visibility':'public',
+         'target_sharedwith':'',
+         'action':'delete'},
+    ]
+
+    access_check = actions.check_user_access_batch(
+        {'user_id':user_id,
+         'user_role':'authenticated',
+         'action':'view',
+         'targets':targets},
+        override_authdb_path='sqlite:///test-permcheck.authdb.sqlite',
+        override_permissions_json=permissions_json,
+        raiseonfail=True,
+    )
+    assert access_check['success'] is True
+    assert access_check['access_granted'] == [
+        True, False, True, True, False, False
+    ]
+    assert (
+        "Batch access request check successful. Access granted: 3 of 6." in
+        access_check['messages']
+    )
+
+    # a user with the wrong role gets nothing
+    access_check = actions.check_user_access_batch(
+        {'user_id':user_id,
+         'user_role':'superuser',
+         'action':'view',
+         'targets':targets},
+        override_authdb_path='sqlite:///test-permcheck.authdb.sqlite',
+        override_permissions_json=permissions_json,
+        raiseonfail=True,
+    )
+    assert access_check['success'] is True
+    assert access_check['access_granted'] == [False]*6
+
+    # an empty batch is an invalid request
+    access_check = actions.check_user_access_batch(
+        {'user_id':user_id,
+         'user_role':'authenticated',
+         'action':'view',
+         'targets':[]},
+        override_authdb_path='sqlite:///test-permcheck.authdb.sqlite',
+        override_permissions_json=permissions_json,
+        raiseonfail=True,
+    )
+    assert access_check['success'] is False
+    assert access_check['access_granted'] is None
+
+    #
+    # teardown
+    #
+
+    currproc = mp.current_process()
+    if getattr(currproc, 'authdb_meta', None):
+        del currproc.authdb_meta
+
+    if getattr(currproc, 'connection', None):
+        currproc.authdb_conn.close()
+        del currproc.authdb_conn
+
+    if getattr(currproc, 'authdb_engine', None):
+        currproc.authdb_engine.dispose()
+        del currproc.authdb_engine
+
+    try:
+        os.remove('test-permcheck.authdb.sqlite')
+    except Exception:
+        pass
+    try:
+        os.remove('test-permcheck.authdb.sqlite-shm')
+    except Exception:
+        pass
+    try:
+        os.remove('test-permcheck.authdb.sqlite-wal')
+    except Exception:
+        pass
+
+
 def test_role_limits():
     '''
     This tests if we can check the permissions for a logged-in user.
@@ -5,11 +5,13 @@ This contains tests for the auth functions in authnzerver.actions.
 
 '''
 
-from .. import authdb, actions
+from .. import authdb, actions, cache
+from ..external.futures37.process import ProcessPoolExecutor
 import os.path
 import os
 from datetime import datetime, timedelta
 import multiprocessing as mp
+import time
 
 
 def get_test_authdb():
@@ -161,3 +163,342 @@ def test_sessioninfo():
         os.remove('test-sessioninfo.authdb.sqlite-wal')
     except Exception as e:
         pass
+
+
+def test_sessioninfo_cache():
+    '''
+    This tests if session lookups are cached and invalidated correctly.
+
+    '''
+
+    try:
+        os.remove('test-sessioninfo.authdb.sqlite')
+    except Exception as e:
+        pass
+    try:
+        os.remove('test-sessioninfo.authdb.sqlite-shm')
+    except Exception as e:
+        pass
+    try:
+        os.remove('test-sessioninfo.authdb.sqlite-wal')
+    except Exception as e:
+        pass
+
+    get_test_authdb()
+
+    session_payload = {
+        'user_id':2,
+        'user_agent':'Mozzarella Killerwhale',
+        'expires':datetime.utcnow()+timedelta(hours=1),
+        'ip_address': '1.1.1.1',
+        'extra_info_json':{'pref_datasets_always_private':True}
+    }
+    session_token = actions.auth_session_new(
+        session_payload,
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )['session_token']
+
+    # look up the session several times
+    for _ in range(3):
+        info_check = actions.auth_session_exists(
+            {'session_token':session_token},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )
+        assert info_check['success'] is True
+        assert info_check['session_info']['user_id'] == 2
+
+        # changing the returned dict shouldn't change the cached copy
+        info_check['session_info']['extra_info_json']['mutated'] = True
+
+    cache_info = actions.session.session_cache_info()
+    assert cache_info['misses'] == 1
+    assert cache_info['hits'] == 2
+
+    info_check = actions.auth_session_exists(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+    assert 'mutated' not in info_check['session_info']['extra_info_json']
+
+    # updating the extra info should be seen by the next lookup
+    actions.auth_session_set_extrainfo(
+        {'session_token':session_token,
+         'extra_info':{'this':'is','a':'test'}},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite',
+        raiseonfail=True
+    )
+    info_check = actions.auth_session_exists(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+    assert info_check['session_info']['extra_info_json'] == {'this':'is',
+                                                             'a':'test'}
+
+    # deleting the session should be seen by the next lookup
+    deleted = actions.auth_session_delete(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+    assert deleted['success'] is True
+
+    info_check = actions.auth_session_exists(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+    assert info_check['success'] is False
+
+    # a session about to expire shouldn't be cached past its expiry
+    session_payload['expires'] = datetime.utcnow() + timedelta(seconds=1)
+    session_token = actions.auth_session_new(
+        session_payload,
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )['session_token']
+
+    info_check = actions.auth_session_exists(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+    assert info_check['success'] is True
+
+    time.sleep(1.5)
+
+    info_check = actions.auth_session_exists(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+    assert info_check['success'] is False
+
+    currproc = mp.current_process()
+    if getattr(currproc, 'authdb_meta', None):
+        del currproc.authdb_meta
+
+    if getattr(currproc, 'connection', None):
+        currproc.authdb_conn.close()
+        del currproc.authdb_conn
+
+    if getattr(currproc, 'authdb_engine', None):
+        currproc.authdb_engine.dispose()
+        del currproc.authdb_engine
+
+    try:
+        os.remove('test-sessioninfo.authdb.sqlite')
+    except Exception as e:
+        pass
+    try:
+        os.remove('test-sessioninfo.authdb.sqlite-shm')
+    except Exception as e:
+        pass
+    try:
+        os.remove('test-sessioninfo.authdb.sqlite-wal')
+    except Exception as e:
+        pass
+
+
+def _set_worker_cache_dirname(cache_dirname):
+    '''
+    This sets the shared cache directory in a test worker.
+
+    '''
+
+    mp.current_process().cache_dirname = cache_dirname
+
+
+def _delete_session_in_worker(session_token):
+    '''
+    This deletes a session from a test worker.
+
+    '''
+
+    return actions.auth_session_delete(
+        {'session_token':session_token},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+
+
+def _delete_user_sessions_in_worker(user_id):
+    '''
+    This deletes all of a user's sessions from a test worker.
+
+    '''
+
+    return actions.auth_delete_sessions_userid(
+        {'user_id':user_id,
+         'session_token':None,
+         'keep_current_session':False},
+        override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+    )
+
+
+def test_sessioninfo_cache_other_process(tmpdir):
+    '''
+    This tests if deleting a session in another worker is seen by lookups.
+
+    '''
+
+    for ext in ('', '-shm', '-wal'):
+        try:
+            os.remove('test-sessioninfo.authdb.sqlite%s' % ext)
+        except Exception:
+            pass
+
+    get_test_authdb()
+
+    currproc = mp.current_process()
+    currproc.cache_dirname = str(tmpdir)
+
+    executor = ProcessPoolExecutor(max_workers=1,
+                                   initializer=_set_worker_cache_dirname,
+                                   initargs=(str(tmpdir),))
+
+    def new_cached_session():
+        session_token = actions.auth_session_new(
+            {'user_id':2,
+             'user_agent':'Mozzarella Killerwhale',
+             'expires':datetime.utcnow()+timedelta(hours=1),
+             'ip_address': '1.1.1.1',
+             'extra_info_json':{}},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )['session_token']
+
+        for _ in range(2):
+            info_check = actions.auth_session_exists(
+                {'session_token':session_token},
+                override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+            )
+            assert info_check['success'] is True
+
+        return session_token
+
+    def session_exists(session_token):
+        return actions.auth_session_exists(
+            {'session_token':session_token},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )['success']
+
+    try:
+
+        # delete a session cached in this process from the worker
+        session_token = new_cached_session()
+        hits = actions.session.session_cache_info()['hits']
+        assert hits >= 1
+
+        deleted = executor.submit(_delete_session_in_worker,
+                                  session_token).result()
+        assert deleted['success'] is True
+        time.sleep(actions.session.SESSION_CACHE_GENERATION_CHECK_SECONDS)
+        assert session_exists(session_token) is False
+
+        # delete all of the user's sessions from the worker, like a logout
+        # from everywhere or a user lock would
+        session_token = new_cached_session()
+        deleted = executor.submit(_delete_user_sessions_in_worker,
+                                  2).result()
+        assert deleted['success'] is True
+        time.sleep(actions.session.SESSION_CACHE_GENERATION_CHECK_SECONDS)
+        assert session_exists(session_token) is False
+
+    finally:
+
+        executor.shutdown(wait=True)
+        del currproc.cache_dirname
+
+        if getattr(currproc, 'authdb_meta', None):
+            del currproc.authdb_meta
+
+        if getattr(currproc, 'connection', None):
+            currproc.authdb_conn.close()
+            del currproc.authdb_conn
+
+        if getattr(currproc, 'authdb_engine', None):
+            currproc.authdb_engine.dispose()
+            del currproc.authdb_engine
+
+        for ext in ('', '-shm', '-wal'):
+            try:
+                os.remove('test-sessioninfo.authdb.sqlite%s' % ext)
+            except Exception:
+                pass
+
+
+def test_sessioninfo_cache_unknown_delete(tmpdir):
+    '''
+    This tests if deleting an unknown session leaves every worker's cache be.
+
+    '''
+
+    for ext in ('', '-shm', '-wal'):
+        try:
+            os.remove('test-sessioninfo.authdb.sqlite%s' % ext)
+        except Exception:
+            pass
+
+    get_test_authdb()
+
+    currproc = mp.current_process()
+    currproc.cache_dirname = str(tmpdir)
+
+    def generation():
+        return cache.cache_get_generation(
+            actions.session.SESSION_CACHE_GENERATION_KEY,
+            cache_dirname=str(tmpdir)
+        )
+
+    try:
+
+        session_token = actions.auth_session_new(
+            {'user_id':2,
+             'user_agent':'Mozzarella Killerwhale',
+             'expires':datetime.utcnow()+timedelta(hours=1),
+             'ip_address': '1.1.1.1',
+             'extra_info_json':{}},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )['session_token']
+        assert actions.auth_session_exists(
+            {'session_token':session_token},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )['success'] is True
+        start_generation = generation()
+
+        # the fake delete run by rejected logins
+        deleted = actions.auth_session_delete(
+            {'session_token':'nope'},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )
+        assert deleted['success'] is True
+        assert generation() == start_generation
+
+        hits = actions.session.session_cache_info()['hits']
+        assert actions.auth_session_exists(
+            {'session_token':session_token},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )['success'] is True
+        assert actions.session.session_cache_info()['hits'] == hits + 1
+
+        # a real delete bumps the generation
+        deleted = actions.auth_session_delete(
+            {'session_token':session_token},
+            override_authdb_path='sqlite:///test-sessioninfo.authdb.sqlite'
+        )
+        assert deleted['success'] is True
+        assert generation() == start_generation + 1
+
+    finally:
+
+        del currproc.cache_dirname
+
+        if getattr(currproc, 'authdb_meta', None):
+            del currproc.authdb_meta
+
+        if getattr(currproc, 'connection', None):
+            currproc.authdb_conn.close()
+            del currproc.authdb_conn
+
+        if getattr(currproc, 'authdb_engine', None):
+            currproc.authdb_engine.dispose()
+            del currproc.authdb_engine
+
+        for ext in ('', '-shm', '-wal'):
+            try:
+                os.remove('test-sessioninfo.authdb.sqlite%s' % ext)
+            except Exception:
+                pass
@@ -0,0 +1,385 @@
+'''test_auth_userstatus.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the per-worker user status cache used by the access and
+limit checks.
+
+'''
+
+from .. import authdb, actions
+from ..cache import MemoryCache
+from ..actions import access
+from ..external.futures37.process import ProcessPoolExecutor
+import os.path
+import os
+import multiprocessing as mp
+import time
+
+
+def get_test_authdb():
+    '''This just makes a new test auth DB for each test function.
+
+    '''
+
+    authdb.create_sqlite_authdb('test-userstatus.authdb.sqlite')
+    authdb.initial_authdb_inserts('sqlite:///test-userstatus.authdb.sqlite')
+
+
+def remove_test_authdb():
+    '''
+    This removes the test auth DB files.
+
+    '''
+
+    try:
+        os.remove('test-userstatus.authdb.sqlite')
+    except Exception:
+        pass
+    try:
+        os.remove('test-userstatus.authdb.sqlite-shm')
+    except Exception:
+        pass
+    try:
+        os.remove('test-userstatus.authdb.sqlite-wal')
+    except Exception:
+        pass
+
+
+def test_memory_cache():
+    '''
+    This tests the expiry and LRU eviction of the in-memory cache.
+
+    '''
+
+    now = [1000.0]
+    cache = MemoryCache(maxsize=2, ttl_seconds=10.0, timer=lambda: now[0])
+
+    cache.set('a', 1)
+    cache.set('b', 2, expires_at=1005.0)
+    assert cache.get('a') == 1
+    assert cache.get('b') == 2
+
+    # b expires at the earlier of its TTL and expires_at
+    now[0] = 1006.0
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    # a is now the most recently used item so c should evict b
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert 'a' in cache
+    assert cache.info()['evictions'] == 1
+
+    assert cache.pop_matching(lambda k, v: v > 1) == 1
+    assert len(cache) == 1
+
+    now[0] = 1020.0
+    assert cache.get('a') is None
+
+    info = cache.info()
+    assert info['hits'] == 4
+    assert info['misses'] == 2
+
+
+def test_user_status_cache():
+    '''
+    This tests if locking a user is seen by the access checks.
+
+    '''
+
+    remove_test_authdb()
+    get_test_authdb()
+
+    # create the user
+    user_payload = {'full_name':'Test User',
+                    'email':'testuser-userstatus@test.org',
+                    'password':'aROwQin9L8nNtPTEMLXd'}
+    user_created = actions.create_new_user(
+        user_payload,
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+    )
+    assert user_created['success'] is True
+
+    # verify our email
+    emailverify = (
+        actions.verify_user_email_address(
+            {'email':user_payload['email'],
+             'user_id': user_created['user_id']},
+            override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+        )
+    )
+    assert emailverify['success'] is True
+    user_id = emailverify['user_id']
+
+    thisdir = os.path.dirname(__file__)
+    permissions_json = os.path.abspath(
+        os.path.join(thisdir, '..', 'default-permissions-model.json')
+    )
+
+    access_payload = {'user_id':user_id,
+                      'user_role':'authenticated',
+                      'action':'view',
+                      'target_name':'apikey',
+                      'target_owner':user_id,
+                      'target_visibility':'private',
+                      'target_sharedwith':''}
+
+    for _ in range(3):
+        access_check = actions.check_user_access(
+            access_payload,
+            override_permissions_json=permissions_json,
+            override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+        )
+        assert access_check['success'] is True
+
+    # the user's status should only have been looked up once
+    cache_info = access.user_status_cache_info()
+    assert cache_info['misses'] == 1
+    assert cache_info['hits'] == 2
+
+    # lock the user
+    user_locked = actions.internal_toggle_user_lock(
+        {'target_userid': user_id,
+         'action': 'lock'},
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite',
+        raiseonfail=True
+    )
+    assert user_locked['success'] is True
+
+    # the access and limit checks should fail immediately
+    access_check = actions.check_user_access(
+        access_payload,
+        override_permissions_json=permissions_json,
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+    )
+    assert access_check['success'] is False
+
+    limit_check = actions.check_user_limit(
+        {'user_id':user_id,
+         'user_role':'authenticated',
+         'limit_name':'max_requests',
+         'value_to_check':10},
+        override_permissions_json=permissions_json,
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+    )
+    assert limit_check['success'] is False
+
+    # unlock the user
+    user_unlocked = actions.internal_toggle_user_lock(
+        {'target_userid': user_id,
+         'action': 'unlock'},
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite',
+        raiseonfail=True
+    )
+    assert user_unlocked['success'] is True
+
+    access_check = actions.check_user_access(
+        access_payload,
+        override_permissions_json=permissions_json,
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+    )
+    assert access_check['success'] is True
+
+    currproc = mp.current_process()
+    if getattr(currproc, 'authdb_meta', None):
+        del currproc.authdb_meta
+
+    if getattr(currproc, 'connection', None):
+        currproc.authdb_conn.close()
+        del currproc.authdb_conn
+
+    if getattr(currproc, 'authdb_engine', None):
+        currproc.authdb_engine.dispose()
+        del currproc.authdb_engine
+
+    remove_test_authdb()
+
+
+def _set_worker_cache_dirname(cache_dirname):
+    '''
+    This sets the shared cache directory in a test worker.
+
+    '''
+
+    mp.current_process().cache_dirname = cache_dirname
+
+
+def _lock_user_in_worker(user_id, action):
+    '''
+    This locks or unlocks a user from a test worker.
+
+    '''
+
+    return actions.internal_toggle_user_lock(
+        {'target_userid': user_id,
+         'action': action},
+        override_authdb_path='sqlite:///test-userstatus.authdb.sqlite',
+        raiseonfail=True
+    )
+
+
+def test_memory_cache_generations():
+    '''
+    This tests if the in-memory cache is cleared when its generation changes.
+
+    '''
+
+    cache = MemoryCache(maxsize=10, ttl_seconds=10.0)
+
+    cache.sync_generation(0)
+    cache.set('a', 1)
+    cache.sync_generation(0)
+    assert cache.get('a') == 1
+
+    # another process bumped the generation
+    cache.sync_generation(1)
+    assert cache.get('a') is None
+
+    # this process bumped it and nobody else did
+    cache.set('a', 1)
+    cache.advance_generation(2)
+    assert cache.generation == 2
+    assert cache.get('a') == 1
+
+    # someone else bumped it in between
+    cache.advance_generation(4)
+    assert cache.generation is None
+    assert cache.get('a') is None
+    assert cache.generation_sync_due(1.0) is True
+
+    # nothing is kept if the generation can't be read
+    cache.sync_generation(None)
+    cache.set('a', 1)
+    cache.sync_generation(None)
+    assert cache.get('a') is None
+
+
+def test_memory_cache_generation_sync_due():
+    '''
+    This tests if the shared generation is only read again after an interval.
+
+    '''
+
+    now = [100.0]
+    cache = MemoryCache(maxsize=10, ttl_seconds=10.0, timer=lambda: now[0])
+
+    assert cache.generation_sync_due(0.25) is True
+    cache.sync_generation(3)
+    assert cache.generation_sync_due(0.25) is False
+
+    now[0] += 0.1
+    assert cache.generation_sync_due(0.25) is False
+
+    now[0] += 0.15
+    assert cache.generation_sync_due(0.25) is True
+    cache.sync_generation(3)
+    assert cache.generation_sync_due(0.25) is False
+
+    # the generation is read every time while it can't be read
+    cache.sync_generation(None)
+    assert cache.generation_sync_due(0.25) is True
+
+
+def test_user_status_cache_other_process(tmpdir):
+    '''
+    This tests if locking a user in another worker is seen by the access checks.
+
+    '''
+
+    remove_test_authdb()
+    get_test_authdb()
+
+    currproc = mp.current_process()
+    currproc.cache_dirname = str(tmpdir)
+
+    executor = ProcessPoolExecutor(max_workers=1,
+                                   initializer=_set_worker_cache_dirname,
+                                   initargs=(str(tmpdir),))
+
+    try:
+
+        user_payload = {'full_name':'Test User',
+                        'email':'testuser-userstatus@test.org',
+                        'password':'aROwQin9L8nNtPTEMLXd'}
+        user_created = actions.create_new_user(
+            user_payload,
+            override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+        )
+        assert user_created['success'] is True
+
+        emailverify = actions.verify_user_email_address(
+            {'email':user_payload['email'],
+             'user_id': user_created['user_id']},
+            override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+        )
+        assert emailverify['success'] is True
+        user_id = emailverify['user_id']
+
+        thisdir = os.path.dirname(__file__)
+        permissions_json = os.path.abspath(
+            os.path.join(thisdir, '..', 'default-permissions-model.json')
+        )
+
+        access_payload = {'user_id':user_id,
+                          'user_role':'authenticated',
+                          'action':'view',
+                          'target_name':'apikey',
+                          'target_owner':user_id,
+                          'target_visibility':'private',
+                          'target_sharedwith':''}
+
+        # cache the user's status in this process
+        for _ in range(2):
+            access_check = actions.check_user_access(
+                access_payload,
+                override_permissions_json=permissions_json,
+                override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+            )
+            assert access_check['success'] is True
+        assert access.user_status_cache_info()['hits'] >= 1
+
+        # lock the user in the worker
+        user_locked = executor.submit(_lock_user_in_worker,
+                                      user_id, 'lock').result()
+        assert user_locked['success'] is True
+        time.sleep(access.USER_STATUS_CACHE_GENERATION_CHECK_SECONDS)
+
+        # this process should see it on the next check
+        access_check = actions.check_user_access(
+            access_payload,
+            override_permissions_json=permissions_json,
+            override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+        )
+        assert access_check['success'] is False
+
+        user_unlocked = executor.submit(_lock_user_in_worker,
+                                        user_id, 'unlock').result()
+        assert user_unlocked['success'] is True
+        time.sleep(access.USER_STATUS_CACHE_GENERATION_CHECK_SECONDS)
+
+        access_check = actions.check_user_access(
+            access_payload,
+            override_permissions_json=permissions_json,
+            override_authdb_path='sqlite:///test-userstatus.authdb.sqlite'
+        )
+        assert access_check['success'] is True
+
+    finally:
+
+        executor.shutdown(wait=True)
+        del currproc.cache_dirname
+
+        if getattr(currproc, 'authdb_meta', None):
+            del currproc.authdb_meta
+
+        if getattr(currproc, 'connection', None):
+            currproc.authdb_conn.close()
+            del currproc.authdb_conn
+
+        if getattr(currproc, 'authdb_engine', None):
+            currproc.authdb_engine.dispose()
+            del currproc.authdb_engine
+
+        remove_test_authdb()
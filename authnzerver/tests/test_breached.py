@@ -0,0 +1,111 @@
+'''test_breached.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the breached passwords check in authnzerver.breached.
+
+'''
+
+import hashlib
+
+import pytest
+
+from .. import breached
+from ..actions.user import validate_input_password
+
+
+BREACHED = ['aROwQin9L8nNtPTEMLXd',
+            'ponylithiumfastener',
+            'correct horse battery staple',
+            'hunter2hunter2hunter2']
+
+
+def write_dump(path, passwords, counts=None, ordered=True):
+    '''
+    This writes a text dump of SHA-1 hashes like the breach corpus ones.
+
+    '''
+
+    hashes = [hashlib.sha1(x.encode('utf-8')).hexdigest().upper()
+              for x in passwords]
+    if counts is None:
+        counts = [10]*len(hashes)
+
+    lines = sorted('%s:%s' % (x, y) for x, y in zip(hashes, counts))
+    if not ordered:
+        lines.reverse()
+
+    with open(path, 'w') as outfd:
+        outfd.write('\r\n'.join(lines))
+
+
+def test_breached_password_file(tmp_path):
+    '''
+    This tests building and checking a breached passwords file.
+
+    '''
+
+    dump = str(tmp_path / 'dump.txt')
+    outfile = str(tmp_path / 'breached.bin')
+
+    # the low-count hash is left out and the duplicate is only written once
+    write_dump(dump,
+               BREACHED + ['rarely-used-password', BREACHED[0]],
+               counts=[10, 10, 10, 10, 1, 10])
+    assert breached.build_breached_password_file(dump,
+                                                 outfile,
+                                                 min_count=2) == 4
+
+    breached_file = breached.BreachedPasswordFile(outfile)
+
+    try:
+        assert len(breached_file) == 4
+        assert all(x in breached_file for x in BREACHED)
+        assert 'rarely-used-password' not in breached_file
+        assert 'a password nobody has ever used' not in breached_file
+        assert 'aROwQin9L8nNtPTEMLXD' not in breached_file
+    finally:
+        breached_file.close()
+
+    # hashes that aren't sorted are turned away
+    write_dump(dump, BREACHED, ordered=False)
+    with pytest.raises(ValueError):
+        breached.build_breached_password_file(dump, outfile)
+
+    # so are files that aren't breached passwords files
+    with pytest.raises(ValueError):
+        breached.BreachedPasswordFile(dump)
+
+
+def test_validate_breached_password(tmp_path):
+    '''
+    This tests if new passwords found in a breach are rejected.
+
+    '''
+
+    dump = str(tmp_path / 'dump.txt')
+    outfile = str(tmp_path / 'breached.bin')
+    write_dump(dump, BREACHED)
+    breached.build_breached_password_file(dump, outfile)
+
+    password = 'aROwQin9L8nNtPTEMLXd'
+
+    passok, messages = validate_input_password('Test User',
+                                               'testuser@test.org',
+                                               password,
+                                               max_match_threshold=30)
+    assert passok is True
+
+    try:
+        breached.load_breached_passwords(outfile)
+        passok, messages = validate_input_password('Test User',
+                                                   'testuser@test.org',
+                                                   password,
+                                               max_match_threshold=30)
+        assert passok is False
+        assert ('Your password has appeared in a data breach '
+                'and is vulnerable to guessing.' in messages)
+    finally:
+        breached.load_breached_passwords('')
+
+    assert breached.breached_passwords is None
+    assert breached.is_breached_password(password) is False
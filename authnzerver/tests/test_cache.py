@@ -0,0 +1,555 @@
+'''test_cache.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the cache functions in authnzerver.cache.
+
+'''
+
+import os.path
+import json
+import asyncio
+
+import pytest
+from cryptography.fernet import Fernet
+import tornado.web
+from tornado import gen
+from tornado.httputil import HTTPServerRequest
+
+from .. import cache, frontendbase, handlers, permissions
+
+
+def test_cache_handle_reuse(tmpdir):
+    '''
+    This tests if the cache functions reuse a single cache handle.
+
+    '''
+
+    cache_dirname = str(tmpdir.join('authnzerver-cache'))
+
+    handle = cache.get_cache_handle(cache_dirname)
+    assert cache.get_cache_handle(cache_dirname) is handle
+
+    assert cache.cache_add('test-key', 'test-value',
+                           cache_dirname=cache_dirname) is True
+    assert cache.cache_get('test-key', cache_dirname=cache_dirname) == (
+        'test-value'
+    )
+    assert cache.get_cache_handle(cache_dirname) is handle
+
+    assert cache.cache_increment('rate-key', cache_dirname=cache_dirname) == 1
+    assert cache.cache_increment('rate-key', cache_dirname=cache_dirname) == 2
+    rate, count, inserted = cache.cache_getrate('rate-key',
+                                                cache_dirname=cache_dirname)
+    assert count == 2
+    assert rate > 0.0
+    assert inserted is not None
+
+    rate, count, inserted = cache.cache_getrate('unknown-key',
+                                                cache_dirname=cache_dirname)
+    assert (rate, count, inserted) == (0.0, 0, None)
+
+    assert cache.cache_decrement('rate-key', cache_dirname=cache_dirname) == 1
+    assert cache.cache_pop('test-key', cache_dirname=cache_dirname) == (
+        'test-value'
+    )
+
+    # closing all the handles should give us a new handle next time
+    cache.cache_close_all()
+    new_handle = cache.get_cache_handle(cache_dirname)
+    assert new_handle is not handle
+    assert cache.cache_get('rate-key-counter',
+                           cache_dirname=cache_dirname) == 1
+
+    assert cache.cache_flush(cache_dirname=cache_dirname) == 2
+    cache.cache_close_all()
+
+
+def test_gcra_check():
+    '''
+    This tests the GCRA rate limit decisions.
+
+    '''
+
+    # 60 requests per minute with a burst of 5
+    tat = None
+    for ind in range(5):
+        ratelimit = cache.gcra_check(tat, 1000.0, 60, burst=5)
+        assert ratelimit['allowed'] is True
+        assert ratelimit['remaining'] == 4 - ind
+        tat = ratelimit['theoretical_arrival']
+
+    # the burst is used up
+    ratelimit = cache.gcra_check(tat, 1000.0, 60, burst=5)
+    assert ratelimit['allowed'] is False
+    assert abs(ratelimit['retry_after'] - 1.0) < 1.0e-6
+    assert ratelimit['theoretical_arrival'] == tat
+
+    # one request is replenished per second
+    ratelimit = cache.gcra_check(tat, 1001.0, 60, burst=5)
+    assert ratelimit['allowed'] is True
+    assert ratelimit['remaining'] == 0
+
+    # a long idle period only replenishes the burst
+    ratelimit = cache.gcra_check(tat, 5000.0, 60, burst=5)
+    assert ratelimit['allowed'] is True
+    assert ratelimit['remaining'] == 4
+
+    # a zero rate never allows anything
+    ratelimit = cache.gcra_check(None, 1000.0, 0, burst=0)
+    assert ratelimit['allowed'] is False
+
+
+def test_cache_ratelimit_role(tmpdir):
+    '''
+    This tests the rate limits read from the permissions model.
+
+    '''
+
+    cache_dirname = str(tmpdir.join('authnzerver-cache'))
+    permissions_json = os.path.abspath(
+        os.path.join(os.path.dirname(__file__),
+                     '..', 'default-permissions-model.json')
+    )
+    permissions_model = permissions.load_permissions_json(permissions_json)
+
+    rate_per_minute, burst = permissions.get_role_ratelimit(
+        permissions_model, 'anonymous'
+    )
+    assert permissions.get_role_ratelimit(permissions_model,
+                                          'anonymous',
+                                          limit_name='unknown') is None
+
+    for ind in range(burst):
+        ratelimit = cache.cache_ratelimit_role(
+            'session-token-1',
+            'anonymous',
+            permissions_json,
+            cost=1,
+            cache_dirname=cache_dirname
+        )
+        assert ratelimit['allowed'] is True
+
+    ratelimit = cache.cache_ratelimit_role(
+        'session-token-1',
+        'anonymous',
+        permissions_json,
+        cache_dirname=cache_dirname
+    )
+    assert ratelimit['allowed'] is False
+    assert ratelimit['retry_after'] > 0.0
+
+    # other keys have their own limit
+    ratelimit = cache.cache_ratelimit_role(
+        'session-token-2',
+        'anonymous',
+        permissions_json,
+        cache_dirname=cache_dirname
+    )
+    assert ratelimit['allowed'] is True
+    assert ratelimit['remaining'] == burst - 1
+
+    cache.cache_close_all()
+
+
+def test_memory_ratelimiter():
+    '''
+    This tests the in-memory rate limiter and the ratelimit-check request.
+
+    '''
+
+    now = [1000.0]
+    ratelimiter = cache.MemoryRateLimiter(maxsize=10, timer=lambda: now[0])
+
+    for ind in range(3):
+        assert ratelimiter.check('key', 60, burst=3)['allowed'] is True
+    assert ratelimiter.check('key', 60, burst=3)['allowed'] is False
+
+    # keys are dropped once their burst is replenished
+    now[0] = 1003.0
+    assert 'key' not in ratelimiter.theoretical_arrivals
+    assert ratelimiter.check('key', 60, burst=3)['remaining'] == 2
+
+    info = ratelimiter.info()
+    assert info['allowed'] == 4
+    assert info['limited'] == 1
+
+    permissions_json = os.path.abspath(
+        os.path.join(os.path.dirname(__file__),
+                     '..', 'default-permissions-model.json')
+    )
+
+    response = handlers.ratelimit_check(
+        {'key_type':'session',
+         'key':'session-token-1',
+         'user_role':'locked'},
+        ratelimiter,
+        permissions_json
+    )
+    assert response['success'] is False
+    assert response['retry_after'] > 0.0
+
+    response = handlers.ratelimit_check(
+        {'key_type':'ip',
+         'key':'1.2.3.4'},
+        ratelimiter,
+        permissions_json
+    )
+    assert response['success'] is True
+    assert response['remaining'] == 599
+
+    response = handlers.ratelimit_check(
+        {'key_type':'cookie',
+         'key':'1.2.3.4'},
+        ratelimiter,
+        permissions_json
+    )
+    assert response['success'] is False
+    assert response['allowed'] is False
+
+
+def test_frontend_ratelimiter_sync(tmpdir):
+    '''
+    This tests if in-process rate limiters see each other's requests.
+
+    '''
+
+    cache_dirname = str(tmpdir.join('authnzerver-cache'))
+
+    # make a permissions model with a small burst for anonymous users
+    with open(os.path.join(os.path.dirname(__file__),
+                           '..', 'default-permissions-model.json'),'r') as infd:
+        model_dict = json.load(infd)
+    model_dict['role_policy']['anonymous']['limits'][
+        'max_requests_per_minute'
+    ] = {"type": "max", "limit": 60, "burst": 5}
+
+    permissions_json = str(tmpdir.join('test-permissions-model.json'))
+    with open(permissions_json,'w') as outfd:
+        json.dump(model_dict, outfd)
+
+    # these are two frontend processes sharing the same cache
+    limiter1 = frontendbase.FrontendRateLimiter(permissions_json,
+                                                cache_dirname=cache_dirname)
+    limiter2 = frontendbase.FrontendRateLimiter(permissions_json,
+                                                cache_dirname=cache_dirname)
+
+    for _ in range(3):
+        assert limiter1.check_request('ip:1.2.3.4',
+                                      'anonymous')['allowed'] is True
+    assert limiter2.check_request('ip:1.2.3.4',
+                                  'anonymous')['remaining'] == 4
+
+    asyncio.run(limiter1.sync())
+    assert limiter1.pending == {}
+    asyncio.run(limiter2.sync())
+
+    # the second limiter should now know about all four requests
+    assert limiter2.check_request('ip:1.2.3.4',
+                                  'anonymous')['allowed'] is True
+    assert limiter2.check_request('ip:1.2.3.4',
+                                  'anonymous')['allowed'] is False
+
+    # roles with no limit are always allowed and aren't synced
+    assert limiter1.check_request('ip:1.2.3.4',
+                                  'anonymous-admin')['allowed'] is True
+    assert 'ip:1.2.3.4' not in limiter1.pending
+
+    cache.cache_close_all()
+    permissions.clear_permissions_model_cache()
+
+
+class _FakeConnection(object):
+    '''
+    This stands in for the HTTP connection of a request that's never sent.
+
+    '''
+
+    def set_close_callback(self, callback):
+        pass
+
+
+class _RatelimitTestHandler(frontendbase.BaseHandler):
+    '''
+    This is a BaseHandler that gets a canned ratelimit-check response.
+
+    '''
+
+    def initialize(self, ratelimit_response):
+        self.ratelimiter = None
+        self.user_role = 'anonymous'
+        self.ratelimit_response = ratelimit_response
+
+    @gen.coroutine
+    def authnzerver_request(self, request_type, request_body):
+        resp = self.ratelimit_response
+        return resp['success'], resp, resp['messages']
+
+
+def test_frontend_ratelimit_failures():
+    '''
+    This tests the 429 responses for rate limited and failed checks.
+
+    '''
+
+    app = tornado.web.Application()
+
+    def check(ratelimit_response):
+
+        handler = _RatelimitTestHandler(
+            app,
+            HTTPServerRequest(method='GET', uri='/',
+                              connection=_FakeConnection()),
+            ratelimit_response=ratelimit_response
+        )
+
+        async def run_check():
+            await handler.check_ratelimit('ip', '1.2.3.4')
+
+        with pytest.raises(tornado.web.Finish):
+            asyncio.run(run_check())
+
+        return handler
+
+    # over the limit
+    handler = check({'success':False,
+                     'allowed':False,
+                     'retry_after':1.2,
+                     'messages':[]})
+    assert handler.get_status() == 429
+    assert handler._headers['Retry-After'] == '2'
+
+    # an invalid request doesn't have a retry_after
+    handler = check(handlers.ratelimit_check({}, None, None))
+    assert handler.get_status() == 429
+    assert 'Retry-After' not in handler._headers
+
+
+def test_replay_cache(tmpdir):
+    '''
+    This tests rejecting replayed and stale request IDs.
+
+    '''
+
+    now = [1000.0]
+    replay_cache = cache.ReplayCache(window_seconds=10.0,
+                                     max_clock_skew=5.0,
+                                     maxsize=100,
+                                     timer=lambda: now[0])
+
+    assert replay_cache.check(1, 1000.0) == 'fresh'
+    assert replay_cache.check(2, 995.0) == 'fresh'
+    assert replay_cache.check(1, 1000.0) == 'replayed'
+    assert replay_cache.check(3, 989.0) == 'stale'
+    assert replay_cache.check(4, 1006.0) == 'stale'
+
+    # request IDs are forgotten once their requests are too old to be accepted
+    now[0] = 1006.0
+    assert replay_cache.check(2, 995.0) == 'stale'
+    assert len(replay_cache) == 1
+    assert replay_cache.check(1, 1000.0) == 'replayed'
+
+    now[0] = 2000.0
+    assert len(replay_cache) == 1
+    assert replay_cache.check(1, 2000.0) == 'fresh'
+    assert len(replay_cache) == 1
+
+    # if the cache is full, the oldest slots are dropped and their requests
+    # become stale instead of replayable
+    replay_cache = cache.ReplayCache(window_seconds=10.0,
+                                     maxsize=2,
+                                     timer=lambda: now[0])
+    assert replay_cache.check('a', 1995.0) == 'fresh'
+    assert replay_cache.check('b', 1997.0) == 'fresh'
+    assert replay_cache.check('c', 1999.0) == 'fresh'
+    assert replay_cache.check('a', 1995.0) == 'stale'
+    assert replay_cache.check('b', 1997.0) == 'replayed'
+
+    info = replay_cache.info()
+    assert info['evicted'] == 1
+    assert info['size'] == 2
+    assert info['accepted'] == 3
+
+    # a shared cache lets other processes see the request IDs
+    cache_dirname = str(tmpdir.join('replay-cache'))
+    first = cache.ReplayCache(window_seconds=10.0,
+                              timer=lambda: now[0],
+                              cache_dirname=cache_dirname)
+    second = cache.ReplayCache(window_seconds=10.0,
+                               timer=lambda: now[0],
+                               cache_dirname=cache_dirname)
+    assert first.check(12345, 2000.0) == 'fresh'
+    assert second.check(12345, 2000.0) == 'replayed'
+    assert second.check(12345, 1980.0) == 'stale'
+
+
+def test_failed_login_tracker():
+    '''
+    This tests locking out keys after failed logins.
+
+    '''
+
+    now = [1000.0]
+    tracker = cache.FailedLoginTracker(maxsize=100,
+                                       half_life_seconds=60.0,
+                                       timer=lambda: now[0])
+
+    keys = ['email:test@example.com', 'ip:1.2.3.4']
+    assert tracker.check(keys) == 0.0
+
+    # lockouts increase with each failure
+    assert tracker.record_failure(keys) == 1.0
+    assert tracker.check(keys) == 1.0
+    assert tracker.check(['email:other@example.com']) == 0.0
+
+    now[0] += 1.0
+    assert tracker.check(keys) == 0.0
+    assert tracker.record_failure(keys) > 1.4
+    now[0] += 2.0
+    assert tracker.record_failure(keys) > 2.0
+
+    # the IP address is still locked out after the email's successful login
+    tracker.record_success(['email:test@example.com'])
+    assert tracker.check(['email:test@example.com']) == 0.0
+    assert tracker.check(['ip:1.2.3.4']) > 2.0
+
+    # failures decay away
+    now[0] += 3600.0
+    assert tracker.check(keys) == 0.0
+    assert len(tracker) == 0
+
+    # lockouts are capped
+    for _ in range(20):
+        retry_after = tracker.record_failure(['ip:5.6.7.8'])
+    assert retry_after == 40.0
+
+    # memory is bounded no matter how many emails are tried
+    for ind in range(100000):
+        tracker.record_failure(['email:user%s@example.com' % ind,
+                                'ip:5.6.7.8'])
+    assert len(tracker) == 100
+
+    info = tracker.info()
+    assert info['failures'] == 100023
+    assert info['keys'] == 100
+    assert info['evictions'] > 0
+    assert tracker.check(['ip:5.6.7.8']) == 40.0
+
+
+def test_frontend_shared_client():
+    '''
+    This tests if handlers on an IOLoop share one authnzerver client.
+
+    '''
+
+    secret = Fernet.generate_key()
+
+    async def get_clients():
+        return (
+            frontendbase.get_authnzerver_client('http://127.0.0.1:13431',
+                                                secret,
+                                                {'max_clients':10}),
+            frontendbase.get_authnzerver_client('http://127.0.0.1:13431',
+                                                secret),
+            frontendbase.get_authnzerver_client('http://127.0.0.1:13432',
+                                                secret),
+        )
+
+    client1, client2, client3 = asyncio.run(get_clients())
+
+    assert client1 is client2
+    assert client1.max_in_flight == 10
+    assert client3 is not client1
+
+    # both clients share the IOLoop's HTTP client
+    assert client3.httpclient is client1.httpclient
+    assert client1.owns_httpclient is False
+
+    # a new IOLoop gets its own client
+    client4, _, _ = asyncio.run(get_clients())
+    assert client4 is not client1
+
+
+def test_login_keys():
+    '''
+    This tests the keys failed logins are tracked under.
+
+    '''
+
+    assert handlers.get_login_keys(
+        {'email':' Test@Example.com', 'ip_address':'1.2.3.4'}
+    ) == ['email:test@example.com ip:1.2.3.4', 'ip:1.2.3.4']
+    assert handlers.get_login_keys(
+        {'email':'test@example.com'}
+    ) == ['email:test@example.com']
+    assert handlers.get_login_keys(
+        {'email':'test@example.com', 'ip_address':''}
+    ) == ['email:test@example.com']
+
+    # failed logins from one IP address don't lock out the same email address
+    # from another one
+    tracker = cache.FailedLoginTracker()
+    attacker_keys = handlers.get_login_keys(
+        {'email':'test@example.com', 'ip_address':'5.6.7.8'}
+    )
+    for _ in range(5):
+        tracker.record_failure(attacker_keys)
+
+    assert tracker.check(attacker_keys) > 0.0
+    assert tracker.check(handlers.get_login_keys(
+        {'email':'test@example.com', 'ip_address':'1.2.3.4'}
+    )) == 0.0
+
+
+class _LoginTestClient(object):
+    '''
+    This stands in for the authnzerver client and remembers its requests.
+
+    '''
+
+    def __init__(self):
+        self.requests = []
+
+    async def request(self, request_type, request_body):
+        self.requests.append((request_type, request_body))
+        return True, {'messages':[]}, []
+
+
+class _LoginTestHandler(frontendbase.BaseHandler):
+    '''
+    This is a BaseHandler that sends its requests to a _LoginTestClient.
+
+    '''
+
+    def initialize(self):
+        self.authnzerver_client = _LoginTestClient()
+
+
+def test_frontend_login_ip():
+    '''
+    This tests if the frontend sends the client's IP address with logins.
+
+    '''
+
+    handler = _LoginTestHandler(
+        tornado.web.Application(),
+        HTTPServerRequest(method='POST', uri='/',
+                          connection=_FakeConnection())
+    )
+    handler.request.remote_ip = '1.2.3.4'
+
+    async def send_requests():
+        await handler.authnzerver_request('user-login',
+                                          {'email':'test@example.com'})
+        await handler.authnzerver_request('user-login',
+                                          {'email':'test@example.com',
+                                           'ip_address':'5.6.7.8'})
+        await handler.authnzerver_request('session-exists',
+                                          {'session_token':'abc'})
+
+    asyncio.run(send_requests())
+
+    assert handler.authnzerver_client.requests == [
+        ('user-login', {'email':'test@example.com', 'ip_address':'1.2.3.4'}),
+        ('user-login', {'email':'test@example.com', 'ip_address':'5.6.7.8'}),
+        ('session-exists', {'session_token':'abc'}),
+    ]
@@ -0,0 +1,168 @@
+'''test_client.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the authnzerver client.
+
+'''
+
+import os
+import asyncio
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from .. import client
+from ..client import AuthnzerverClient
+from ..handlers import decrypt_request, encrypt_response
+
+
+def test_request_ids():
+    '''
+    This tests if request IDs are unique and increasing.
+
+    '''
+
+    reqids = [client.new_request_id() for _ in range(10000)]
+
+    assert len(set(reqids)) == len(reqids)
+    assert reqids == sorted(reqids)
+    assert all(0 <= x < 2**64 for x in reqids)
+
+    # a forked process should start from a different random base
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, str(client.new_request_id()).encode())
+        os._exit(0)
+
+    os.close(write_fd)
+    child_reqid = int(os.read(read_fd, 64).decode())
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    assert child_reqid not in reqids
+    assert child_reqid != client.new_request_id()
+
+
+def test_request_encryption():
+    '''
+    This tests if the client's requests can be read by the authnzerver.
+
+    '''
+
+    secret = Fernet.generate_key()
+    ferneter = Fernet(secret)
+
+    expires = datetime.utcnow()
+    encrypted = client.encrypt_request(
+        {'request':'session-new',
+         'body':{'expires':expires, 'session_token':b'abc'},
+         'reqid':client.new_request_id()},
+        ferneter
+    )
+
+    decrypted = decrypt_request(encrypted, secret)
+    assert decrypted['request'] == 'session-new'
+    assert decrypted['body']['expires'] == expires.isoformat()
+    assert decrypted['body']['session_token'] == 'abc'
+
+    response = encrypt_response({'success':True,
+                                 'reqid':decrypted['reqid'],
+                                 'response':{'messages':[]}},
+                                secret)
+    assert client.decrypt_response(response, ferneter)['reqid'] == (
+        decrypted['reqid']
+    )
+
+    # responses encrypted with another key can't be read
+    assert client.decrypt_response(
+        response,
+        Fernet(Fernet.generate_key())
+    ) is None
+
+
+def test_request_unreachable():
+    '''
+    This tests if requests to an authnzerver that isn't there fail cleanly.
+
+    '''
+
+    async def send_requests():
+
+        # nothing should be listening on port 1
+        authnzerver_client = AuthnzerverClient(
+            'http://127.0.0.1:1',
+            Fernet.generate_key(),
+            connect_timeout=1.0,
+            max_retries=1,
+            retry_backoff=0.01
+        )
+        results = await authnzerver_client.request_many([
+            ('session-exists', {'session_token':'abc'}),
+            ('session-new', {'user_id':2}),
+        ])
+        authnzerver_client.close()
+        return results
+
+    assert asyncio.run(send_requests()) == [(False, None, None),
+                                            (False, None, None)]
+
+
+class _ThrottlingHandler(tornado.web.RequestHandler):
+    '''
+    This turns away every request like the authnzerver does a throttled login.
+
+    '''
+
+    def post(self):
+        self.set_status(429)
+        self.set_header('Retry-After', '7')
+        self.finish()
+
+
+def test_request_throttled():
+    '''
+    This tests if a 429 from the authnzerver comes back with its Retry-After.
+
+    '''
+
+    async def send_requests():
+
+        sock, port = bind_unused_port()
+        server = HTTPServer(tornado.web.Application([
+            (r'/', _ThrottlingHandler)
+        ]))
+        server.add_sockets([sock])
+
+        authnzerver_client = AuthnzerverClient(
+            'http://127.0.0.1:%s' % port,
+            Fernet.generate_key()
+        )
+        result = await authnzerver_client.request(
+            'user-login',
+            {'session_token':'abc',
+             'email':'testuser@test.org',
+             'password':'aROwQin9L8nNtPTEMLXd'}
+        )
+        batch_results = await authnzerver_client.request_batch([
+            ('session-exists', {'session_token':'abc'}),
+        ])
+
+        authnzerver_client.close()
+        server.stop()
+        return result, batch_results
+
+    (success, response, messages), batch_results = asyncio.run(
+        send_requests()
+    )
+
+    assert success is False
+    assert response['success'] is False
+    assert response['retry_after'] == 7.0
+    assert messages == response['messages']
+    assert batch_results == [(False, None, None)]
@@ -0,0 +1,460 @@
+'''test_dispatch.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the request dispatch classes and metrics.
+
+'''
+
+import asyncio
+import os.path
+import time
+import multiprocessing as mp
+from datetime import datetime, timedelta
+
+import pytest
+
+from .. import authdb, actions
+from ..main import _setup_auth_worker
+from ..external.futures37.process import ProcessPoolExecutor
+from ..handlers import (
+    parse_dispatch,
+    get_dispatch_mode,
+    RequestMetrics,
+    parse_queue_limits,
+    parse_inflight_limits,
+    run_before_deadline,
+    auth_batch,
+    get_coalescing_key,
+    RequestCoalescer,
+    DeadlineExpired,
+    DEFAULT_DISPATCH,
+)
+
+
+def test_parse_dispatch():
+    '''
+    This tests parsing dispatch specs and looking up request modes.
+
+    '''
+
+    dispatch = parse_dispatch(DEFAULT_DISPATCH)
+    assert get_dispatch_mode('check-user-limit', dispatch) == 'inline'
+    assert get_dispatch_mode('session-exists', dispatch) == 'inline'
+    assert get_dispatch_mode('user-login', dispatch) == 'process'
+    assert get_dispatch_mode('session-new', dispatch) == 'process'
+
+    # lookups that can return or check many items stay in the workers
+    assert get_dispatch_mode('user-list', dispatch) == 'process'
+    assert get_dispatch_mode('check-user-access-batch', dispatch) == 'process'
+
+    # request types override their class
+    dispatch = parse_dispatch(
+        ' lookup:inline, session-exists:process,session-new:inline '
+    )
+    assert get_dispatch_mode('session-exists', dispatch) == 'process'
+    assert get_dispatch_mode('apikey-verify', dispatch) == 'inline'
+    assert get_dispatch_mode('session-new', dispatch) == 'inline'
+
+    # everything runs in the workers if there's no spec
+    assert parse_dispatch('') == {}
+    assert get_dispatch_mode('check-user-limit', {}) == 'process'
+
+    with pytest.raises(ValueError):
+        parse_dispatch('lookup:thread')
+
+    with pytest.raises(ValueError):
+        parse_dispatch('not-a-request:inline')
+
+
+def test_request_metrics():
+    '''
+    This tests the per-class latency metrics.
+
+    '''
+
+    metrics = RequestMetrics(nsamples=10)
+
+    for ind in range(20):
+        metrics.record('lookup', 'inline', (ind + 1)*1.0e-3)
+    metrics.record('hashing', 'process', 0.25)
+
+    info = metrics.info()
+
+    assert info['lookup']['count'] == 20
+    assert info['lookup']['inline'] == 20
+    assert info['lookup']['process'] == 0
+    assert info['lookup']['mean_ms'] == pytest.approx(10.5)
+    assert info['lookup']['max_ms'] == pytest.approx(20.0)
+
+    # percentiles only use the most recent samples
+    assert info['lookup']['p50_ms'] == pytest.approx(16.0)
+    assert info['lookup']['p99_ms'] == pytest.approx(20.0)
+
+    assert info['hashing']['count'] == 1
+    assert info['hashing']['process'] == 1
+    assert info['hashing']['p95_ms'] == pytest.approx(250.0)
+
+
+def test_pool_metrics():
+    '''
+    This tests the executor pool queue depth metrics.
+
+    '''
+
+    metrics = RequestMetrics(pool_sizes={'default':2, 'hashing':1})
+
+    for _ in range(3):
+        metrics.pool_submitted('hashing')
+    metrics.pool_submitted('default')
+    metrics.pool_completed('hashing')
+
+    info = metrics.pool_info()
+
+    assert info['hashing'] == {'workers':1,
+                               'in_flight':2,
+                               'max_in_flight':3,
+                               'queued':1,
+                               'max_queued':2,
+                               'queue_limit':None,
+                               'submitted':3,
+                               'shed':0}
+    assert info['default']['queued'] == 0
+    assert info['default']['in_flight'] == 1
+
+    # pools without a known size don't report queue depths
+    metrics.pool_submitted('other')
+    assert metrics.pool_info()['other']['queued'] is None
+
+
+def test_pool_admission():
+    '''
+    This tests turning requests away when an executor pool's queue is full.
+
+    '''
+
+    assert parse_queue_limits('hashing:2, default:10') == {'hashing':2,
+                                                            'default':10}
+    with pytest.raises(ValueError):
+        parse_queue_limits('lookup:10')
+
+    metrics = RequestMetrics(pool_sizes={'default':2, 'hashing':1},
+                             queue_limits={'hashing':2})
+
+    # one running and two waiting fill up the hashing pool
+    for _ in range(3):
+        assert metrics.pool_admit('hashing', 'hashing') is None
+        metrics.pool_submitted('hashing')
+
+    metrics.record('hashing', 'process', 2.0)
+    retry_after = metrics.pool_admit('hashing', 'hashing')
+    assert retry_after == pytest.approx(6.0)
+
+    # the default pool has no limit
+    for _ in range(100):
+        assert metrics.pool_admit('default', 'lookup') is None
+        metrics.pool_submitted('default')
+
+    metrics.pool_completed('hashing')
+    assert metrics.pool_admit('hashing', 'hashing') is None
+
+    info = metrics.pool_info()
+    assert info['hashing']['shed'] == 1
+    assert info['hashing']['queue_limit'] == 2
+    assert info['default']['shed'] == 0
+    assert info['default']['queue_limit'] is None
+
+
+def test_class_inflight_limits():
+    '''
+    This tests turning requests away when their class has too many in flight.
+
+    '''
+
+    assert parse_inflight_limits(' hashing:2,lookup:10 ') == {'hashing':2,
+                                                              'lookup':10}
+    assert parse_inflight_limits('') == {}
+    with pytest.raises(ValueError):
+        parse_inflight_limits('batch:10')
+    with pytest.raises(ValueError):
+        parse_inflight_limits('lookup:0')
+
+    metrics = RequestMetrics(pool_sizes={'default':4},
+                             queue_limits={'default':100},
+                             inflight_limits={'lookup':2})
+
+    for _ in range(2):
+        assert metrics.pool_admit('default', 'lookup') is None
+        metrics.pool_submitted('default', 'lookup')
+
+    # lookups are at their limit, but the other classes in the same pool
+    # still get in
+    metrics.record('lookup', 'process', 3.0)
+    assert metrics.pool_admit('default', 'lookup') == pytest.approx(3.0)
+    assert metrics.pool_admit('default', 'default') is None
+
+    metrics.pool_completed('default', 'lookup')
+    assert metrics.pool_admit('default', 'lookup') is None
+
+    info = metrics.class_pool_info()
+    assert info['lookup'] == {'inflight_limit':2,
+                              'in_flight':1,
+                              'max_in_flight':2,
+                              'shed':1}
+    assert info['default']['inflight_limit'] is None
+    assert metrics.pool_info()['default']['shed'] == 0
+
+
+def test_deadlines():
+    '''
+    This tests if requests past their deadline aren't run.
+
+    '''
+
+    calls = []
+
+    def request_func(payload):
+        calls.append(payload)
+        return {'success':True, 'messages':[]}
+
+    assert run_before_deadline(request_func, {'a':1}, None)['success'] is True
+    assert run_before_deadline(request_func,
+                               {'a':2},
+                               time.time() + 10.0)['success'] is True
+    assert run_before_deadline(request_func, {'a':3}, time.time()) is None
+    assert calls == [{'a':1}, {'a':2}]
+
+    # none of the requests in an expired batch are run
+    responses = auth_batch([('session-exists', {'session_token':'nope'}),
+                            ('user-list', {'user_id':1})],
+                           deadline=time.time() - 1.0)
+    assert len(responses) == 2
+    assert all(x['success'] is False for x in responses)
+    assert 'deadline' in responses[1]['messages'][0]
+
+    metrics = RequestMetrics()
+    metrics.record_dropped('expired_in_worker')
+    metrics.record_dropped('cancelled')
+    assert metrics.dropped == {'expired_before_dispatch':0,
+                               'expired_in_worker':1,
+                               'cancelled':1}
+
+
+def test_coalescing():
+    '''
+    This tests if identical concurrent lookups share one result.
+
+    '''
+
+    # keys don't depend on the order of the body items
+    assert (
+        get_coalescing_key('check-user-access', {'user_id':1, 'action':'view'})
+        == get_coalescing_key('check-user-access', {'action':'view',
+                                                     'user_id':1})
+    )
+    assert get_coalescing_key('user-list', {'user_id':2}) is not None
+    assert get_coalescing_key('user-list', {'user_id':None}) is None
+    assert get_coalescing_key('user-login', {'email':'a@b.c'}) is None
+
+    calls = []
+
+    async def lookup(token):
+        calls.append(token)
+        await asyncio.sleep(0.05)
+        return {'success':True, 'token':token}
+
+    async def run_lookups():
+
+        coalescer = RequestCoalescer()
+        same = get_coalescing_key('session-exists', {'session_token':'a'})
+        other = get_coalescing_key('session-exists', {'session_token':'b'})
+
+        results = await asyncio.gather(
+            *[coalescer.run(same, lookup, 'a') for _ in range(9)],
+            coalescer.run(other, lookup, 'b')
+        )
+
+        # once the first request is done, a new one runs again
+        results.append(await coalescer.run(same, lookup, 'a'))
+        return coalescer, results
+
+    coalescer, results = asyncio.run(run_lookups())
+
+    assert calls == ['a', 'b', 'a']
+    assert [x['token'] for x in results] == ['a']*9 + ['b', 'a']
+
+    info = coalescer.info()
+    assert info['requests'] == 11
+    assert info['coalesced'] == 8
+    assert info['executed'] == 3
+    assert info['ratio'] == pytest.approx(8/11)
+    assert info['in_flight'] == 0
+
+    # a request stops waiting at its own deadline without stopping the
+    # shared work for the others
+    async def run_with_deadlines():
+
+        coalescer = RequestCoalescer()
+        key = get_coalescing_key('session-exists', {'session_token':'c'})
+
+        return await asyncio.gather(
+            coalescer.run(key, lookup, 'c', deadline=time.time() + 10.0),
+            coalescer.run(key, lookup, 'c', deadline=time.time() + 0.01),
+            coalescer.run(key, lookup, 'c', deadline=time.time() - 1.0),
+            coalescer.run(key, lookup, 'c'),
+            return_exceptions=True
+        )
+
+    calls.clear()
+    results = asyncio.run(run_with_deadlines())
+
+    assert calls == ['c']
+    assert results[0]['token'] == 'c'
+    assert isinstance(results[1], DeadlineExpired)
+    assert isinstance(results[2], DeadlineExpired)
+    assert results[3]['token'] == 'c'
+
+
+def _close_test_authdb(currproc):
+    '''
+    This closes the auth DB connection of the test process.
+
+    '''
+
+    if getattr(currproc, 'authdb_meta', None):
+        del currproc.authdb_meta
+
+    if getattr(currproc, 'authdb_conn', None):
+        currproc.authdb_conn.close()
+        del currproc.authdb_conn
+
+    if getattr(currproc, 'authdb_engine', None):
+        currproc.authdb_engine.dispose()
+        del currproc.authdb_engine
+
+
+def test_inline_lookups_see_worker_changes(tmpdir):
+    '''
+    This tests if inline lookups see sessions and users changed in workers.
+
+    '''
+
+    authdb_file = str(tmpdir.join('test-dispatch.authdb.sqlite'))
+    authdb_url = 'sqlite:///%s' % authdb_file
+    cache_dirname = str(tmpdir.join('authnzerver-cache'))
+    permissions_json = os.path.abspath(
+        os.path.join(os.path.dirname(__file__),
+                     '..', 'default-permissions-model.json')
+    )
+
+    authdb.create_sqlite_authdb(authdb_file)
+    authdb.initial_authdb_inserts(authdb_url)
+
+    # set up this process like the server does for inline requests
+    currproc = mp.current_process()
+    _close_test_authdb(currproc)
+    currproc.auth_db_path = authdb_url
+    currproc.permissions_json = permissions_json
+    currproc.cache_dirname = cache_dirname
+
+    executor = ProcessPoolExecutor(
+        max_workers=2,
+        initializer=_setup_auth_worker,
+        initargs=(authdb_url, 'secret', permissions_json, 'verify:2',
+                  '', 1, 1024, '', '', cache_dirname)
+    )
+
+    try:
+
+        user_created = actions.create_new_user(
+            {'full_name':'Test User',
+             'email':'testuser-dispatch@test.org',
+             'password':'aROwQin9L8nNtPTEMLXd'}
+        )
+        assert user_created['success'] is True
+        emailverify = actions.verify_user_email_address(
+            {'email':'testuser-dispatch@test.org',
+             'user_id':user_created['user_id']}
+        )
+        assert emailverify['success'] is True
+        user_id = emailverify['user_id']
+
+        session_token = actions.auth_session_new(
+            {'user_id':user_id,
+             'user_agent':'Mozzarella Killerwhale',
+             'expires':datetime.utcnow()+timedelta(hours=1),
+             'ip_address': '1.1.1.1',
+             'extra_info_json':{}}
+        )['session_token']
+
+        access_payload = {'user_id':user_id,
+                          'user_role':'authenticated',
+                          'action':'view',
+                          'target_name':'apikey',
+                          'target_owner':user_id,
+                          'target_visibility':'private',
+                          'target_sharedwith':''}
+
+        # cache the session and the user's status in this process
+        for _ in range(2):
+            assert actions.auth_session_exists(
+                {'session_token':session_token}
+            )['success'] is True
+            assert actions.check_user_access(access_payload)['success'] is True
+
+        # delete the session in a worker
+        deleted = executor.submit(actions.auth_session_delete,
+                                  {'session_token':session_token}).result()
+        assert deleted['success'] is True
+        time.sleep(actions.session.SESSION_CACHE_GENERATION_CHECK_SECONDS)
+        assert actions.auth_session_exists(
+            {'session_token':session_token}
+        )['success'] is False
+
+        # lock the user in a worker
+        locked = executor.submit(actions.internal_toggle_user_lock,
+                                 {'target_userid':user_id,
+                                  'action':'lock'}).result()
+        assert locked['success'] is True
+        time.sleep(actions.access.USER_STATUS_CACHE_GENERATION_CHECK_SECONDS)
+        assert actions.check_user_access(access_payload)['success'] is False
+
+    finally:
+
+        executor.shutdown(wait=True)
+        del currproc.cache_dirname
+        _close_test_authdb(currproc)
+
+
+def _get_worker_setup():
+    '''
+    This returns the settings a worker has after it starts.
+
+    '''
+
+    currproc = mp.current_process()
+    return currproc.auth_db_path, currproc.cache_dirname
+
+
+def test_worker_starts_if_password_checks_fail(tmpdir):
+    '''
+    This tests if a worker still starts when its password checks can't be set
+    up, e.g. because the auth DB isn't there yet.
+
+    '''
+
+    authdb_url = 'sqlite:///%s' % tmpdir.join('nonexistent', 'test.authdb')
+    cache_dirname = str(tmpdir.join('authnzerver-cache'))
+
+    executor = ProcessPoolExecutor(
+        max_workers=1,
+        initializer=_setup_auth_worker,
+        initargs=(authdb_url, 'secret', 'permissions.json', 'verify:2',
+                  '', 1, 1024, '', '', cache_dirname)
+    )
+
+    try:
+        assert executor.submit(_get_worker_setup).result(timeout=30) == (
+            authdb_url, cache_dirname
+        )
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,299 @@
+'''test_passhash.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the password hasher in authnzerver.passhash.
+
+'''
+
+import os
+import time
+import threading
+import multiprocessing as mp
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from .. import authdb, actions, passhash
+from ..external.futures37.process import ProcessPoolExecutor
+
+
+def test_parse_passhash_params():
+    '''
+    This tests parsing password hasher parameter specs.
+
+    '''
+
+    assert passhash.parse_passhash_params('') == {}
+    params = passhash.parse_passhash_params(
+        ' time_cost:3, memory_cost:65536,parallelism:2 '
+    )
+    assert params == {'time_cost':3, 'memory_cost':65536, 'parallelism':2}
+    assert passhash.format_passhash_params(params) == (
+        'time_cost:3,memory_cost:65536,parallelism:2'
+    )
+
+    with pytest.raises(ValueError):
+        passhash.parse_passhash_params('hash_len:16')
+    with pytest.raises(ValueError):
+        passhash.parse_passhash_params('time_cost:0')
+    with pytest.raises(ValueError):
+        passhash.parse_passhash_params('time_cost:lots')
+
+
+def test_calibrate_passhash():
+    '''
+    This tests picking hasher parameters for a target verify time.
+
+    '''
+
+    # pretend a verify takes 0.1 seconds per GiB-pass
+    def timer(params):
+        return 0.1*params['time_cost']*params['memory_cost']/1048576
+
+    params, verify_seconds = passhash.calibrate_passhash(
+        target_seconds=0.25,
+        memory_budget_mib=2048,
+        concurrency=4,
+        timer=timer
+    )
+
+    # 512 MiB per hash fits the budget, and 5 passes over it fit the target
+    assert params['memory_cost'] == 524288
+    assert params['time_cost'] == 5
+    assert verify_seconds == pytest.approx(0.25)
+
+    # memory is cut down if even one pass is too slow
+    params, verify_seconds = passhash.calibrate_passhash(
+        target_seconds=0.01,
+        memory_budget_mib=2048,
+        concurrency=1,
+        timer=timer
+    )
+    assert params['memory_cost'] == 65536
+    assert params['time_cost'] == 1
+    assert verify_seconds <= 0.01
+
+
+def test_hashing_engine():
+    '''
+    This tests if requests on a worker's threads only overlap while hashing.
+
+    '''
+
+    engine = passhash.HashingEngine(max_concurrent=4)
+    hasher = passhash.TunablePasswordHasher(
+        engine=engine,
+        time_cost=2, memory_cost=8192, parallelism=1
+    )
+
+    # the requests that are running something other than a hash
+    outside_hash = []
+    overlaps = []
+
+    def action(password):
+        outside_hash.append(password)
+        overlaps.append(len(outside_hash))
+        outside_hash.remove(password)
+        password_hash = hasher.hash(password)
+        outside_hash.append(password)
+        overlaps.append(len(outside_hash))
+        outside_hash.remove(password)
+        return password, password_hash
+
+    def run_many(nthreads):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda x: results.append(
+                    engine.run_action(action, 'password-%s' % x)
+                ),
+                args=(x,)
+            ) for x in range(nthreads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    results = run_many(8)
+    assert len(results) == 8
+
+    # only one request at a time was ever outside of a hash
+    assert overlaps == [1]*16
+
+    info = engine.info()
+    assert info['hashes'] == 8
+    assert info['running'] == 0
+    assert 1 < info['max_running'] <= 4
+
+    assert all(hasher.verify(password_hash, password)
+               for password, password_hash in results)
+
+    # a smaller memory budget runs fewer hashes at once
+    engine.configure(1)
+    run_many(4)
+    assert engine.info()['max_running'] == 1
+
+
+def test_configure_hashing_engine():
+    '''
+    This tests if the number of concurrent hashes fits the memory budget.
+
+    '''
+
+    old_params = dict(passhash.pass_hasher.params)
+    old_concurrent = passhash.hashing_engine.max_concurrent
+
+    try:
+        passhash.configure_pass_hasher('memory_cost:65536')
+        assert passhash.configure_hashing_engine(8, 256) == 4
+        assert passhash.configure_hashing_engine(2, 256) == 2
+        assert passhash.configure_hashing_engine(8, 16) == 1
+        assert passhash.hashing_engine.max_concurrent == 1
+    finally:
+        passhash.pass_hasher.configure(**old_params)
+        passhash.hashing_engine.configure(old_concurrent)
+
+
+def _sleep_and_report(seconds):
+    '''
+    This sleeps and returns the worker's PID.
+
+    '''
+
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def test_threaded_worker():
+    '''
+    This tests if a single worker process can run several calls at once.
+
+    '''
+
+    executor = ProcessPoolExecutor(max_workers=1, max_threads=4)
+
+    try:
+        # start up the worker first
+        executor.submit(_sleep_and_report, 0.0).result()
+
+        start = time.monotonic()
+        futures = [executor.submit(_sleep_and_report, 0.5) for _ in range(4)]
+        pids = {x.result() for x in futures}
+        elapsed = time.monotonic() - start
+
+        assert len(pids) == 1
+        assert elapsed < 1.5
+
+    finally:
+        executor.shutdown(wait=True)
+
+
+def test_rehash_on_login():
+    '''
+    This tests if password hashes are upgraded when users log in.
+
+    '''
+
+    try:
+        os.remove('test-passhash.authdb.sqlite')
+    except Exception:
+        pass
+
+    authdb_path = 'sqlite:///test-passhash.authdb.sqlite'
+    old_params = dict(passhash.pass_hasher.params)
+
+    try:
+
+        passhash.configure_pass_hasher(
+            'time_cost:1,memory_cost:8192,parallelism:1'
+        )
+
+        authdb.create_sqlite_authdb('test-passhash.authdb.sqlite')
+        authdb.initial_authdb_inserts(authdb_path)
+
+        user_payload = {'full_name':'Test User',
+                        'email':'testuser-passhash@test.org',
+                        'password':'aROwQin9L8nNtPTEMLXd'}
+        user_created = actions.create_new_user(
+            user_payload,
+            override_authdb_path=authdb_path
+        )
+        assert user_created['success'] is True
+
+        emailverify = actions.verify_user_email_address(
+            {'email':user_payload['email'],
+             'user_id':user_created['user_id']},
+            override_authdb_path=authdb_path
+        )
+        assert emailverify['success'] is True
+
+        def get_password_hash():
+            currproc = mp.current_process()
+            users = currproc.authdb_meta.tables['users']
+            result = currproc.authdb_conn.execute(
+                select([users.c.password]).where(
+                    users.c.user_id == user_created['user_id']
+                )
+            )
+            password_hash = result.fetchone()['password']
+            result.close()
+            return password_hash
+
+        def login():
+            session_token = actions.auth_session_new(
+                {'user_id':2,
+                 'user_agent':'Mozzarella Killerwhale',
+                 'expires':datetime.utcnow()+timedelta(hours=1),
+                 'ip_address': '1.1.1.1',
+                 'extra_info_json':{}},
+                override_authdb_path=authdb_path
+            )
+            return actions.auth_user_login(
+                {'session_token':session_token['session_token'],
+                 'email':user_payload['email'],
+                 'password':user_payload['password']},
+                override_authdb_path=authdb_path
+            )
+
+        old_hash = get_password_hash()
+        assert 'm=8192,t=1,p=1' in old_hash
+
+        # retune the hasher. the next login upgrades the hash.
+        passhash.configure_pass_hasher(
+            'time_cost:2,memory_cost:8192,parallelism:1'
+        )
+        assert passhash.pass_hasher.check_needs_rehash(old_hash) is True
+
+        assert login()['success'] is True
+        new_hash = get_password_hash()
+        assert new_hash != old_hash
+        assert 'm=8192,t=2,p=1' in new_hash
+        assert passhash.pass_hasher.check_needs_rehash(new_hash) is False
+
+        # the upgraded hash still works and isn't changed again
+        assert login()['success'] is True
+        assert get_password_hash() == new_hash
+
+    finally:
+
+        passhash.pass_hasher.configure(**old_params)
+
+        currproc = mp.current_process()
+        if getattr(currproc, 'authdb_meta', None):
+            del currproc.authdb_meta
+
+        if getattr(currproc, 'authdb_conn', None):
+            currproc.authdb_conn.close()
+            del currproc.authdb_conn
+
+        if getattr(currproc, 'authdb_engine', None):
+            currproc.authdb_engine.dispose()
+            del currproc.authdb_engine
+
+        try:
+            os.remove('test-passhash.authdb.sqlite')
+        except Exception:
+            pass
@@ -0,0 +1,147 @@
+'''test_passpolicy.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the password policy in authnzerver.passpolicy.
+
+'''
+
+import socket
+
+import pytest
+from fuzzywuzzy.fuzz import UQRatio
+
+from .. import passpolicy
+from ..actions.user import validate_input_password
+
+
+def test_parse_password_policy():
+    '''
+    This tests parsing password policy specs.
+
+    '''
+
+    assert passpolicy.parse_password_policy('') == {}
+    params = passpolicy.parse_password_policy(
+        ' min_length:16, max_similarity:25,max_char_fraction:0.25 '
+    )
+    assert params == {'min_length':16,
+                      'max_similarity':25,
+                      'max_char_fraction':0.25}
+
+    with pytest.raises(ValueError):
+        passpolicy.parse_password_policy('max_length:16')
+    with pytest.raises(ValueError):
+        passpolicy.parse_password_policy('min_length:0')
+    with pytest.raises(ValueError):
+        passpolicy.parse_password_policy('min_length:lots')
+    with pytest.raises(ValueError):
+        passpolicy.parse_password_policy('max_char_fraction:1.5')
+    with pytest.raises(ValueError):
+        passpolicy.parse_password_policy('max_similarity:101')
+
+
+def test_policy_matches_uqratio():
+    '''
+    This tests if the policy's fuzzy matching gives the same scores as UQRatio.
+
+    '''
+
+    policy = passpolicy.PasswordPolicy(fqdn='auth.example.org')
+
+    for password, other in (('aROwQin9L8nNtPTEMLXd', 'auth.example.org'),
+                            ('TestUser2020!', 'Test User'),
+                            ('testuser@test.org', 'testuser@test.org'),
+                            ('Ünïcödé-pässwörd', 'ünïcödé pässwörd'),
+                            ('!!!!', 'Test User')):
+        assert policy._similarity(
+            policy._process(password),
+            policy._process(other)
+        ) == UQRatio(password.casefold(), other.casefold())
+
+
+def test_policy_complexity():
+    '''
+    This tests the single-pass character frequency check.
+
+    '''
+
+    policy = passpolicy.PasswordPolicy(fqdn='auth.example.org')
+
+    assert policy.is_complex_enough('aROwQin9L8nNtPTEMLXd') is True
+    assert policy.is_complex_enough('aaaaabcdefghij') is False
+
+    # characters are counted case-folded, and exactly 20% is still OK
+    assert policy.is_complex_enough('aAbcdefghi') is True
+    assert policy.is_complex_enough('aAbcdefghA') is False
+    assert policy.is_complex_enough('') is True
+
+    lenient = passpolicy.PasswordPolicy(max_char_fraction=0.5,
+                                        fqdn='auth.example.org')
+    assert lenient.is_complex_enough('aaaaabcdefghij') is True
+
+
+def test_configured_policy(monkeypatch):
+    '''
+    This tests if the configured policy is used to validate new passwords.
+
+    '''
+
+    try:
+
+        policy = passpolicy.configure_password_policy(
+            'min_length:24',
+            fqdn='auth.example.org'
+        )
+        assert passpolicy.get_password_policy() is policy
+        assert policy.min_length == 24
+        assert policy.max_similarity == 30
+
+        # the FQDN is only looked up when the policy is made
+        def no_getfqdn(*args):
+            raise AssertionError('getfqdn called while validating')
+        monkeypatch.setattr(socket, 'getfqdn', no_getfqdn)
+
+        passok, messages = validate_input_password('Test User',
+                                                   'testuser@test.org',
+                                                   'aROwQin9L8nNtPTEMLXd')
+        assert passok is False
+        assert ('Your password is too short. '
+                'It must have at least 24 characters.' in messages)
+
+        # arguments still override the policy
+        passok, messages = validate_input_password('Test User',
+                                                   'testuser@test.org',
+                                                   'aROwQin9L8nNtPTEMLXd',
+                                                   min_length=12)
+        assert passok is True
+
+        # called directly, the similarity threshold keeps its old default of
+        # 20 instead of the policy's 30
+        passok, messages = validate_input_password('Test User',
+                                                   'testuser@test.org',
+                                                   'gh7#Tq!zmW2@kLp9sRe',
+                                                   min_length=12)
+        assert passok is False
+        assert ('Your password is too similar to either '
+                'the domain name of this server or your '
+                'own name or email address.' in messages)
+
+        passok, messages = validate_input_password('Test User',
+                                                   'testuser@test.org',
+                                                   'gh7#Tq!zmW2@kLp9sRe',
+                                                   min_length=12,
+                                                   max_match_threshold=None)
+        assert passok is True
+
+        # the password is too close to the configured FQDN
+        passok, messages = validate_input_password('Test User',
+                                                   'testuser@test.org',
+                                                   'auth.example.org.42')
+        assert passok is False
+        assert ('Your password is too similar to either '
+                'the domain name of this server or your '
+                'own name or email address.' in messages)
+
+    finally:
+        monkeypatch.undo()
+        passpolicy.password_policy = None
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# test_permissions_cache.py - Waqas Bhatti (wbhatti@astro.princeton.edu) -
+# Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This tests the per-process cache of compiled permissions models.
+
+'''
+
+import os
+import os.path
+import json
+
+from authnzerver import permissions
+
+
+def get_default_model_dict():
+    '''
+    This returns the default permissions model as a dict.
+
+    '''
+
+    modpath = os.path.abspath(os.path.dirname(__file__))
+    permpath = os.path.abspath(
+        os.path.join(modpath,'..','default-permissions-model.json')
+    )
+    with open(permpath,'r') as infd:
+        return json.load(infd)
+
+
+def write_model(model_dict, outpath, mtime):
+    '''
+    This writes a permissions model and sets its mtime.
+
+    '''
+
+    with open(outpath,'w') as outfd:
+        json.dump(model_dict, outfd)
+    os.utime(outpath, (mtime, mtime))
+
+
+def test_model_cache_reload(tmpdir):
+    '''
+    This checks if the cached model is reused and reloaded when it changes.
+
+    '''
+
+    permissions.clear_permissions_model_cache()
+
+    model_dict = get_default_model_dict()
+    permpath = os.path.join(str(tmpdir), 'test-permissions-model.json')
+    write_model(model_dict, permpath, 1500000000)
+
+    check_kwargs = dict(userid=4,
+                        role='authenticated',
+                        action='view',
+                        target_name='dataset',
+                        target_owner=1,
+                        target_visibility='public',
+                        target_sharedwith='')
+
+    assert permissions.load_policy_and_check_access(
+        permpath, **check_kwargs
+    ) is True
+    assert permissions.load_policy_and_check_access(
+        permpath, **check_kwargs
+    ) is True
+
+    info = permissions.permissions_model_cache_info()
+    assert info['reloads'] == 1
+    assert info['hits'] == 1
+    assert info['models'] == [os.path.abspath(permpath)]
+
+    # touching the file without changing its contents shouldn't reload it
+    os.utime(permpath, (1500000100, 1500000100))
+    assert permissions.load_policy_and_check_access(
+        permpath, **check_kwargs
+    ) is True
+    info = permissions.permissions_model_cache_info()
+    assert info['reloads'] == 1
+    assert info['hits'] == 2
+
+    # change the policy so authenticated users can't view public datasets
+    model_dict['role_policy']['authenticated'][
+        'allowed_actions_for_other'
+    ]['public'] = ['list']
+    write_model(model_dict, permpath, 1500000200)
+
+    assert permissions.load_policy_and_check_access(
+        permpath, **check_kwargs
+    ) is False
+    info = permissions.permissions_model_cache_info()
+    assert info['reloads'] == 2
+
+    # a broken permissions JSON should leave the previous model in place
+    with open(permpath,'w') as outfd:
+        outfd.write('{"roles": [')
+    os.utime(permpath, (1500000300, 1500000300))
+
+    assert permissions.load_policy_and_check_access(
+        permpath, **check_kwargs
+    ) is False
+    info = permissions.permissions_model_cache_info()
+    assert info['reloads'] == 2
+    assert info['reload_errors'] == 1
+
+    permissions.clear_permissions_model_cache()
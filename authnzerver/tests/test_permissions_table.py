@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# test_permissions_table.py - Waqas Bhatti (wbhatti@astro.princeton.edu) -
+# Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This tests the precomputed permissions decision table against the set-based
+policy checks.
+
+'''
+
+import os.path
+import itertools
+
+from authnzerver import permissions
+
+
+def test_decision_table_matches_sets():
+    '''
+    This checks the decision table against the set-based policy for the whole
+    default permissions model.
+
+    '''
+
+    # load the default permissions model
+    modpath = os.path.abspath(os.path.dirname(__file__))
+    permpath = os.path.abspath(
+        os.path.join(modpath,'..','default-permissions-model.json')
+    )
+    model = permissions.load_permissions_json(permpath)
+
+    for role, item, visibility, owner, action in itertools.product(
+            model['roles'],
+            model['items'],
+            model['visibilities'],
+            (4, 5),
+            model['actions']
+    ):
+
+        table_decision = permissions.check_item_access(
+            model,
+            userid=4,
+            role=role,
+            action=action,
+            target_name=item,
+            target_owner=owner,
+            target_visibility=visibility,
+            target_sharedwith='4',
+        )
+
+        # the debug path uses the set-based policy checks
+        set_decision = permissions.check_item_access(
+            model,
+            userid=4,
+            role=role,
+            action=action,
+            target_name=item,
+            target_owner=owner,
+            target_visibility=visibility,
+            target_sharedwith='4',
+            debug=True
+        )
+
+        assert table_decision is set_decision, (
+            role, item, visibility, owner, action
+        )
+
+
+def test_decision_table_unknown_names():
+    '''
+    This checks if unknown roles, items, and actions are denied.
+
+    '''
+
+    modpath = os.path.abspath(os.path.dirname(__file__))
+    permpath = os.path.abspath(
+        os.path.join(modpath,'..','default-permissions-model.json')
+    )
+    model = permissions.load_permissions_json(permpath)
+
+    assert permissions.check_item_access(
+        model,
+        userid=4,
+        role='authenticated',
+        action='teleport',
+        target_name='dataset',
+        target_owner=4,
+        target_visibility='public',
+    ) is False
+
+    assert permissions.check_item_access(
+        model,
+        userid=4,
+        role='authenticated',
+        action='view',
+        target_name='spaceship',
+        target_owner=4,
+        target_visibility='public',
+    ) is False
+
+    assert permissions.check_item_access(
+        model,
+        userid=4,
+        role='overlord',
+        action='view',
+        target_name='dataset',
+        target_owner=4,
+        target_visibility='public',
+    ) is False
@@ -10,10 +10,12 @@ import subprocess
 import requests
 import os.path
 import time
+import asyncio
 from datetime import datetime, timedelta
 
 from authnzerver.autosetup import autogen_secrets_authdb
 from authnzerver.handlers import encrypt_response, decrypt_request
+from authnzerver.client import AuthnzerverClient
 
 
 def test_server_with_env(monkeypatch, tmpdir):
@@ -134,6 +136,154 @@ def test_server_with_env(monkeypatch, tmpdir):
         assert isinstance(response_dict['response'], dict)
         assert response_dict['response']['user_id'] == 1
 
+        #
+        # 3. check the rate limit for this session
+        #
+        request_dict = {
+            'request':'ratelimit-check',
+            'body':{
+                'key_type':'session',
+                'key':'test-session-token',
+                'user_role':'anonymous'
+            },
+            'reqid':103
+        }
+
+        encrypted_request = encrypt_response(request_dict, secret)
+
+        # send the request to the authnzerver
+        resp = requests.post(
+            'http://%s:%s' % (server_listen, server_port),
+            data=encrypted_request,
+            timeout=1.0
+        )
+        resp.raise_for_status()
+
+        # decrypt the response
+        response_dict = decrypt_request(resp.text, secret)
+
+        assert response_dict['reqid'] == request_dict['reqid']
+        assert response_dict['success'] is True
+        assert response_dict['response']['allowed'] is True
+        assert response_dict['response']['remaining'] == 599
+
+        # sending the same request again is rejected as a replay
+        resp = requests.post(
+            'http://%s:%s' % (server_listen, server_port),
+            data=encrypted_request,
+            timeout=1.0
+        )
+        assert resp.status_code == 400
+
+        #
+        # 4. requests past their deadline aren't run
+        #
+        request_dict = {
+            'request':'user-list',
+            'body':{'user_id':1},
+            'reqid':104,
+            'deadline':time.time() - 1.0,
+        }
+        encrypted_request = encrypt_response(request_dict, secret)
+        resp = requests.post(
+            'http://%s:%s' % (server_listen, server_port),
+            data=encrypted_request,
+            timeout=1.0
+        )
+        assert resp.status_code == 504
+
+        #
+        # 5. send several requests at once using the client
+        #
+        async def client_requests():
+
+            authnzerver_client = AuthnzerverClient(
+                'http://%s:%s' % (server_listen, server_port),
+                secret
+            )
+            session_ok, session_resp, _ = await authnzerver_client.request(
+                'session-new',
+                {'user_id':1,
+                 'user_agent':'Mozzarella Killerwhale',
+                 'expires':datetime.utcnow()+timedelta(hours=1),
+                 'ip_address':'1.1.1.1',
+                 'extra_info_json':{}}
+            )
+            assert session_ok is True
+            session_token = session_resp['session_token']
+
+            results = await authnzerver_client.request_many(
+                [('session-exists',
+                  {'session_token':session_token})]*10 +
+                [('ratelimit-check',
+                  {'key_type':'ip',
+                   'key':'1.1.1.1',
+                   'user_role':'anonymous'})]
+            )
+
+            # a page load's worth of requests in a single batch
+            batch_results = await authnzerver_client.request_batch([
+                ('session-exists',
+                 {'session_token':session_token}),
+                ('check-user-limit',
+                 {'user_id':1,
+                  'user_role':'superuser',
+                  'limit_name':'max_requests',
+                  'value_to_check':10}),
+                ('apikey-verify',
+                 {'apikey_dict':{'uid':1}}),
+                ('ratelimit-check',
+                 {'key_type':'ip',
+                  'key':'1.1.1.1',
+                  'user_role':'anonymous'}),
+                ('user-login',
+                 {'session_token':session_token,
+                  'email':useremail,
+                  'password':password}),
+            ])
+
+            metrics = await authnzerver_client.request('server-metrics', {})
+
+            authnzerver_client.close()
+            return results, batch_results, metrics
+
+        results, batch_results, metrics = asyncio.run(client_requests())
+        assert len(results) == 11
+        assert all(x[0] is True for x in results)
+        assert results[0][1]['session_info']['user_id'] == 1
+        assert results[-1][1]['remaining'] == 599
+
+        assert len(batch_results) == 5
+        assert batch_results[0][0] is True
+        assert batch_results[0][1]['session_info']['user_id'] == 1
+        assert batch_results[1][0] is True
+        assert batch_results[2][0] is False
+        assert batch_results[3][0] is True
+        assert batch_results[3][1]['remaining'] == 598
+        assert batch_results[4][0] is False
+        assert 'not allowed' in batch_results[4][2][0]
+
+        # lookups run inline and hashing requests in the workers by default
+        metrics_resp = metrics[1]
+        pools = metrics_resp['pools']
+        metrics = metrics_resp['metrics']
+        assert metrics['lookup']['inline'] == metrics['lookup']['count']
+        assert metrics['lookup']['count'] >= 11
+        assert metrics['hashing']['process'] == 1
+        assert metrics['batch']['count'] == 1
+        assert metrics['batch']['inline'] == 1
+
+        # the login went to the separate hashing pool, which has one worker
+        # running four requests at once
+        assert pools['hashing']['workers'] == 4
+        assert pools['hashing']['submitted'] == 1
+        assert pools['hashing']['in_flight'] == 0
+        assert pools['default']['submitted'] >= 2
+
+        assert metrics_resp['dropped']['expired_before_dispatch'] == 1
+        assert metrics_resp['replay']['replayed'] == 1
+        assert metrics_resp['replay']['stale'] == 0
+
         #
         # kill the server at the end
         #
@@ -158,8 +308,8 @@ def test_server_with_env(monkeypatch, tmpdir):
 def test_server_invalid_logins(monkeypatch, tmpdir):
     '''This tests if the server responds appropriately to invalid logins.
 
-    The timing difference between successive failed logins should increase
-    roughly exponentially.
+    Logins tried too soon after a failed login should be turned away with an
+    HTTP 429, and the Retry-After time should increase with each failure.
 
     '''
 
@@ -207,88 +357,12 @@ def test_server_invalid_logins(monkeypatch, tmpdir):
     # wait 2.5 seconds for the server to start
     time.sleep(2.5)
 
-    timing = []
-
-    try:
-
-        #
-        # attempt to login as the superuser several times with the wrong
-        # password
-        #
-        for i in range(5):
-
-            # create a new anonymous session token
-            session_payload = {
-                'user_id':2,
-                'user_agent':'Mozzarella Killerwhale',
-                'expires':datetime.utcnow()+timedelta(hours=1),
-                'ip_address': '1.1.1.1',
-                'extra_info_json':{'pref_datasets_always_private':True}
-            }
-
-            request_dict = {'request':'session-new',
-                            'body':session_payload,
-                            'reqid':i}
-
-            encrypted_request = encrypt_response(request_dict, secret)
-
-            # send the request to the authnzerver
-            resp = requests.post(
-                'http://%s:%s' % (server_listen, server_port),
-                data=encrypted_request,
-                timeout=1.0
-            )
-            resp.raise_for_status()
-
-            # decrypt the response
-            session_dict = decrypt_request(resp.text, secret)
-
-            assert session_dict['reqid'] == request_dict['reqid']
-            assert session_dict['success'] is True
-            assert isinstance(session_dict['response'], dict)
-            assert session_dict['response']['session_token'] is not None
-
-            request_dict = {
-                'request':'user-login',
-                'body':{
-                    'session_token':session_dict['response']['session_token'],
-                    'email':useremail,
-                    'password':'%s-%i' % (password,i)
-                },
-                'reqid':10*i + 10
-            }
-
-            encrypted_request = encrypt_response(request_dict, secret)
-
-            start_login_time = time.monotonic()
-
-            # send the request to the authnzerver
-            resp = requests.post(
-                'http://%s:%s' % (server_listen, server_port),
-                data=encrypted_request,
-                timeout=60.0
-            )
-            resp.raise_for_status()
-
-            timing.append(time.monotonic() - start_login_time)
-
-            # decrypt the response
-            response_dict = decrypt_request(resp.text, secret)
-
-            assert response_dict['reqid'] == request_dict['reqid']
-            assert response_dict['success'] is False
-            assert isinstance(response_dict['response'], dict)
-            assert response_dict['response']['user_id'] is None
+    def new_session(reqid):
+        '''
+        This makes a new anonymous session and returns its token.
 
-        #
-        # check if the timings follow the expected trend
-        #
-        diffs = [timing[x+1]-timing[x] for x in range(4)]
-        diffs_increasing = all(diffs[x+1] > diffs[x] for x in range(3))
-        assert diffs_increasing is True
+        '''
 
-        # now login wih the correct password and see if the login time goes back
-        # to normal
         session_payload = {
             'user_id':2,
             'user_agent':'Mozzarella Killerwhale',
@@ -299,7 +373,7 @@ def test_server_invalid_logins(monkeypatch, tmpdir):
 
         request_dict = {'request':'session-new',
                         'body':session_payload,
-                        'reqid':1004}
+                        'reqid':reqid}
 
         encrypted_request = encrypt_response(request_dict, secret)
 
@@ -319,41 +393,92 @@ def test_server_invalid_logins(monkeypatch, tmpdir):
         assert isinstance(session_dict['response'], dict)
         assert session_dict['response']['session_token'] is not None
 
+        return session_dict['response']['session_token']
+
+    def login(reqid, session_token, login_password):
+        '''
+        This tries to log in and returns the HTTP response.
+
+        '''
+
         request_dict = {
             'request':'user-login',
             'body':{
-                'session_token':session_dict['response']['session_token'],
+                'session_token':session_token,
                 'email':useremail,
-                'password':password
+                'password':login_password
             },
-            'reqid':1005
+            'reqid':reqid
         }
 
         encrypted_request = encrypt_response(request_dict, secret)
 
-        start_login_time = time.monotonic()
-
         # send the request to the authnzerver
-        resp = requests.post(
+        return requests.post(
             'http://%s:%s' % (server_listen, server_port),
             data=encrypted_request,
-            timeout=60.0
+            timeout=5.0
         )
-        resp.raise_for_status()
 
-        timing.append(time.monotonic() - start_login_time)
+    retry_afters = []
+
+    try:
+
+        #
+        # attempt to login as the superuser several times with the wrong
+        # password
+        #
+        for i in range(4):
+
+            session_token = new_session(i)
+
+            resp = login(10*i + 10, session_token, '%s-%i' % (password, i))
+            resp.raise_for_status()
+
+            # decrypt the response
+            response_dict = decrypt_request(resp.text, secret)
+
+            assert response_dict['reqid'] == 10*i + 10
+            assert response_dict['success'] is False
+            assert isinstance(response_dict['response'], dict)
+            assert response_dict['response']['user_id'] is None
+
+            # trying again right away is turned away without checking the
+            # password
+            start_login_time = time.monotonic()
+            resp = login(10*i + 11, session_token, password)
+            assert resp.status_code == 429
+            assert time.monotonic() - start_login_time < 1.0
+
+            retry_after = int(resp.headers['Retry-After'])
+            retry_afters.append(retry_after)
+
+            # wait until we're allowed to try again
+            time.sleep(retry_after)
+
+        #
+        # check if the lockouts follow the expected trend
+        #
+        assert retry_afters == sorted(retry_afters)
+        assert retry_afters[-1] > retry_afters[0]
+
+        # now login wih the correct password once we're allowed to
+        session_token = new_session(1004)
+        resp = login(1005, session_token, password)
+        resp.raise_for_status()
 
         # decrypt the response
         response_dict = decrypt_request(resp.text, secret)
 
-        assert response_dict['reqid'] == request_dict['reqid']
+        assert response_dict['reqid'] == 1005
         assert response_dict['success'] is True
         assert isinstance(response_dict['response'], dict)
         assert response_dict['response']['user_id'] == 1
 
-        # the latest time should be less than the 1st time (when throttling was
-        # activated) and also less than the immediately previous time
-        assert ((timing[-1] < timing[0]) and (timing[-1] < timing[-2]))
+        # the failed logins are forgotten after a successful login
+        session_token = new_session(1006)
+        resp = login(1007, session_token, 'wrong-password')
+        assert resp.status_code == 200
 
     finally:
 
@@ -374,3 +499,112 @@ def test_server_invalid_logins(monkeypatch, tmpdir):
             "lsof | grep 18158 | awk '{ print $2 }' | sort | uniq | xargs kill",
             shell=True
         )
+
+
+def test_server_load_shedding(monkeypatch, tmpdir):
+    '''This tests if the server turns requests away when a worker pool's queue
+    is full.
+
+    '''
+
+    # the basedir will be the pytest provided temporary directory
+    basedir = str(tmpdir)
+
+    # we'll make the auth DB and secrets file first
+    authdb_path, creds, secrets_file = autogen_secrets_authdb(
+        basedir,
+        interactive=False
+    )
+
+    # read in the secrets file for the secret
+    with open(secrets_file,'r') as infd:
+        secret = infd.read().strip('\n')
+
+    # get a temp directory
+    tmpdir = os.path.join('/tmp', 'authnzrv-%s' % secrets.token_urlsafe(8))
+
+    server_listen = '127.0.0.1'
+    server_port = '18158'
+
+    # set up the environment. the hashing pool has one worker and no room for
+    # waiting requests
+    monkeypatch.setenv("AUTHNZERVER_AUTHDB", authdb_path)
+    monkeypatch.setenv("AUTHNZERVER_BASEDIR", basedir)
+    monkeypatch.setenv("AUTHNZERVER_CACHEDIR", tmpdir)
+    monkeypatch.setenv("AUTHNZERVER_DEBUGMODE", "0")
+    monkeypatch.setenv("AUTHNZERVER_LISTEN", server_listen)
+    monkeypatch.setenv("AUTHNZERVER_PORT", server_port)
+    monkeypatch.setenv("AUTHNZERVER_SECRET", secret)
+    monkeypatch.setenv("AUTHNZERVER_SESSIONEXPIRY", "60")
+    monkeypatch.setenv("AUTHNZERVER_WORKERS", "1")
+    monkeypatch.setenv("AUTHNZERVER_HASHWORKERS", "1")
+    monkeypatch.setenv("AUTHNZERVER_MAXQUEUED", "hashing:0")
+    monkeypatch.setenv("AUTHNZERVER_EMAILSERVER", "smtp.test.org")
+    monkeypatch.setenv("AUTHNZERVER_EMAILPORT", "25")
+    monkeypatch.setenv("AUTHNZERVER_EMAILUSER", "testuser")
+    monkeypatch.setenv("AUTHNZERVER_EMAILPASS", "testpass")
+
+    # launch the server subprocess
+    p = subprocess.Popen("authnzrv", shell=True)
+
+    # wait 2.5 seconds for the server to start
+    time.sleep(2.5)
+
+    try:
+
+        async def client_requests():
+
+            authnzerver_client = AuthnzerverClient(
+                'http://%s:%s' % (server_listen, server_port),
+                secret
+            )
+
+            # only the first of these fits in the hashing pool
+            results = await authnzerver_client.request_many(
+                [('user-passcheck',
+                  {'session_token':'nope',
+                   'password':'nope'})]*5,
+                retry=False
+            )
+
+            # lookups aren't affected
+            lookup = await authnzerver_client.request(
+                'session-exists',
+                {'session_token':'nope'}
+            )
+            metrics = await authnzerver_client.request('server-metrics', {})
+
+            authnzerver_client.close()
+            return results, lookup, metrics
+
+        results, lookup, metrics = asyncio.run(client_requests())
+
+        # the answered requests have a response, the shed ones don't
+        answered = [x for x in results if x[1] is not None]
+        shed = [x for x in results if x[1] is None]
+        assert len(answered) >= 1
+        assert len(shed) >= 1
+
+        assert lookup[1] is not None
+
+        pools = metrics[1]['pools']
+        assert pools['hashing']['queue_limit'] == 0
+        assert pools['hashing']['shed'] == len(shed)
+        assert pools['hashing']['submitted'] == len(answered)
+        assert pools['default']['shed'] == 0
+
+    finally:
+
+        p.kill()
+        try:
+            p.communicate(timeout=1.0)
+            p.kill()
+        except Exception:
+            pass
+
+        # make sure to kill authnzrv on some Linux machines.  use lsof and the
+        # port number to find the remaining authnzrv processes and kill them
+        subprocess.call(
+            "lsof | grep 18158 | awk '{ print $2 }' | sort | uniq | xargs kill",
+            shell=True
+        )
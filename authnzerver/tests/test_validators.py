@@ -0,0 +1,59 @@
+'''test_validators.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+License: MIT. See the LICENSE file for details.
+
+This contains tests for the fuzzy common password check in
+authnzerver.validators.
+
+'''
+
+from .. import validators
+from ..actions.user import validate_input_password
+
+
+def test_ngram_index():
+    '''
+    This tests finding the most similar string in an n-gram index.
+
+    '''
+
+    index = validators.NGramIndex(['password', 'dragon', 'qwertyuiop', 'ab'])
+    assert len(index) == 4
+
+    assert index.most_similar('dragon') == (1.0, 'dragon')
+    assert index.most_similar('ab') == (1.0, 'ab')
+    assert index.most_similar('zzzzzz') == (0.0, None)
+
+    # 6 shared trigrams out of 8 + 6
+    similarity, match = index.most_similar('passwordpasswordpassword')
+    assert match == 'password'
+    assert similarity == 2.0*6/(8 + 6)
+
+
+def test_similar_common_passwords():
+    '''
+    This tests if dressed-up common passwords are caught.
+
+    '''
+
+    for password in ('passwordpasswordpassword',
+                     'qwertyuiop1234',
+                     'sunshine!sunshine',
+                     'trustno1trustno1',
+                     'abc123abc123abc123'):
+        assert validators.find_similar_common_password(password) is not None
+
+    for password in ('aROwQin9L8nNtPTEMLXd',
+                     'correcthorsebatterystaple',
+                     'incorrectponylithiumfastener',
+                     'MyDogSpotLikesBones'):
+        assert validators.find_similar_common_password(password) is None
+
+    passok, messages = validate_input_password(
+        'Test User',
+        'testuser@test.org',
+        'passwordpasswordpassword',
+        max_match_threshold=30
+    )
+    assert passok is False
+    assert ('Your password is too similar to one of the most common '
+            'passwords and is vulnerable to guessing.' in messages)
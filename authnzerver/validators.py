@@ -56,6 +56,7 @@ LOGGER = logging.getLogger(__name__)
 import unicodedata
 import re
 import os.path
+from collections import Counter
 
 from confusable_homoglyphs import confusables
 
@@ -234,6 +235,141 @@ with open(TENK_PASSWORDS_FILE,'r') as infd:
     TOP_10K_PASSWORDS = {x.strip('\n') for x in infd.readlines()}
 
 
+###################################
+## FUZZY MATCHING COMMON STRINGS ##
+###################################
+
+def get_ngrams(value, ngram_size=3):
+    '''This returns the set of character n-grams in value.
+
+    Values shorter than ngram_size are their own single n-gram.
+
+    '''
+
+    if len(value) <= ngram_size:
+        return {value}
+
+    return {value[i:i+ngram_size] for i in range(len(value) - ngram_size + 1)}
+
+
+class NGramIndex(object):
+    '''This is an inverted index from character n-grams to a list of strings.
+
+    It finds the strings that are most similar to a query without comparing
+    the query to every string. Only the strings that share at least one n-gram
+    with the query are looked at. Similarity is the Dice coefficient of the
+    two sets of n-grams: 2 x shared / (query n-grams + string n-grams), so 1.0
+    is an exact match and 0.0 means nothing in common.
+
+    '''
+
+    def __init__(self, values, ngram_size=3):
+        '''
+        This builds the index for the values.
+
+        '''
+
+        self.ngram_size = ngram_size
+        self.values = sorted(values)
+        self.ngram_counts = []
+        self.postings = {}
+
+        for ind, value in enumerate(self.values):
+
+            ngrams = get_ngrams(value, ngram_size=ngram_size)
+            self.ngram_counts.append(len(ngrams))
+
+            for ngram in ngrams:
+                self.postings.setdefault(ngram, []).append(ind)
+
+    def __len__(self):
+        '''
+        This returns the number of strings in the index.
+
+        '''
+
+        return len(self.values)
+
+    def most_similar(self, query):
+        '''This finds the indexed string that's most similar to the query.
+
+        Returns a (similarity, string) tuple, or (0.0, None) if no indexed
+        string has any n-grams in common with the query.
+
+        '''
+
+        ngrams = get_ngrams(query, ngram_size=self.ngram_size)
+
+        shared = Counter()
+        for ngram in ngrams:
+            postings = self.postings.get(ngram)
+            if postings is not None:
+                shared.update(postings)
+
+        best_similarity, best_value = 0.0, None
+
+        for ind, nshared in shared.items():
+            similarity = 2.0*nshared/(len(ngrams) + self.ngram_counts[ind])
+            if similarity > best_similarity:
+                best_similarity, best_value = similarity, self.values[ind]
+
+        return best_similarity, best_value
+
+
+# this is built on first use so processes that don't check passwords don't
+# have to carry it around
+_COMMON_PASSWORD_INDEX = None
+
+
+def get_common_password_index():
+    '''
+    This returns the n-gram index of the top 10k passwords for this process.
+
+    '''
+
+    global _COMMON_PASSWORD_INDEX
+
+    if _COMMON_PASSWORD_INDEX is None:
+        _COMMON_PASSWORD_INDEX = NGramIndex(TOP_10K_PASSWORDS)
+
+    return _COMMON_PASSWORD_INDEX
+
+
+def find_similar_common_password(password, min_similarity=0.7):
+    '''This finds a top 10k password that's nearly the same as password.
+
+    This catches common passwords that have been repeated, padded, or lightly
+    changed, e.g. 'passwordpasswordpassword' or 'qwertyuiop1234'.
+
+    Parameters
+    ----------
+
+    password : str
+        The password to check. This is casefolded before it's compared.
+
+    min_similarity : float
+        The n-gram similarity (see :py:class:`.NGramIndex`) above which a
+        common password counts as a match.
+
+    Returns
+    -------
+
+    str or None
+        The most similar common password if it's at least min_similarity
+        similar to password, otherwise None.
+
+    '''
+
+    similarity, match = get_common_password_index().most_similar(
+        password.casefold()
+    )
+
+    if similarity >= min_similarity:
+        return match
+    else:
+        return None
+
+
 ###############
 ## FUNCTIONS ##
 ###############
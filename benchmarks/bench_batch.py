@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_batch.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This measures the latency of a typical page load's authnzerver requests:
+session-exists, check-user-access, check-user-limit, and apikey-verify.
+
+These are sent one after the other, all at once as separate requests, and in
+a single batch request.
+
+This starts a local authnzerver (the authnzrv script must be installed).
+
+Run it like so::
+
+    python benchmarks/bench_batch.py
+
+'''
+
+import os
+import os.path
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import tornado.ioloop
+
+from authnzerver.autosetup import autogen_secrets_authdb
+from authnzerver.client import AuthnzerverClient
+
+
+AUTHNZERVER_PORT = 18261
+
+
+def page_load_requests(session_token):
+    '''
+    This returns the requests a frontend makes for a single page load.
+
+    '''
+
+    return [
+        ('session-exists',
+         {'session_token':session_token}),
+        ('check-user-access',
+         {'user_id':2,
+          'user_role':'anonymous',
+          'action':'view',
+          'target_name':'dataset',
+          'target_owner':1,
+          'target_visibility':'public',
+          'target_sharedwith':''}),
+        ('check-user-limit',
+         {'user_id':2,
+          'user_role':'anonymous',
+          'limit_name':'max_requests',
+          'value_to_check':10}),
+        ('apikey-verify',
+         {'apikey_dict':{'uid':2,
+                         'rol':'anonymous',
+                         'tkn':'not-a-real-token',
+                         'exp':(datetime.utcnow() +
+                                timedelta(hours=1)).isoformat()}}),
+    ]
+
+
+async def sequential(client, requests):
+    '''
+    This sends the requests one after the other.
+
+    '''
+
+    return [await client.request(*x) for x in requests]
+
+
+async def concurrent(client, requests):
+    '''
+    This sends the requests at the same time as separate requests.
+
+    '''
+
+    return await client.request_many(requests)
+
+
+async def batched(client, requests):
+    '''
+    This sends the requests as a single batch request.
+
+    '''
+
+    return await client.request_batch(requests)
+
+
+async def run_bench(func, client, requests, npages):
+    '''
+    This runs npages page loads and returns the mean and 95th percentile
+    latency in milliseconds.
+
+    '''
+
+    latencies = []
+
+    for _ in range(npages):
+        start = time.perf_counter()
+        results = await func(client, requests)
+        latencies.append((time.perf_counter() - start)*1.0e3)
+        assert len(results) == len(requests)
+
+    latencies.sort()
+    return (sum(latencies)/len(latencies),
+            latencies[int(0.95*len(latencies))])
+
+
+async def main(npages=500):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        authdb_path, creds, secrets_file = autogen_secrets_authdb(
+            basedir,
+            interactive=False
+        )
+        with open(secrets_file,'r') as infd:
+            secret = infd.read().strip('\n')
+
+        env = os.environ.copy()
+        env.update({
+            "AUTHNZERVER_AUTHDB":authdb_path,
+            "AUTHNZERVER_BASEDIR":basedir,
+            "AUTHNZERVER_CACHEDIR":os.path.join(basedir, 'cache'),
+            "AUTHNZERVER_DEBUGMODE":"0",
+            "AUTHNZERVER_LISTEN":"127.0.0.1",
+            "AUTHNZERVER_PORT":str(AUTHNZERVER_PORT),
+            "AUTHNZERVER_SECRET":secret,
+            "AUTHNZERVER_SESSIONEXPIRY":"60",
+            "AUTHNZERVER_WORKERS":"2",
+        })
+        authnzrv = subprocess.Popen(['authnzrv'], env=env)
+        time.sleep(2.5)
+
+        try:
+
+            client = AuthnzerverClient('http://127.0.0.1:%s' %
+                                       AUTHNZERVER_PORT,
+                                       secret)
+
+            ok, resp, msgs = await client.request(
+                'session-new',
+                {'user_id':2,
+                 'user_agent':'bench',
+                 'expires':datetime.utcnow() + timedelta(hours=1),
+                 'ip_address':'127.0.0.1',
+                 'extra_info_json':{}}
+            )
+            requests = page_load_requests(resp['session_token'])
+
+            for name, func in (('sequential', sequential),
+                               ('concurrent', concurrent),
+                               ('batch', batched)):
+                mean_ms, p95_ms = await run_bench(func,
+                                                  client,
+                                                  requests,
+                                                  npages)
+                print('%-12s page load: mean %6.2f ms, p95 %6.2f ms' %
+                      (name, mean_ms, p95_ms))
+
+            client.close()
+
+        finally:
+            authnzrv.terminate()
+            authnzrv.wait()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
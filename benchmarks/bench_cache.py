@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_cache.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This compares opening a new diskcache handle for every cache operation
+against reusing the long-lived per-process handle from authnzerver.cache.
+
+Run it like so::
+
+    python benchmarks/bench_cache.py
+
+'''
+
+import os.path
+import tempfile
+import time
+
+from diskcache import FanoutCache
+
+from authnzerver import cache
+
+
+def reopening_increment(key, cache_dirname, timeout_seconds=0.3):
+    '''
+    This is the cache_increment implementation that opens a new handle.
+
+    '''
+
+    cachedir = os.path.abspath(cache_dirname)
+    fcache = FanoutCache(cachedir, timeout=timeout_seconds)
+    fcache.add(key, time.time())
+    key_count = fcache.incr('%s-counter' % key)
+    fcache.close()
+    return key_count
+
+
+def reopening_get(key, cache_dirname, timeout_seconds=0.3):
+    '''
+    This is the cache_get implementation that opens a new handle.
+
+    '''
+
+    cachedir = os.path.abspath(cache_dirname)
+    fcache = FanoutCache(cachedir, timeout=timeout_seconds)
+    val = fcache.get(key)
+    fcache.close()
+    return val
+
+
+def run_bench(func, cache_dirname, repeats):
+    '''
+    This runs func repeats times and returns the mean time per call in
+    microseconds.
+
+    '''
+
+    start = time.perf_counter()
+
+    for ind in range(repeats):
+        func('bench-key-%s' % (ind % 100), cache_dirname)
+
+    elapsed = time.perf_counter() - start
+    return elapsed/repeats*1.0e6
+
+
+def main(repeats=2000):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as tempdir:
+
+        cache_dirname = os.path.join(tempdir, 'authnzerver-cache')
+
+        results = [
+            ('increment', reopening_increment,
+             lambda k, d: cache.cache_increment(k, cache_dirname=d)),
+            ('get', reopening_get,
+             lambda k, d: cache.cache_get(k, cache_dirname=d)),
+        ]
+
+        for name, before_func, after_func in results:
+
+            before_us = run_bench(before_func, cache_dirname, repeats)
+            after_us = run_bench(after_func, cache_dirname, repeats)
+
+            print('%-10s new handle per call: %9.1f us/op' % (name, before_us))
+            print('%-10s shared handle:       %9.1f us/op' % (name, after_us))
+            print('%-10s speedup:             %9.1fx' %
+                  (name, before_us/after_us))
+
+        cache.cache_close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_client.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This compares the old way BaseHandler talked to the authnzerver (a new HTTP
+client per request, encryption in an executor, random request IDs from
+0-10000) against the AuthnzerverClient sending requests one at a time and all at
+once.
+
+This starts a local authnzerver (the authnzrv script must be installed) and
+sends session-exists requests to it.
+
+Run it like so::
+
+    python benchmarks/bench_client.py
+
+'''
+
+import os
+import os.path
+import json
+import random
+import subprocess
+import tempfile
+import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient
+from cryptography.fernet import Fernet
+
+from authnzerver.autosetup import autogen_secrets_authdb
+from authnzerver.client import AuthnzerverClient, ClientEncoder, \
+    decrypt_response
+
+
+AUTHNZERVER_PORT = 18260
+
+
+def legacy_encrypt(request_dict, ferneter):
+    '''
+    This is how BaseHandler used to encrypt requests.
+
+    '''
+
+    json_bytes = json.dumps(request_dict, cls=ClientEncoder).encode()
+    return b64encode(ferneter.encrypt(json_bytes))
+
+
+async def legacy_request(url, ferneter, executor, payload):
+    '''
+    This makes a request the way BaseHandler used to.
+
+    '''
+
+    loop = tornado.ioloop.IOLoop.current()
+    reqid = random.randint(0, 10000)
+
+    encrypted_req = await loop.run_in_executor(
+        executor,
+        legacy_encrypt,
+        {'request':'session-exists', 'body':payload, 'reqid':reqid},
+        ferneter
+    )
+
+    httpclient = AsyncHTTPClient(force_instance=True)
+    resp = await httpclient.fetch(url,
+                                  method='POST',
+                                  body=encrypted_req,
+                                  raise_error=False)
+    httpclient.close()
+
+    if resp.code != 200:
+        return False
+
+    respdict = await loop.run_in_executor(executor,
+                                          decrypt_response,
+                                          resp.body,
+                                          ferneter)
+    return respdict is not None and respdict['reqid'] == reqid
+
+
+async def run_legacy(url, secret, payload, nrequests, concurrency):
+    '''
+    This runs the legacy requests and returns requests/sec and failures.
+
+    '''
+
+    ferneter = Fernet(secret)
+    executor = ThreadPoolExecutor(max_workers=4)
+    failed = 0
+    start = time.perf_counter()
+
+    for batch_start in range(0, nrequests, concurrency):
+        batch = [
+            legacy_request(url, ferneter, executor, payload)
+            for _ in range(min(concurrency, nrequests - batch_start))
+        ]
+        for ok in [await x for x in batch]:
+            if not ok:
+                failed += 1
+
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return nrequests/elapsed, failed
+
+
+async def run_client(client, payload, nrequests, concurrency):
+    '''
+    This runs the client requests and returns requests/sec and failures.
+
+    '''
+
+    failed = 0
+    start = time.perf_counter()
+
+    for batch_start in range(0, nrequests, concurrency):
+        results = await client.request_many(
+            [('session-exists', payload)] *
+            min(concurrency, nrequests - batch_start)
+        )
+        failed += sum(1 for x in results if x[1] is None)
+
+    elapsed = time.perf_counter() - start
+    return nrequests/elapsed, failed
+
+
+async def main(nrequests=1000, concurrency=50):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        authdb_path, creds, secrets_file = autogen_secrets_authdb(
+            basedir,
+            interactive=False
+        )
+        with open(secrets_file,'r') as infd:
+            secret = infd.read().strip('\n')
+
+        env = os.environ.copy()
+        env.update({
+            "AUTHNZERVER_AUTHDB":authdb_path,
+            "AUTHNZERVER_BASEDIR":basedir,
+            "AUTHNZERVER_CACHEDIR":os.path.join(basedir, 'cache'),
+            "AUTHNZERVER_DEBUGMODE":"0",
+            "AUTHNZERVER_LISTEN":"127.0.0.1",
+            "AUTHNZERVER_PORT":str(AUTHNZERVER_PORT),
+            "AUTHNZERVER_SECRET":secret,
+            "AUTHNZERVER_SESSIONEXPIRY":"60",
+            "AUTHNZERVER_WORKERS":"2",
+        })
+        authnzrv = subprocess.Popen(['authnzrv'], env=env)
+        time.sleep(2.5)
+
+        url = 'http://127.0.0.1:%s' % AUTHNZERVER_PORT
+
+        try:
+
+            client = AuthnzerverClient(url, secret, max_in_flight=concurrency)
+
+            ok, resp, msgs = await client.request(
+                'session-new',
+                {'user_id':2,
+                 'user_agent':'bench',
+                 'expires':datetime.utcnow() + timedelta(hours=1),
+                 'ip_address':'127.0.0.1',
+                 'extra_info_json':{}}
+            )
+            payload = {'session_token':resp['session_token']}
+
+            results = [
+                ('legacy',
+                 await run_legacy(url, secret, payload,
+                                  nrequests, concurrency)),
+                ('client, 1 at a time',
+                 await run_client(client, payload, nrequests, 1)),
+                ('client, %s at a time' % concurrency,
+                 await run_client(client, payload, nrequests, concurrency)),
+            ]
+
+            for name, (reqs_per_sec, failed) in results:
+                print('%-22s %8.1f requests/sec, %s failed' %
+                      (name, reqs_per_sec, failed))
+
+            client.close()
+
+        finally:
+            authnzrv.terminate()
+            authnzrv.wait()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_common_passwords.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This compares fuzzy matching a password against the top 10k passwords list
+by running fuzzywuzzy's UQRatio against every entry with the n-gram index in
+authnzerver.validators.
+
+Run it like so::
+
+    python benchmarks/bench_common_passwords.py
+
+'''
+
+import time
+
+from fuzzywuzzy.fuzz import UQRatio
+
+from authnzerver import validators
+
+
+PASSWORDS = [
+    'passwordpasswordpassword',
+    'qwertyuiop1234',
+    'sunshine!sunshine',
+    'football123456',
+    'aROwQin9L8nNtPTEMLXd',
+    'correcthorsebatterystaple',
+    'incorrectponylithiumfastener',
+    'MyDogSpotLikesBones',
+]
+
+
+def linear_scan(password):
+    '''
+    This runs UQRatio against every password in the list.
+
+    '''
+
+    password = password.casefold()
+    return max((UQRatio(password, x), x) for x in validators.TOP_10K_PASSWORDS)
+
+
+def ngram_index(password):
+    '''
+    This looks up the password in the n-gram index.
+
+    '''
+
+    return validators.get_common_password_index().most_similar(
+        password.casefold()
+    )
+
+
+def run_bench(func, nrepeats):
+    '''
+    This returns the mean time per password in milliseconds.
+
+    '''
+
+    start = time.perf_counter()
+    for _ in range(nrepeats):
+        for password in PASSWORDS:
+            func(password)
+    elapsed = time.perf_counter() - start
+
+    return elapsed/(nrepeats*len(PASSWORDS))*1.0e3
+
+
+def main():
+    '''
+    This runs the benchmark.
+
+    '''
+
+    start = time.perf_counter()
+    validators.get_common_password_index()
+    print('index build: %.1f ms' % ((time.perf_counter() - start)*1.0e3))
+
+    for name, func, nrepeats in (('UQRatio linear scan', linear_scan, 1),
+                                 ('n-gram index', ngram_index, 200)):
+        print('%-20s %9.3f ms/password' % (name, run_bench(func, nrepeats)))
+
+    print()
+    for password in PASSWORDS:
+        similarity, match = ngram_index(password)
+        print('%-30s %.2f %s' % (password, similarity, match))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_dispatch.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This compares running lookup requests in the authnzerver's background
+workers against running them inline on its IOLoop.
+
+This starts a local authnzerver (the authnzrv script must be installed) once
+for each dispatch setting and sends check-user-limit and session-exists
+requests to it, then prints the server's own per-class latency metrics.
+
+Run it like so::
+
+    python benchmarks/bench_dispatch.py
+
+'''
+
+import os
+import os.path
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import tornado.ioloop
+
+from authnzerver.autosetup import autogen_secrets_authdb
+from authnzerver.client import AuthnzerverClient
+
+
+AUTHNZERVER_PORT = 18262
+
+
+async def run_bench(url, secret, nrequests, concurrency):
+    '''
+    This sends the requests and returns requests/sec and the server metrics.
+
+    '''
+
+    client = AuthnzerverClient(url, secret, max_in_flight=concurrency)
+
+    ok, resp, msgs = await client.request(
+        'session-new',
+        {'user_id':2,
+         'user_agent':'bench',
+         'expires':datetime.utcnow() + timedelta(hours=1),
+         'ip_address':'127.0.0.1',
+         'extra_info_json':{}}
+    )
+
+    requests = [
+        ('session-exists', {'session_token':resp['session_token']}),
+        ('check-user-limit', {'user_id':2,
+                              'user_role':'anonymous',
+                              'limit_name':'max_requests',
+                              'value_to_check':10}),
+    ]
+
+    start = time.perf_counter()
+
+    for batch_start in range(0, nrequests, concurrency):
+        await client.request_many(
+            [requests[ind % 2]
+             for ind in range(min(concurrency, nrequests - batch_start))]
+        )
+
+    elapsed = time.perf_counter() - start
+
+    ok, resp, msgs = await client.request('server-metrics', {})
+    client.close()
+
+    return nrequests/elapsed, resp['metrics']['lookup']
+
+
+async def main(nrequests=2000, concurrency=20):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        authdb_path, creds, secrets_file = autogen_secrets_authdb(
+            basedir,
+            interactive=False
+        )
+        with open(secrets_file,'r') as infd:
+            secret = infd.read().strip('\n')
+
+        for dispatch in ('lookup:process', 'lookup:inline'):
+
+            env = os.environ.copy()
+            env.update({
+                "AUTHNZERVER_AUTHDB":authdb_path,
+                "AUTHNZERVER_BASEDIR":basedir,
+                "AUTHNZERVER_CACHEDIR":os.path.join(basedir, 'cache'),
+                "AUTHNZERVER_DEBUGMODE":"0",
+                "AUTHNZERVER_DISPATCH":dispatch,
+                "AUTHNZERVER_LISTEN":"127.0.0.1",
+                "AUTHNZERVER_PORT":str(AUTHNZERVER_PORT),
+                "AUTHNZERVER_SECRET":secret,
+                "AUTHNZERVER_SESSIONEXPIRY":"60",
+                "AUTHNZERVER_WORKERS":"2",
+            })
+            authnzrv = subprocess.Popen(['authnzrv'], env=env)
+            time.sleep(2.5)
+
+            try:
+
+                reqs_per_sec, lookup_metrics = await run_bench(
+                    'http://127.0.0.1:%s' % AUTHNZERVER_PORT,
+                    secret,
+                    nrequests,
+                    concurrency
+                )
+                print('%-15s %8.1f requests/sec, server-side lookup latency: '
+                      'mean %.3f ms, p99 %.3f ms' %
+                      (dispatch, reqs_per_sec,
+                       lookup_metrics['mean_ms'], lookup_metrics['p99_ms']))
+
+            finally:
+                authnzrv.terminate()
+                authnzrv.wait()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_failed_logins.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This simulates a credential stuffing attack against many accounts and
+compares the memory used to track failed logins by an unbounded dict against
+authnzerver.cache.FailedLoginTracker.
+
+Run it like so::
+
+    python benchmarks/bench_failed_logins.py
+
+'''
+
+import time
+import tracemalloc
+
+from authnzerver import cache
+
+
+def dict_tracker(failed_passchecks, email, ip_address):
+    '''
+    This is the old failed_passchecks dict update.
+
+    '''
+
+    if email in failed_passchecks:
+        failed_passchecks[email] += 1
+    else:
+        failed_passchecks[email] = 1
+
+
+def bounded_tracker(tracker, email, ip_address):
+    '''
+    This is the FailedLoginTracker update.
+
+    '''
+
+    keys = ['email:%s' % email, 'ip:%s' % ip_address]
+    if tracker.check(keys) == 0.0:
+        tracker.record_failure(keys)
+
+
+def run_bench(func, tracker, naccounts):
+    '''This runs func for naccounts emails and returns the time per call in
+    microseconds and the traced memory in MB after every 20% of the accounts.
+
+    '''
+
+    memory = []
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    for ind in range(naccounts):
+        func(tracker,
+             'user%s@example.com' % ind,
+             '10.0.%s.%s' % ((ind//256) % 256, ind % 256))
+        if (ind + 1) % (naccounts//5) == 0:
+            memory.append(tracemalloc.get_traced_memory()[0]/1.0e6)
+
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    return elapsed/naccounts*1.0e6, memory
+
+
+def main(naccounts=100000, maxsize=10000):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    results = [
+        ('unbounded dict', dict_tracker, {}),
+        ('tracker (maxsize=%s)' % maxsize, bounded_tracker,
+         cache.FailedLoginTracker(maxsize=maxsize)),
+    ]
+
+    for name, func, tracker in results:
+
+        per_call_us, memory = run_bench(func, tracker, naccounts)
+        print('%-26s %7.1f us/op, memory (MB) at 20%% steps: %s' %
+              (name, per_call_us, ' '.join('%.1f' % x for x in memory)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_frontend_prepare.py - Waqas Bhatti (wbhatti@astro.princeton.edu) -
+# Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This measures the throughput of BaseHandler.prepare() when using a new HTTP
+client for every request compared to the shared HTTP client.
+
+This starts a local authnzerver (the authnzrv script must be installed) and a
+frontend server using a BaseHandler subclass. It then makes requests to the
+frontend using an existing session cookie, so each request results in a single
+session-exists request to the authnzerver.
+
+Run it like so::
+
+    python benchmarks/bench_frontend_prepare.py
+
+'''
+
+import os
+import os.path
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient
+
+from authnzerver.autosetup import autogen_secrets_authdb
+from authnzerver import frontendbase
+
+
+AUTHNZERVER_PORT = 18258
+FRONTEND_PORT = 18259
+
+
+class PooledClientHandler(frontendbase.BaseHandler):
+    '''
+    This uses the shared HTTP client.
+
+    '''
+
+    def get(self):
+        self.write({'user_id':self.user_id})
+
+
+class PerRequestClientHandler(PooledClientHandler):
+    '''
+    This uses a new HTTP client for every request like BaseHandler used to.
+
+    '''
+
+    def initialize(self, **kwargs):
+        super().initialize(**kwargs)
+        self.httpclient = AsyncHTTPClient(force_instance=True)
+
+    def on_finish(self):
+        self.httpclient.close()
+
+
+async def run_bench(url, nrequests, concurrency):
+    '''
+    This makes nrequests to url with the given concurrency.
+
+    Returns the requests per second and the number of failed requests.
+
+    '''
+
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+
+    # get a session cookie first
+    resp = await client.fetch(url)
+    cookie = resp.headers['Set-Cookie'].split(';')[0]
+
+    failed = 0
+    start = time.perf_counter()
+
+    for batch_start in range(0, nrequests, concurrency):
+
+        batch = [
+            client.fetch(url,
+                         headers={'Cookie':cookie},
+                         follow_redirects=False,
+                         raise_error=False)
+            for _ in range(min(concurrency, nrequests - batch_start))
+        ]
+
+        for resp in [await x for x in batch]:
+            if resp.code != 200:
+                failed += 1
+
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    return nrequests/elapsed, failed
+
+
+async def main(nrequests=500, concurrency=20):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        authdb_path, creds, secrets_file = autogen_secrets_authdb(
+            basedir,
+            interactive=False
+        )
+        with open(secrets_file,'r') as infd:
+            secret = infd.read().strip('\n')
+
+        env = os.environ.copy()
+        env.update({
+            "AUTHNZERVER_AUTHDB":authdb_path,
+            "AUTHNZERVER_BASEDIR":basedir,
+            "AUTHNZERVER_CACHEDIR":os.path.join(basedir, 'cache'),
+            "AUTHNZERVER_DEBUGMODE":"0",
+            "AUTHNZERVER_LISTEN":"127.0.0.1",
+            "AUTHNZERVER_PORT":str(AUTHNZERVER_PORT),
+            "AUTHNZERVER_SECRET":secret,
+            "AUTHNZERVER_SESSIONEXPIRY":"60",
+            "AUTHNZERVER_WORKERS":"2",
+        })
+        authnzrv = subprocess.Popen(['authnzrv'], env=env)
+        time.sleep(2.5)
+
+        try:
+
+            handler_kwargs = {
+                'authnzerver':'http://127.0.0.1:%s' % AUTHNZERVER_PORT,
+                'fernetkey':secret,
+                'executor':ThreadPoolExecutor(max_workers=4),
+                'session_settings':{'expiry_days':30,
+                                    'cookie_name':'bench_session',
+                                    'cookie_secure':False},
+                'api_settings':{'maxrate_60sec':False,
+                                'version':1,
+                                'expiry_days':30,
+                                'issuer':'authnzerver'},
+                'email_settings':{'email_server':None,
+                                  'email_port':None,
+                                  'email_user':None,
+                                  'email_pass':None},
+                'cachedir':os.path.join(basedir, 'frontend-cache'),
+            }
+
+            app = tornado.web.Application(
+                [(r'/per-request', PerRequestClientHandler, handler_kwargs),
+                 (r'/pooled', PooledClientHandler, handler_kwargs)],
+                cookie_secret=secret,
+            )
+            app.listen(FRONTEND_PORT, '127.0.0.1')
+
+            for name in ('per-request', 'pooled'):
+                reqs_per_sec, failed = await run_bench(
+                    'http://127.0.0.1:%s/%s' % (FRONTEND_PORT, name),
+                    nrequests,
+                    concurrency
+                )
+                print('%-12s client: %8.1f requests/sec, %s failed' %
+                      (name, reqs_per_sec, failed))
+
+        finally:
+            authnzrv.terminate()
+            authnzrv.wait()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_hashpool.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This measures session-exists latency during a burst of password checks,
+with all requests sharing one worker pool and with password hashing requests
+going to their own pool.
+
+Lookups are sent to the workers (AUTHNZERVER_DISPATCH=lookup:process) so they
+compete with the password checks in the shared pool case.
+
+This starts a local authnzerver (the authnzrv script must be installed) once
+for each setting.
+
+Run it like so::
+
+    python benchmarks/bench_hashpool.py
+
+'''
+
+import asyncio
+import os
+import os.path
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import tornado.ioloop
+
+from authnzerver.autosetup import autogen_secrets_authdb
+from authnzerver.client import AuthnzerverClient
+
+
+AUTHNZERVER_PORT = 18263
+
+
+async def timed_lookup(client, session_token):
+    '''
+    This returns the latency of a single session-exists request in ms.
+
+    '''
+
+    start = time.perf_counter()
+    await client.request('session-exists', {'session_token':session_token})
+    return (time.perf_counter() - start)*1.0e3
+
+
+async def run_bench(url, secret, nhashing, nlookups):
+    '''
+    This sends nhashing password checks and nlookups session lookups at the
+    same time, and returns the lookup latencies and the server's pool stats.
+
+    '''
+
+    client = AuthnzerverClient(url, secret, request_timeout=60.0)
+
+    ok, resp, msgs = await client.request(
+        'session-new',
+        {'user_id':2,
+         'user_agent':'bench',
+         'expires':datetime.utcnow() + timedelta(hours=1),
+         'ip_address':'127.0.0.1',
+         'extra_info_json':{}}
+    )
+    session_token = resp['session_token']
+
+    hashing = [
+        client.request('user-passcheck',
+                       {'session_token':'not-a-session',
+                        'password':'not-a-password'})
+        for _ in range(nhashing)
+    ]
+
+    async def lookups():
+        latencies = []
+        for _ in range(nlookups):
+            latencies.append(await timed_lookup(client, session_token))
+            await asyncio.sleep(0.01)
+        return latencies
+
+    results = await asyncio.gather(lookups(), *hashing)
+    latencies = sorted(results[0])
+
+    ok, resp, msgs = await client.request('server-metrics', {})
+    client.close()
+
+    return latencies, resp['pools']
+
+
+async def main(nhashing=20, nlookups=50):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    with tempfile.TemporaryDirectory() as basedir:
+
+        authdb_path, creds, secrets_file = autogen_secrets_authdb(
+            basedir,
+            interactive=False
+        )
+        with open(secrets_file,'r') as infd:
+            secret = infd.read().strip('\n')
+
+        for name, hashworkers in (('shared pool', '0'),
+                                  ('separate pools', '2')):
+
+            env = os.environ.copy()
+            env.update({
+                "AUTHNZERVER_AUTHDB":authdb_path,
+                "AUTHNZERVER_BASEDIR":basedir,
+                "AUTHNZERVER_CACHEDIR":os.path.join(basedir, 'cache'),
+                "AUTHNZERVER_DEBUGMODE":"0",
+                "AUTHNZERVER_DISPATCH":"lookup:process",
+                "AUTHNZERVER_HASHWORKERS":hashworkers,
+                "AUTHNZERVER_LISTEN":"127.0.0.1",
+                "AUTHNZERVER_PORT":str(AUTHNZERVER_PORT),
+                "AUTHNZERVER_SECRET":secret,
+                "AUTHNZERVER_SESSIONEXPIRY":"60",
+                "AUTHNZERVER_WORKERS":"2",
+            })
+            authnzrv = subprocess.Popen(['authnzrv'], env=env)
+            time.sleep(2.5)
+
+            try:
+
+                latencies, pools = await run_bench(
+                    'http://127.0.0.1:%s' % AUTHNZERVER_PORT,
+                    secret,
+                    nhashing,
+                    nlookups
+                )
+                print('%-15s session-exists during %s password checks: '
+                      'p50 %7.2f ms, p95 %7.2f ms, max %7.2f ms' %
+                      (name, nhashing,
+                       latencies[len(latencies)//2],
+                       latencies[int(0.95*len(latencies))],
+                       latencies[-1]))
+                for pool, stats in sorted(pools.items()):
+                    print('%-15s   %-8s pool: %s workers, max queued %s' %
+                          ('', pool, stats['workers'], stats['max_queued']))
+
+            finally:
+                authnzrv.terminate()
+                authnzrv.wait()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# bench_permissions.py - Waqas Bhatti (wbhatti@astro.princeton.edu) - Mar 2020
+# License: MIT - see the LICENSE file for the full text.
+
+'''This compares the precomputed permissions decision table against the
+set-based policy checks across the whole default permissions model.
+
+Run it like so::
+
+    python benchmarks/bench_permissions.py
+
+'''
+
+import os.path
+import itertools
+import time
+
+from authnzerver import permissions
+
+
+def set_based_check(model,
+                    userid,
+                    role,
+                    action,
+                    target_name,
+                    target_owner,
+                    target_visibility):
+    '''
+    This is the set-based action check that the decision table replaces.
+
+    '''
+
+    role_policy = model['role_policy']
+
+    if (userid == target_owner and
+        target_name in role_policy[role]['can_own_items']):
+        perms = permissions.get_item_actions(model,
+                                             role,
+                                             target_name,
+                                             target_visibility,
+                                             'for_owned')
+    elif userid != target_owner:
+        perms = permissions.get_item_actions(model,
+                                             role,
+                                             target_name,
+                                             target_visibility,
+                                             'for_other')
+    else:
+        perms = set({})
+
+    return action in perms
+
+
+def table_based_check(model,
+                      userid,
+                      role,
+                      action,
+                      target_name,
+                      target_owner,
+                      target_visibility):
+    '''
+    This is the action check using the decision table.
+
+    '''
+
+    decision_table = model['decision_table']
+
+    table_index = (
+        ((decision_table['roles'][role]*len(decision_table['items']) +
+          decision_table['items'][target_name]) *
+         len(decision_table['visibilities']) +
+         decision_table['visibilities'][target_visibility])*2 +
+        (0 if userid == target_owner else 1)
+    )
+    return (
+        decision_table['table'][table_index] &
+        decision_table['actions'][action]
+    ) != 0
+
+
+def run_bench(func, model, space, repeats):
+    '''
+    This runs func over the decision space repeats times and returns the mean
+    time per decision in microseconds.
+
+    '''
+
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        for role, item, visibility, owner, action in space:
+            func(model, 4, role, action, item, owner, visibility)
+
+    elapsed = time.perf_counter() - start
+    return elapsed/(repeats*len(space))*1.0e6
+
+
+def main(repeats=50):
+    '''
+    This runs the benchmark.
+
+    '''
+
+    modpath = os.path.abspath(os.path.dirname(__file__))
+    permpath = os.path.abspath(
+        os.path.join(modpath, '..', 'authnzerver',
+                     'default-permissions-model.json')
+    )
+    model = permissions.load_permissions_json(permpath)
+
+    space = list(itertools.product(sorted(model['roles']),
+                                   sorted(model['items']),
+                                   sorted(model['visibilities']),
+                                   (4, 5),
+                                   sorted(model['actions'])))
+
+    # make sure both agree before timing them
+    for role, item, visibility, owner, action in space:
+        assert (
+            set_based_check(model, 4, role, action, item, owner, visibility) is
+            table_based_check(model, 4, role, action, item, owner, visibility)
+        )
+
+    set_us = run_bench(set_based_check, model, space, repeats)
+    table_us = run_bench(table_based_check, model, space, repeats)
+
+    full_start = time.perf_counter()
+    for _ in range(repeats):
+        for role, item, visibility, owner, action in space:
+            permissions.check_item_access(model,
+                                          userid=4,
+                                          role=role,
+                                          action=action,
+                                          target_name=item,
+                                          target_owner=owner,
+                                          target_visibility=visibility,
+                                          target_sharedwith='')
+    full_us = (
+        (time.perf_counter() - full_start)/(repeats*len(space))*1.0e6
+    )
+
+    print('decision space size: %s combinations' % len(space))
+    print('set-based action check:   %.3f us/decision' % set_us)
+    print('decision table check:     %.3f us/decision' % table_us)
+    print('speedup:                  %.1fx' % (set_us/table_us))
+    print('full check_item_access(): %.3f us/decision' % full_us)
+
+
+if __name__ == '__main__':
+    main()
@@ -54,9 +54,14 @@ setup(
     license='MIT',
     packages=find_packages(),
     install_requires=INSTALL_REQUIRES,
+    extras_require={
+        # pooled keep-alive connections from BaseHandler to the authnzerver
+        'curl':['pycurl>=7.43'],
+    },
     entry_points={
         'console_scripts':[
             'authnzrv=authnzerver.main:main',
+            'authnzrv-breached=authnzerver.breached:main',
         ],
     },
     include_package_data=True,